@@ -1,17 +1,26 @@
 from flask import Flask
+from api.group_commit import configure_group_commit
+from api.recording import configure_recording
 from api.routes import api_bp
-from db import db
-from db import data_seed
+from api.storage import configure_storage
+from db.config import configure_database
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///mydatabase.db'  # Change to SQLite database URI
 
-# Initialize SQLAlchemy
-db.init_app(app)
+# Database URL, pool sizing and SQLite pragmas come from the environment (DATABASE_URL etc.)
+configure_database(app)
+# GROUP_COMMIT=1 funnels POSTed rows through one writer that commits them in batches
+configure_group_commit(app)
+# STORAGE=memory serves every route from in-process records instead of the database
+configure_storage(app)
 
 # Register Blueprints
 app.register_blueprint(api_bp)
 
+# RECORD_TRAFFIC=path appends every /api/ request to a JSONL file for python -m bench.replay
+configure_recording(app)
+
 if __name__ == '__main__':
+    from db import data_seed
     data_seed.seed_data()
     app.run(debug=True)
@@ -0,0 +1,186 @@
+import asyncio
+import contextvars
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from api.app import app as flask_app
+from api.profiles import ProfileMiddleware
+from db.config import asgi_threads
+
+# Threads that run the Flask views and therefore the database calls. Connections are read from
+# and written to on the event loop, so a slow client never holds one of these threads. The
+# SQLAlchemy pool grows to this many connections by default (see db.config); an explicit
+# DB_POOL_SIZE + DB_MAX_OVERFLOW should not be smaller.
+ASGI_THREADS = asgi_threads()
+# Request bodies up to this size are read on the event loop before a thread is taken; larger
+# bodies (e.g. bulk imports) are streamed into the view as it reads them
+PREBUFFER_BYTES = int(os.environ.get('ASGI_PREBUFFER_BYTES', 1024 * 1024))
+# Response bytes collected per thread hop when a view returns a streamed body
+RESPONSE_CHUNK_BYTES = 64 * 1024
+# Streams whose chunks must reach the client as soon as they are produced
+UNBUFFERED_CONTENT_TYPES = (b'text/event-stream',)
+
+
+# wsgi.input for bodies larger than PREBUFFER_BYTES: the view's thread pulls the remaining
+# ASGI body messages from the event loop as it reads
+class _ReceiveStream(io.RawIOBase):
+    def __init__(self, initial, more_body, receive, loop):
+        self._buffer = bytearray(initial)
+        self._more_body = more_body
+        self._receive = receive
+        self._loop = loop
+
+    def readable(self):
+        return True
+
+    def readinto(self, target):
+        while not self._buffer and self._more_body:
+            message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+            if message['type'] == 'http.disconnect':
+                self._more_body = False
+                break
+            self._buffer.extend(message.get('body', b''))
+            self._more_body = message.get('more_body', False)
+        size = min(len(target), len(self._buffer))
+        target[:size] = self._buffer[:size]
+        del self._buffer[:size]
+        return size
+
+
+def _build_environ(scope, body_stream):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body_stream,
+        # Bodies sent with chunked encoding have no Content-Length; the stream itself ends them
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'asgi.scope': scope,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+            environ[name] = value
+            continue
+        key = 'HTTP_' + name
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+# Serves a WSGI app (the Flask app) under an ASGI server. Request and response bytes move on
+# the event loop; only the view itself runs on the bounded thread pool, all of one request's
+# thread hops sharing one contextvars context so Flask's request/app context and the scoped
+# SQLAlchemy session follow the request from hop to hop.
+class WsgiToAsgi:
+    def __init__(self, wsgi_app, threads=ASGI_THREADS):
+        self.wsgi_app = wsgi_app
+        self.threads = threads
+        self._executor = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='asgi')
+        return self._executor
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self._executor is not None:
+                    self._executor.shutdown(wait=True)
+                    self._executor = None
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _read_body(self, receive):
+        body = bytearray()
+        more_body = True
+        while more_body and len(body) <= PREBUFFER_BYTES:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return body, False, True
+            body.extend(message.get('body', b''))
+            more_body = message.get('more_body', False)
+        return body, more_body, False
+
+    async def _http(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        body, more_body, disconnected = await self._read_body(receive)
+        if disconnected:
+            return
+        if more_body:
+            body_stream = io.BufferedReader(_ReceiveStream(body, more_body, receive, loop))
+        else:
+            body_stream = io.BytesIO(bytes(body))
+        environ = _build_environ(scope, body_stream)
+        context = contextvars.copy_context()
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                  for name, value in headers]
+            started['unbuffered'] = any(name == b'content-type' and value.startswith(UNBUFFERED_CONTENT_TYPES)
+                                        for name, value in started['headers'])
+
+        def collect(iterator):
+            chunks = []
+            size = 0
+            for chunk in iterator:
+                if chunk:
+                    chunks.append(chunk)
+                    size += len(chunk)
+                    if size >= RESPONSE_CHUNK_BYTES or started['unbuffered']:
+                        return b''.join(chunks), False
+            return b''.join(chunks), True
+
+        def start():
+            iterable = self.wsgi_app(environ, start_response)
+            iterator = iter(iterable)
+            chunk, done = collect(iterator)
+            return iterable, iterator, chunk, done
+
+        def close(iterable):
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+        iterable, iterator, chunk, done = await loop.run_in_executor(self.executor, context.run, start)
+        try:
+            await send({'type': 'http.response.start', 'status': started['status'],
+                        'headers': started['headers']})
+            while not done:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk, done = await loop.run_in_executor(self.executor, context.run, collect, iterator)
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': False})
+        finally:
+            await loop.run_in_executor(self.executor, context.run, close, iterable)
+
+
+# Latency, rate-limit and fault-injection profiles (MOCK_PROFILES) run in front of the adapter
+app = ProfileMiddleware(WsgiToAsgi(flask_app), flask_app.url_map)
@@ -0,0 +1,96 @@
+import hashlib
+import threading
+import uuid
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Response, make_response, request
+
+from api.storage import get_storage
+
+# Total size of the serialized bodies kept in memory, and the largest single body worth keeping
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+RESPONSE_CACHE_MAX_ENTRY_BYTES = 8 * 1024 * 1024
+
+# Every ETag carries a per-process token: versions restart with a reseeded or restored
+# database (and with the in-memory backend), so an ETag from an earlier run never matches
+_PROCESS_TOKEN = uuid.uuid4().hex[:8]
+
+
+class LRUCache:
+    def __init__(self, max_bytes, max_entry_bytes):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry, nbytes):
+        if nbytes > self.max_entry_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+            self._entries[key] = (entry, nbytes)
+            self.size += nbytes
+            while self.size > self.max_bytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self.size -= evicted_bytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+response_cache = LRUCache(RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_MAX_ENTRY_BYTES)
+
+
+# Serve a GET view through the response cache. The ETag is derived from the versions of the
+# tables the view reads: write counters kept by triggers in the database (db/versions.py), so
+# writes from other workers, the dispatcher or plain SQL invalidate it too. One primary-key read
+# of data_versions per request, then a matching If-None-Match is answered with a 304 and an
+# unchanged read is served from memory without running the view's query.
+def cached_response(*resources):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # Streamed bodies are never buffered
+            if request.args.get('stream'):
+                return view(*args, **kwargs)
+
+            # Read the versions before the query so a concurrent write can only make the entry stale
+            versions = get_storage().data_versions(resources)
+            path_hash = hashlib.sha1(request.full_path.encode('utf-8')).hexdigest()[:12]
+            etag = f'{_PROCESS_TOKEN}-{"-".join(map(str, versions))}-{path_hash}'
+
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+
+            key = (request.endpoint, request.full_path)
+            cached = response_cache.get(key)
+            if cached is not None and cached[0][0] == versions:
+                _, body, mimetype = cached[0]
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                body = response.get_data()
+                mimetype = response.mimetype
+                response_cache.set(key, (versions, body, mimetype), len(body))
+
+            response = Response(body, status=200, mimetype=mimetype)
+            response.set_etag(etag)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,200 @@
+from datetime import datetime, timezone
+
+from sqlalchemy import select
+
+from db import db
+from db.models import Campaign, EmailTemplate, RecipientList
+
+# Upper bound on items in one batch request; keeps each IN (...) list well under SQLite's
+# bound-parameter limit and the transaction short
+MAX_BATCH_ITEMS = 5000
+MAX_NAME_LENGTH = 60
+
+BATCH_OPS = ('create', 'patch')
+# Columns a change can set; the rest (id, status, timestamps) are only known once the batch is written
+CHANGED_COLUMNS = ('name', 'send_time', 'campaign_template', 'recipient_category', 'template_name')
+
+
+class CampaignChangeError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+# The campaign names, categories and templates a set of changes refers to
+def referenced_names(changes):
+    names, categories, templates = set(), set(), set()
+    for op, target, data in changes:
+        if target:
+            names.add(target)
+        if isinstance(data, dict):
+            for key, found in (('name', names), ('recipient_category', categories),
+                               ('template_name', templates)):
+                if isinstance(data.get(key), str) and data[key]:
+                    found.add(data[key])
+    return names, categories, templates
+
+
+# The IN (...) queries for the campaigns, categories and templates a set of changes refers to,
+# keyed by which of the three they look up; a kind nothing refers to has no query
+def lookup_statements(changes):
+    names, categories, templates = referenced_names(changes)
+    statements = {}
+    if names:
+        statements['campaigns'] = select(Campaign).where(Campaign.name.in_(names))
+    if categories:
+        statements['categories'] = select(RecipientList.recipient_category) \
+            .where(RecipientList.recipient_category.in_(categories))
+    if templates:
+        statements['templates'] = select(EmailTemplate.name).where(EmailTemplate.name.in_(templates))
+    return statements
+
+
+# The names, categories and templates a set of changes refers to, each looked up with a single
+# IN (...) query. Campaigns created or renamed earlier in the same batch are tracked in
+# campaigns_by_name so later items see them. New campaigns are built as model and staged with add().
+class CampaignLookup:
+    model = Campaign
+
+    def __init__(self, changes):
+        statements = lookup_statements(changes)
+        self.campaigns_by_name = {}
+        if 'campaigns' in statements:
+            self.campaigns_by_name = {campaign.name: campaign for campaign in
+                                      db.session.execute(statements['campaigns']).scalars()}
+        self.categories = set()
+        if 'categories' in statements:
+            self.categories = set(db.session.execute(statements['categories']).scalars())
+        self.templates = set()
+        if 'templates' in statements:
+            self.templates = set(db.session.execute(statements['templates']).scalars())
+
+    def add(self, campaign):
+        db.session.add(campaign)
+
+
+# send_time is stored as naive UTC; a value with an offset is converted to it
+def _parse_send_time(value, now):
+    if not value:
+        raise CampaignChangeError('Send time is required')
+    try:
+        send_time = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise CampaignChangeError('Invalid send time format. ISO 8601 format expected')
+    if send_time.tzinfo is not None:
+        send_time = send_time.astimezone(timezone.utc).replace(tzinfo=None)
+    if send_time <= now:
+        raise CampaignChangeError('Send time must be in the future')
+    return send_time
+
+
+def _check_name(name, lookup, campaign=None):
+    if not name or not isinstance(name, str):
+        raise CampaignChangeError('Campaign name is required')
+    if len(name) > MAX_NAME_LENGTH:
+        raise CampaignChangeError(f'Campaign name exceeds maximum length of {MAX_NAME_LENGTH} characters')
+    existing = lookup.campaigns_by_name.get(name)
+    if existing is not None and existing is not campaign:
+        raise CampaignChangeError('Campaign name already exists', 409)
+
+
+def _check_references(data, lookup):
+    for key in ('recipient_category', 'template_name', 'campaign_template'):
+        if data.get(key) is not None and not isinstance(data[key], str):
+            raise CampaignChangeError(f'{key} must be a string')
+    if 'recipient_category' in data and data['recipient_category'] not in lookup.categories:
+        raise CampaignChangeError('Recipient category not found', 404)
+    if 'template_name' in data and data['template_name'] not in lookup.templates:
+        raise CampaignChangeError('Email template not found', 404)
+    if 'campaign_template' in data and not data['campaign_template']:
+        raise CampaignChangeError('Campaign Template cannot be Null')
+
+
+def validate_create(data, lookup, now):
+    if not isinstance(data, dict):
+        raise CampaignChangeError('Request body must be a JSON object')
+    _check_name(data.get('name'), lookup)
+    send_time = _parse_send_time(data.get('send_time'), now)
+    if not data.get('recipient_category'):
+        raise CampaignChangeError('Recipient category is required')
+    if not data.get('template_name'):
+        raise CampaignChangeError('Email template name is required')
+    if not data.get('campaign_template'):
+        raise CampaignChangeError('Campaign Template cannot be Null')
+    _check_references(data, lookup)
+    return lookup.model(name=data['name'], send_time=send_time, recipient_category=data['recipient_category'],
+                        campaign_template=data['campaign_template'], template_name=data['template_name'])
+
+
+# Validates every field first and only then assigns them, so a rejected change leaves the
+# campaign untouched
+def validate_update(name, data, lookup, now):
+    if not isinstance(data, dict):
+        raise CampaignChangeError('Request body must be a JSON object')
+    campaign = lookup.campaigns_by_name.get(name)
+    if campaign is None:
+        raise CampaignChangeError('Campaign not found', 404)
+    changes = {}
+    if 'name' in data:
+        _check_name(data['name'], lookup, campaign)
+        changes['name'] = data['name']
+    if 'send_time' in data:
+        changes['send_time'] = _parse_send_time(data['send_time'], now)
+    _check_references(data, lookup)
+    for key in ('recipient_category', 'template_name', 'campaign_template'):
+        if key in data:
+            changes[key] = data[key]
+    return campaign, changes
+
+
+# Validate and stage a sequence of (op, target_name, data) changes against lookup (a
+# CampaignLookup, or the in-memory backend's equivalent). Returns one (campaign, snapshot, error)
+# triple per change, snapshot holding the CHANGED_COLUMNS as that change left them, since a later
+# change in the batch may modify the same campaign; nothing is flushed or committed here.
+def apply_changes(changes, lookup):
+    now = datetime.utcnow()
+    results = []
+    for op, target, data in changes:
+        try:
+            if op == 'create':
+                campaign = validate_create(data, lookup, now)
+                lookup.add(campaign)
+            elif op == 'patch':
+                campaign, updates = validate_update(target, data, lookup, now)
+                if 'name' in updates and updates['name'] != campaign.name:
+                    del lookup.campaigns_by_name[campaign.name]
+                for key, value in updates.items():
+                    setattr(campaign, key, value)
+            else:
+                raise CampaignChangeError(f'op must be one of: {", ".join(BATCH_OPS)}')
+        except CampaignChangeError as exc:
+            results.append((None, None, exc))
+            continue
+        lookup.campaigns_by_name[campaign.name] = campaign
+        results.append((campaign, {column: getattr(campaign, column) for column in CHANGED_COLUMNS}, None))
+    return results
+
+
+# The serialized result of one change: the written campaign as of that change's snapshot
+def serialize_result(campaign, snapshot):
+    return {**campaign.serialize(), **snapshot, 'send_time': snapshot['send_time'].isoformat()}
+
+
+# Turn a batch request body into (op, target_name, data) changes. Raises CampaignChangeError
+# when the body as a whole is unusable; problems with single items are reported per item.
+def parse_batch(body):
+    if not isinstance(body, list):
+        raise CampaignChangeError('Request body must be a JSON array of changes')
+    if not body:
+        raise CampaignChangeError('At least one change is required')
+    if len(body) > MAX_BATCH_ITEMS:
+        raise CampaignChangeError(f'A batch may contain at most {MAX_BATCH_ITEMS} changes', 413)
+    changes = []
+    for item in body:
+        if not isinstance(item, dict):
+            changes.append((None, None, None))
+            continue
+        target = item.get('name') if item.get('op') == 'patch' else None
+        changes.append((item.get('op'), target if isinstance(target, str) else None, item.get('data')))
+    return changes
@@ -0,0 +1,199 @@
+import logging
+import os
+import threading
+import time
+
+from flask import Response, jsonify, request, stream_with_context
+
+from api.serialization import dumps, json_response
+from api.storage import get_storage
+from db.config import asgi_threads
+
+logger = logging.getLogger(__name__)
+
+# How often the per-process watcher reads the log head while at least one client is waiting
+POLL_INTERVAL = float(os.environ.get('CHANGE_FEED_POLL_INTERVAL', 0.25))
+# Clients held open at once per process. Each one blocks a view thread of the ASGI adapter while
+# it waits, so the default leaves half of ASGI_THREADS for every other route; beyond it the
+# feed answers 503 with Retry-After instead of waiting
+MAX_WAITERS = int(os.environ.get('CHANGE_FEED_MAX_WAITERS', max(1, asgi_threads() // 2)))
+BUSY_RETRY_AFTER_SECONDS = 2
+DEFAULT_WAIT_SECONDS = 25
+MAX_WAIT_SECONDS = 60
+# An SSE stream is closed after this long and the client reconnects with Last-Event-ID
+SSE_MAX_SECONDS = 300
+SSE_HEARTBEAT_SECONDS = 15
+SSE_RETRY_MS = 1000
+DEFAULT_CHANGES_LIMIT = 500
+MAX_CHANGES_LIMIT = 5000
+
+# One thread per process reads the head of the log while anyone is waiting and wakes the
+# waiters when it moves, so a thousand idle clients cost one indexed max(seq) per interval,
+# and nothing at all once they are gone. Writes from any process (other workers, the
+# dispatcher) are seen, since the log lives in the database. read_head is the storage
+# backend's change_head.
+class ChangeWatcher:
+    def __init__(self, poll_interval=POLL_INTERVAL, max_waiters=MAX_WAITERS):
+        self.poll_interval = poll_interval
+        self.max_waiters = max_waiters
+        self.head = None
+        self._waiters = 0
+        self._read_head = None
+        self._thread = None
+        self._cond = threading.Condition()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._waiters == 0:
+                    self._cond.wait()
+            try:
+                head = self._read_head()
+            except Exception:
+                logger.exception("Reading the campaign change log head failed")
+                head = None
+            with self._cond:
+                if head is not None and head != self.head:
+                    self.head = head
+                    self._cond.notify_all()
+            time.sleep(self.poll_interval)
+
+    def full(self):
+        with self._cond:
+            return self._waiters >= self.max_waiters
+
+    # Block until the log has an entry after since or timeout passes. Returns False on timeout,
+    # and None straight away when the process already holds max_waiters clients.
+    def wait(self, read_head, since, timeout):
+        with self._cond:
+            if self._waiters >= self.max_waiters:
+                return None
+            if self._thread is None:
+                self._read_head = read_head
+                self._thread = threading.Thread(target=self._run, name='change-watcher', daemon=True)
+                self._thread.start()
+            self._waiters += 1
+            self._cond.notify_all()
+            deadline = time.monotonic() + timeout
+            try:
+                while self.head is None or self.head <= since:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+                return True
+            finally:
+                self._waiters -= 1
+                if self._waiters == 0:
+                    # Not refreshed while nobody waits; the next waiter starts from a fresh read
+                    self.head = None
+
+
+watcher = ChangeWatcher()
+
+
+def _parse_int(value, name, minimum, default):
+    if value is None or value == '':
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError(f'{name} must be an integer.')
+    if value < minimum:
+        raise ValueError(f'{name} must be greater than or equal to {minimum}.')
+    return value
+
+
+# True when since cannot be continued from: entries after it were pruned, or it is ahead of a
+# log that was restarted (reseed, snapshot restore)
+def _needs_reset(since, oldest, head):
+    return since > (head or 0) or (oldest is not None and since < oldest - 1)
+
+
+def _busy_response():
+    response = jsonify({'error': 'Service unavailable',
+                        'message': 'Too many clients are waiting for changes; retry shortly.'})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(BUSY_RETRY_AFTER_SECONDS)
+    return response
+
+
+# Long-poll: answers with the entries after since as soon as there are any, or with an empty
+# list after ?wait seconds. Sync servers (one request per worker) get wait=0, a plain poll.
+def _poll_response(since, limit, wait):
+    storage = get_storage()
+    oldest, head = storage.change_bounds()
+    if _needs_reset(since, oldest, head):
+        return json_response({'changes': [], 'next_since': head or 0, 'reset': True})
+    changes = storage.read_changes(since, limit)
+    if not changes and wait:
+        # End the read transaction so the wait holds no connection and the re-read sees new rows
+        storage.release()
+        woke = watcher.wait(storage.change_head, since, wait)
+        if woke is None:
+            return _busy_response()
+        if woke:
+            changes = storage.read_changes(since, limit)
+    return json_response({
+        'changes': changes,
+        'next_since': changes[-1]['seq'] if changes else since,
+        'reset': False
+    })
+
+
+def _sse_event(change):
+    return b'id: %d\nevent: %s\ndata: %s\n\n' % (change['seq'], change['op'].encode('ascii'), dumps(change))
+
+
+def _sse_response(since, limit, multithread):
+    storage = get_storage()
+    oldest, head = storage.change_bounds()
+    reset = _needs_reset(since, oldest, head)
+    if reset:
+        since = head or 0
+
+    def generate():
+        nonlocal since
+        yield b'retry: %d\n\n' % SSE_RETRY_MS
+        if reset:
+            yield b'id: %d\nevent: reset\ndata: {}\n\n' % since
+        closes_at = time.monotonic() + SSE_MAX_SECONDS
+        while True:
+            changes = storage.read_changes(since, limit)
+            storage.release()
+            if changes:
+                since = changes[-1]['seq']
+                yield b''.join(_sse_event(change) for change in changes)
+                continue
+            # A sync worker cannot be held, nor a client that found the waiter limit reached since
+            # the stream opened: send what there is and let the client reconnect
+            if not multithread or time.monotonic() >= closes_at:
+                return
+            woke = watcher.wait(storage.change_head, since, min(SSE_HEARTBEAT_SECONDS, closes_at - time.monotonic()))
+            if woke is None:
+                return
+            if not woke:
+                yield b': keepalive\n\n'
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# GET /api/campaigns/changes?since=N. Without since (or Last-Event-ID) the feed starts at the
+# current head, so a client loads the list once and then follows the deltas.
+def changes_response():
+    try:
+        since = _parse_int(request.args.get('since', request.headers.get('Last-Event-ID')), 'since', 0, None)
+        limit = min(_parse_int(request.args.get('limit'), 'limit', 1, DEFAULT_CHANGES_LIMIT), MAX_CHANGES_LIMIT)
+        wait = min(_parse_int(request.args.get('wait'), 'wait', 0, DEFAULT_WAIT_SECONDS), MAX_WAIT_SECONDS)
+    except ValueError as exc:
+        return jsonify({'error': 'Invalid input', 'message': str(exc)}), 400
+    if since is None:
+        since = get_storage().change_bounds()[1] or 0
+
+    multithread = request.environ.get('wsgi.multithread', False)
+    if request.args.get('stream') == 'sse' or request.accept_mimetypes.best == 'text/event-stream':
+        if multithread and watcher.full():
+            return _busy_response()
+        return _sse_response(since, limit, multithread)
+    return _poll_response(since, limit, wait if multithread else 0)
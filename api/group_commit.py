@@ -0,0 +1,160 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from flask import current_app
+from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from db import db
+from db.config import engine_options, install_sqlite_pragmas, install_sqlite_transactions
+
+logger = logging.getLogger(__name__)
+
+# How long the writer keeps collecting after the first queued write, and the most writes
+# committed together. The default window of 0 commits whatever is queued at that moment:
+# writes arriving during a commit form the next batch, and a lone write is never delayed.
+DEFAULT_WINDOW_MS = 0.0
+DEFAULT_MAX_BATCH = 256
+# A request gives up on its write after this long
+RESULT_TIMEOUT_SECONDS = 30
+
+
+class WriteConflict(Exception):
+    pass
+
+
+class _Write:
+    __slots__ = ('instance', 'future')
+
+    def __init__(self, instance):
+        self.instance = instance
+        self.future = Future()
+
+
+# A single thread per process that inserts queued rows and commits them together: one
+# transaction, and one fsync with synchronous=FULL, per batch instead of per request. Each
+# row is flushed in its own savepoint, so a constraint violation (duplicate email, name or
+# category) rolls back and fails only that request. On SQLite this needs an engine with explicit
+# transactions (see writer_engine), or every savepoint commits on its own.
+class GroupCommitWriter:
+    def __init__(self, engine, window_ms=DEFAULT_WINDOW_MS, max_batch=DEFAULT_MAX_BATCH):
+        self.engine = engine
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self.batches = 0
+        self.writes = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='group-commit', daemon=True)
+        self._thread.start()
+
+    # Returns a future resolving to the row's serialize() dict, or failing with WriteConflict
+    def submit(self, instance):
+        write = _Write(instance)
+        self._queue.put(write)
+        return write.future
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            try:
+                remaining = deadline - time.monotonic()
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                self._commit(batch)
+            except Exception as exc:
+                logger.exception("Group commit of %d writes failed", len(batch))
+                for write in batch:
+                    if not write.future.done():
+                        write.future.set_exception(exc)
+
+    def _commit(self, batch):
+        with Session(self.engine, expire_on_commit=False) as session:
+            # The common case, no conflicts, is one flush: the rows of each model in one INSERT
+            try:
+                with session.begin_nested():
+                    session.add_all([write.instance for write in batch])
+            except IntegrityError:
+                written = self._flush_each(session, batch)
+            else:
+                written = batch
+            session.commit()
+            self.batches += 1
+            self.writes += len(written)
+            for write in written:
+                write.future.set_result(write.instance.serialize())
+
+    # Retries a batch that hit a constraint row by row, so only the conflicting requests fail
+    @staticmethod
+    def _flush_each(session, batch):
+        written = []
+        for write in batch:
+            try:
+                with session.begin_nested():
+                    session.add(write.instance)
+            except IntegrityError as exc:
+                write.future.set_exception(WriteConflict(str(exc.orig)))
+            else:
+                written.append(write)
+        return written
+
+
+def configure_group_commit(app):
+    app.config.setdefault('GROUP_COMMIT', os.environ.get('GROUP_COMMIT') == '1')
+    app.config.setdefault('GROUP_COMMIT_WINDOW_MS', float(os.environ.get('GROUP_COMMIT_WINDOW_MS', DEFAULT_WINDOW_MS)))
+    app.config.setdefault('GROUP_COMMIT_MAX_BATCH', int(os.environ.get('GROUP_COMMIT_MAX_BATCH', DEFAULT_MAX_BATCH)))
+
+
+_writer_lock = threading.Lock()
+
+
+# The app's engine, or for a SQLite file a second engine on it whose transactions are begun
+# explicitly (db.config.install_sqlite_transactions). The app's own engine keeps pysqlite's
+# default, where a request's reads run outside a transaction and never need a lock upgrade.
+def writer_engine(engine):
+    if engine.dialect.name != 'sqlite' or engine.url.database in (None, '', ':memory:'):
+        return engine
+    url = engine.url.render_as_string(hide_password=False)
+    writer = create_engine(url, **engine_options(url))
+    install_sqlite_pragmas(writer)
+    install_sqlite_transactions(writer)
+    return writer
+
+
+def group_writer():
+    app = current_app._get_current_object()
+    with _writer_lock:
+        writer = app.extensions.get('group_commit')
+        if writer is None:
+            writer = app.extensions['group_commit'] = GroupCommitWriter(
+                writer_engine(db.engine), app.config['GROUP_COMMIT_WINDOW_MS'], app.config['GROUP_COMMIT_MAX_BATCH'])
+    return writer
+
+
+# Persist a new row for a POST handler and return its serialize() dict. With GROUP_COMMIT=1
+# the row goes through the shared writer; otherwise it is committed on the request's session
+# as before. Either way a unique-constraint violation raises WriteConflict.
+def insert_row(instance):
+    if not current_app.config.get('GROUP_COMMIT'):
+        db.session.add(instance)
+        try:
+            db.session.commit()
+        except IntegrityError as exc:
+            db.session.rollback()
+            raise WriteConflict(str(exc.orig))
+        return instance.serialize()
+    # The request's read transaction is finished first so it holds no connection while it waits
+    db.session.rollback()
+    return group_writer().submit(instance).result(RESULT_TIMEOUT_SECONDS)
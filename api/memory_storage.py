@@ -0,0 +1,485 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+from datetime import datetime
+from itertools import islice
+from operator import attrgetter
+
+from sqlalchemy import create_engine, func, insert, select
+from sqlalchemy import inspect as inspect_schema
+
+from api.campaign_changes import apply_changes, referenced_names, serialize_result
+from api.group_commit import WriteConflict
+from api.storage import AudienceRow
+from db import db
+from db.change_log import CHANGE_LOG_RETENTION
+from db.models import (Campaign, CampaignChange, CampaignDispatch, EmailTemplate, Recipient, RecipientList,
+                       SeedMetadata)
+from db.schema import triggers_suspended
+from db.search import MAX_RANKED_CANDIDATES, MIN_TRIGRAM_LENGTH
+
+logger = logging.getLogger(__name__)
+
+# Rows per INSERT when a snapshot is written back to SQLite
+SNAPSHOT_CHUNK_SIZE = 10000
+# Imports larger than this re-sort the email index once instead of inserting into it row by row
+EMAIL_RESORT_THRESHOLD = 100
+
+
+class _Record:
+    __slots__ = ()
+    DEFAULTS = {}
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values.get(name, self.DEFAULTS.get(name)))
+
+    def copy(self):
+        clone = object.__new__(type(self))
+        for name in self.__slots__:
+            setattr(clone, name, getattr(self, name))
+        return clone
+
+
+# One compact record type per table, with the model's attribute names and its serialize(), so
+# responses are identical to the SQL backend's
+class RecipientRecord(_Record):
+    __slots__ = ('id', 'email', 'name', 'recipient_category')
+    serialize = Recipient.serialize
+
+
+class RecipientListRecord(_Record):
+    __slots__ = ('id', 'recipient_category', 'description', 'created_at', 'updated_at', 'recipient_count')
+    DEFAULTS = {'recipient_count': 0}
+    serialize = RecipientList.serialize
+
+
+class EmailTemplateRecord(_Record):
+    __slots__ = ('id', 'name', 'content', 'created_at', 'updated_at')
+    serialize = EmailTemplate.serialize
+
+
+class CampaignRecord(_Record):
+    __slots__ = ('id', 'name', 'send_time', 'campaign_template', 'recipient_category', 'template_name', 'status',
+                 'created_at', 'updated_at')
+    DEFAULTS = {'status': 'Scheduled'}
+    serialize = Campaign.serialize
+
+
+def _row_getter(names):
+    getter = attrgetter(*names)
+    return getter if len(names) > 1 else lambda record: (getter(record),)
+
+
+def _remove_id(ids, record_id):
+    del ids[bisect_left(ids, record_id)]
+
+
+def _add_id(ids, record_id):
+    # Ids are handed out in increasing order, so this is an append except while loading
+    if ids and record_id < ids[-1]:
+        insort(ids, record_id)
+    else:
+        ids.append(record_id)
+
+
+# Records by id plus the indexes the routes read through: ids in ascending order for keyset
+# pages, a dict per unique column, and an ascending id list per value of each indexed column.
+class _Table:
+    def __init__(self, model, record_type, unique=(), indexed=()):
+        self.model = model
+        self.record_type = record_type
+        self.columns = [column.name for column in model.__table__.columns]
+        self.rows = {}
+        self.ids = []
+        self.next_id = 1
+        # Counts writes, as the data_versions triggers do for the database
+        self.version = 0
+        self.unique = {column: {} for column in unique}
+        self.indexed = {column: {} for column in indexed}
+
+    def get(self, column, value):
+        return self.unique[column].get(value)
+
+    # The unique column record would collide on, if any
+    def conflict(self, record):
+        for column, index in self.unique.items():
+            existing = index.get(getattr(record, column))
+            if existing is not None and existing.id != record.id:
+                return column
+        return None
+
+    def add(self, record):
+        self.version += 1
+        if record.id is None:
+            record.id = self.next_id
+        self.next_id = max(self.next_id, record.id + 1)
+        self.rows[record.id] = record
+        _add_id(self.ids, record.id)
+        for column, index in self.unique.items():
+            index[getattr(record, column)] = record
+        for column, index in self.indexed.items():
+            _add_id(index.setdefault(getattr(record, column), []), record.id)
+
+    def update(self, record, changes):
+        self.version += 1
+        for column, value in changes.items():
+            old = getattr(record, column)
+            if old == value:
+                continue
+            if column in self.unique:
+                index = self.unique[column]
+                # Another record of the same batch may already have taken the old value
+                if index.get(old) is record:
+                    del index[old]
+                index[value] = record
+            if column in self.indexed:
+                _remove_id(self.indexed[column][old], record.id)
+                _add_id(self.indexed[column].setdefault(value, []), record.id)
+            setattr(record, column, value)
+
+    def ids_for(self, filters):
+        if not filters:
+            return self.ids
+        if len(filters) == 1:
+            (column, value), = filters.items()
+            if column in self.indexed:
+                return self.indexed[column].get(value, [])
+            if column in self.unique:
+                record = self.unique[column].get(value)
+                return [record.id] if record is not None else []
+        rows = self.rows
+        return [record_id for record_id in self.ids
+                if all(getattr(rows[record_id], column) == value for column, value in filters.items())]
+
+    # Records in id order after after_id; every match when limit is None
+    def select(self, filters, after_id=None, limit=None):
+        ids = self.ids_for(filters)
+        start = bisect_right(ids, after_id) if after_id is not None else 0
+        rows = self.rows
+        return [rows[record_id] for record_id in ids[start:None if limit is None else start + limit]]
+
+
+# What apply_changes validates against, like CampaignLookup, but over copies of the stored
+# campaigns: nothing changes in the store until the whole batch has been validated.
+class _CampaignLookup:
+    model = CampaignRecord
+
+    def __init__(self, storage, changes):
+        names, categories, templates = referenced_names(changes)
+        by_name = storage.campaigns.unique['name']
+        self.campaigns_by_name = {name: by_name[name].copy() for name in names if name in by_name}
+        self.categories = categories & storage.recipient_lists.unique['recipient_category'].keys()
+        self.templates = templates & storage.email_templates.unique['name'].keys()
+
+    def add(self, campaign):
+        pass
+
+
+# STORAGE=memory: every table held as __slots__ records in this process, with the SQL
+# backend's semantics (duplicate 409s, missing-reference 404s, cancel instead of delete, the
+# per-category counts, the campaign change log). Reads take no I/O at all and every write is
+# applied at once under one lock, so there is nothing to commit or roll back.
+# The tables are loaded from the database at first use and never written back to it. With
+# MEMORY_SNAPSHOT=path, state is written to that SQLite file at exit and loaded from it on the
+# next start. Each process has its own copy: run a single worker (WEB_CONCURRENCY=1 under
+# uvicorn) so every request sees every write. The dispatcher reads the database, so campaigns
+# created here are never sent, and audience progress is what was loaded.
+class MemoryStorage:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.recipients = _Table(Recipient, RecipientRecord, unique=('email',), indexed=('recipient_category',))
+        self.recipient_lists = _Table(RecipientList, RecipientListRecord, unique=('recipient_category',))
+        self.email_templates = _Table(EmailTemplate, EmailTemplateRecord, unique=('name',))
+        self.campaigns = _Table(Campaign, CampaignRecord, unique=('name',), indexed=('status',))
+        self.tables = {table.model: table for table in
+                       (self.recipients, self.recipient_lists, self.email_templates, self.campaigns)}
+        # Every recipient email in sorted order, for prefix searches
+        self.emails = []
+        self.category_counts = {}
+        # Rows of the tables no route writes, kept for the snapshot
+        self.dispatches = {}
+        self.seed_metadata = []
+        self.changes = deque(maxlen=CHANGE_LOG_RETENTION)
+        self.change_seq = 0
+
+    @classmethod
+    def load(cls, engine, snapshot=None):
+        storage = cls()
+        source = engine
+        if snapshot and os.path.exists(snapshot):
+            source = create_engine('sqlite:///' + os.path.abspath(snapshot))
+        started = time.perf_counter()
+        storage._load(source)
+        logger.info("Loaded %d recipients and %d campaigns from %s into memory in %.1fs",
+                    len(storage.recipients.rows), len(storage.campaigns.rows), source.url,
+                    time.perf_counter() - started)
+        if source is not engine:
+            source.dispose()
+        if snapshot:
+            atexit.register(storage.save, snapshot)
+        return storage
+
+    def _load(self, engine):
+        schema = inspect_schema(engine)
+        with engine.connect() as conn:
+            for table in (self.recipient_lists, self.email_templates, self.campaigns, self.recipients):
+                if not schema.has_table(table.model.__tablename__):
+                    continue
+                record_type, columns = table.record_type, table.columns
+                for row in conn.execute(select(*table.model.__table__.columns).order_by(table.model.id)):
+                    table.add(record_type(**dict(zip(columns, row))))
+            if schema.has_table(CampaignDispatch.__tablename__):
+                columns = [column.name for column in CampaignDispatch.__table__.columns]
+                self.dispatches = {row.campaign_id: dict(zip(columns, row)) for row in
+                                   conn.execute(select(*CampaignDispatch.__table__.columns))}
+            if schema.has_table(SeedMetadata.__tablename__):
+                self.seed_metadata = [dict(row._mapping) for row in conn.execute(select(SeedMetadata.__table__))]
+            # The log restarts empty, numbered on from the database's, so clients holding a cursor reload
+            if schema.has_table(CampaignChange.__tablename__):
+                self.change_seq = conn.execute(select(func.max(CampaignChange.seq))).scalar() or 0
+        self.emails = sorted(self.recipients.unique['email'])
+        for category, ids in self.recipients.indexed['recipient_category'].items():
+            self._count(category, len(ids))
+
+    # Write every table to a new SQLite file and move it over path. The counters, search index
+    # and change log are rebuilt by the same triggers a seeded database has.
+    def save(self, path):
+        started = time.perf_counter()
+        with self._lock:
+            tables = [(table.model, table.columns,
+                       list(map(attrgetter(*table.columns), (table.rows[record_id] for record_id in table.ids))))
+                      for table in self.tables.values()]
+            dispatches = list(self.dispatches.values())
+            seed_metadata = list(self.seed_metadata)
+        partial = path + '.partial'
+        if os.path.exists(partial):
+            os.remove(partial)
+        engine = create_engine('sqlite:///' + os.path.abspath(partial))
+        db.metadata.create_all(engine)
+        with engine.begin() as conn:
+            with triggers_suspended(conn):
+                for model, columns, rows in tables:
+                    for start in range(0, len(rows), SNAPSHOT_CHUNK_SIZE):
+                        conn.execute(insert(model), [dict(zip(columns, row))
+                                                     for row in rows[start:start + SNAPSHOT_CHUNK_SIZE]])
+                if dispatches:
+                    conn.execute(insert(CampaignDispatch), dispatches)
+                if seed_metadata:
+                    conn.execute(insert(SeedMetadata), seed_metadata)
+        engine.dispose()
+        os.replace(partial, path)
+        logger.info("Wrote the in-memory tables to %s in %.1fs", path, time.perf_counter() - started)
+
+    def _count(self, category, delta):
+        count = self.category_counts.get(category, 0) + delta
+        self.category_counts[category] = count
+        recipient_list = self.recipient_lists.get('recipient_category', category)
+        if recipient_list is not None:
+            recipient_list.recipient_count = count
+
+    def _log(self, op, campaign, now):
+        self.change_seq += 1
+        # Millisecond precision, as the SQLite trigger records it
+        changed_at = now.replace(microsecond=now.microsecond // 1000 * 1000)
+        self.changes.append({'seq': self.change_seq, 'campaign_id': campaign.id, 'op': op, 'name': campaign.name,
+                             'status': campaign.status, 'send_time': campaign.send_time, 'changed_at': changed_at})
+
+    def has_rows(self, model, filters):
+        with self._lock:
+            return bool(self.tables[model].ids_for(filters))
+
+    def select_rows(self, model, names, filters, after_id=None, limit=None):
+        getter = _row_getter(names)
+        with self._lock:
+            return [getter(record) for record in self.tables[model].select(filters, after_id, limit)]
+
+    def stream_rows(self, model, names, filters, chunk_size):
+        getter = _row_getter(names)
+        with self._lock:
+            records = self.tables[model].select(filters)
+        for start in range(0, len(records), chunk_size):
+            with self._lock:
+                rows = [getter(record) for record in records[start:start + chunk_size]]
+            yield rows
+
+    # The SQL backend's ordering without its index: short queries are email prefixes in email
+    # order; longer ones match email or name substrings, emails starting with q first. The
+    # substring scan runs outside the lock, since recipients are only ever appended.
+    def search_rows(self, q, names, offset, limit):
+        getter = _row_getter(names)
+        if len(q) < MIN_TRIGRAM_LENGTH:
+            needle = q.lower()
+            with self._lock:
+                emails, by_email = self.emails, self.recipients.unique['email']
+                start = bisect_left(emails, needle) + offset
+                matched = []
+                for email in islice(emails, start, start + limit):
+                    if not email.startswith(needle):
+                        break
+                    matched.append(by_email[email])
+                return [getter(record) for record in matched]
+
+        needle = q.lower()
+        rows, ids = self.recipients.rows, self.recipients.ids
+        matched = []
+        for index in range(len(ids)):
+            record = rows[ids[index]]
+            if needle in record.email.lower() or (record.name and needle in record.name.lower()):
+                matched.append(record)
+                if len(matched) >= MAX_RANKED_CANDIDATES:
+                    break
+        matched.sort(key=lambda record: not record.email.lower().startswith(needle))
+        with self._lock:
+            return [getter(record) for record in matched[offset:offset + limit]]
+
+    def exists(self, model, **key):
+        (column, value), = key.items()
+        with self._lock:
+            return self.tables[model].get(column, value) is not None
+
+    def insert(self, model, values):
+        table = self.tables[model]
+        record = table.record_type(**values)
+        with self._lock:
+            column = table.conflict(record)
+            if column is not None:
+                raise WriteConflict(f'UNIQUE constraint failed: {model.__tablename__}.{column}')
+            if 'created_at' in table.columns:
+                record.created_at = record.updated_at = datetime.utcnow()
+            if model is RecipientList:
+                record.recipient_count = self.category_counts.get(record.recipient_category, 0)
+            table.add(record)
+            if model is Recipient:
+                insort(self.emails, record.email)
+                self._count(record.recipient_category, 1)
+            return record.serialize()
+
+    def apply_campaign_changes(self, changes):
+        with self._lock:
+            outcomes = apply_changes(changes, _CampaignLookup(self, changes))
+            now = datetime.utcnow()
+            # A campaign patched twice in one batch is written once, in its final state
+            written = {id(campaign): campaign for campaign, _, error in outcomes if error is None}
+            for campaign in written.values():
+                self._write_campaign(campaign, now)
+            return [(serialize_result(campaign, snapshot) if error is None else None, error)
+                    for campaign, snapshot, error in outcomes]
+
+    def _write_campaign(self, campaign, now):
+        if campaign.id is None:
+            campaign.created_at = campaign.updated_at = now
+            self.campaigns.add(campaign)
+            self._log('insert', campaign, now)
+            return
+        stored = self.campaigns.rows[campaign.id]
+        changes = {column: getattr(campaign, column) for column in self.campaigns.columns
+                   if getattr(campaign, column) != getattr(stored, column)}
+        if changes:
+            campaign.updated_at = changes['updated_at'] = now
+            self.campaigns.update(stored, changes)
+            self._log('update', stored, now)
+
+    def cancel_campaign(self, name):
+        with self._lock:
+            campaign = self.campaigns.get('name', name)
+            if campaign is None:
+                return False
+            if campaign.status != 'Cancelled':
+                now = datetime.utcnow()
+                self.campaigns.update(campaign, {'status': 'Cancelled', 'updated_at': now})
+                self._log('update', campaign, now)
+            return True
+
+    def campaign(self, name):
+        with self._lock:
+            return self.campaigns.get('name', name)
+
+    def email_template(self, name):
+        with self._lock:
+            return self.email_templates.get('name', name)
+
+    def recipient_rows(self, recipient_category, limit, after_id=0):
+        with self._lock:
+            return [(record.id, record.email, record.name, record.recipient_category)
+                    for record in self.recipients.select({'recipient_category': recipient_category}, after_id, limit)]
+
+    def campaign_audience(self, name):
+        with self._lock:
+            campaign = self.campaigns.get('name', name)
+            if campaign is None:
+                return None
+            progress = self.dispatches.get(campaign.id, {})
+            return AudienceRow(campaign.name, campaign.recipient_category, campaign.status, campaign.send_time,
+                               self.category_counts.get(campaign.recipient_category),
+                               progress.get('sent_count'), progress.get('failed_count'))
+
+    def existing_categories(self, categories):
+        with self._lock:
+            return set(categories) & self.recipient_lists.unique['recipient_category'].keys()
+
+    def existing_emails(self, emails):
+        with self._lock:
+            return set(emails) & self.recipients.unique['email'].keys()
+
+    def insert_recipients(self, rows):
+        with self._lock:
+            by_email = self.recipients.unique['email']
+            taken = next((row['email'] for row in rows if row['email'] in by_email), None)
+            if taken is not None:
+                raise WriteConflict('UNIQUE constraint failed: recipients.email')
+            for row in rows:
+                self.recipients.add(RecipientRecord(**row))
+                self._count(row['recipient_category'], 1)
+            if len(rows) > EMAIL_RESORT_THRESHOLD:
+                self.emails.extend(row['email'] for row in rows)
+                self.emails.sort()
+            else:
+                for row in rows:
+                    insort(self.emails, row['email'])
+
+    def update_recipients(self, rows):
+        with self._lock:
+            by_email = self.recipients.unique['email']
+            for row in rows:
+                record = by_email[row['email']]
+                if record.recipient_category != row['recipient_category']:
+                    self._count(record.recipient_category, -1)
+                    self._count(row['recipient_category'], 1)
+                self.recipients.update(record, {'name': row['name'], 'recipient_category': row['recipient_category']})
+
+    # Writes are applied as they are made
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def release(self):
+        pass
+
+    def data_versions(self, resources):
+        by_name = {table.model.__tablename__: table for table in self.tables.values()}
+        with self._lock:
+            return tuple(by_name[resource].version for resource in resources)
+
+    def change_bounds(self):
+        with self._lock:
+            if not self.changes:
+                return None, None
+            return self.changes[0]['seq'], self.changes[-1]['seq']
+
+    def read_changes(self, since, limit):
+        with self._lock:
+            if not self.changes:
+                return []
+            start = max(0, since - self.changes[0]['seq'] + 1)
+            return list(islice(self.changes, start, start + limit))
+
+    def change_head(self):
+        with self._lock:
+            return self.changes[-1]['seq'] if self.changes else None
@@ -0,0 +1,169 @@
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# Statements slower than this are logged with the route that issued them; 0 disables the log
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # One slot per bucket plus +Inf; counts are per bucket and made cumulative when rendered
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+# In-process registry: with several gunicorn workers each worker reports its own series, which
+# Prometheus aggregates per instance as usual
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = {}
+        self.statements = {}
+        self.sql_seconds = {}
+        self.slow_statements = {}
+        self.failed_statements = {}
+
+    def observe_request(self, route, method, status, seconds, statements, sql_seconds):
+        with self._lock:
+            key = (route, method, status)
+            if key not in self.latency:
+                self.latency[key] = Histogram(LATENCY_BUCKETS)
+            self.latency[key].observe(seconds)
+            key = (route, method)
+            if key not in self.statements:
+                self.statements[key] = Histogram(STATEMENT_BUCKETS)
+            self.statements[key].observe(statements)
+            self.sql_seconds[key] = self.sql_seconds.get(key, 0.0) + sql_seconds
+
+    def observe_slow_statement(self, route, method):
+        with self._lock:
+            key = (route, method)
+            self.slow_statements[key] = self.slow_statements.get(key, 0) + 1
+
+    def observe_failed_statement(self, route, method):
+        with self._lock:
+            key = (route, method)
+            self.failed_statements[key] = self.failed_statements.get(key, 0) + 1
+
+    def render(self):
+        with self._lock:
+            lines = ['# HELP http_request_duration_seconds Request latency by route, method and status.',
+                     '# TYPE http_request_duration_seconds histogram']
+            for (route, method, status), histogram in sorted(self.latency.items()):
+                lines.extend(histogram.render('http_request_duration_seconds',
+                                              f'route="{route}",method="{method}",status="{status}"'))
+            lines += ['# HELP db_statements_per_request SQL statements issued per request.',
+                      '# TYPE db_statements_per_request histogram']
+            for (route, method), histogram in sorted(self.statements.items()):
+                lines.extend(histogram.render('db_statements_per_request', f'route="{route}",method="{method}"'))
+            lines += ['# HELP db_statement_seconds_total Time spent executing SQL statements.',
+                      '# TYPE db_statement_seconds_total counter']
+            for (route, method), seconds in sorted(self.sql_seconds.items()):
+                lines.append(f'db_statement_seconds_total{{route="{route}",method="{method}"}} {seconds}')
+            lines += ['# HELP db_slow_statements_total SQL statements slower than SLOW_QUERY_MS.',
+                      '# TYPE db_slow_statements_total counter']
+            for (route, method), count in sorted(self.slow_statements.items()):
+                lines.append(f'db_slow_statements_total{{route="{route}",method="{method}"}} {count}')
+            lines += ['# HELP db_failed_statements_total SQL statements that raised an error.',
+                      '# TYPE db_failed_statements_total counter']
+            for (route, method), count in sorted(self.failed_statements.items()):
+                lines.append(f'db_failed_statements_total{{route="{route}",method="{method}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def _route():
+    # The rule template, not the raw path, keeps label cardinality bounded
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _observe_statement(statement, time.perf_counter() - conn.info['query_start_time'].pop())
+
+
+# A statement that raises never reaches after_cursor_execute: pop its start time here, or the
+# stack on the pooled connection grows and every later statement is timed against the wrong start
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    conn = context.connection
+    if conn is None or context.execution_context is None or not conn.info.get('query_start_time'):
+        return
+    elapsed = time.perf_counter() - conn.info['query_start_time'].pop()
+    if _observe_statement(context.statement or '', elapsed):
+        registry.observe_failed_statement(_route(), request.method)
+
+
+# Adds the statement to the current request's totals; False outside a metered request
+def _observe_statement(statement, elapsed):
+    if not has_request_context() or '_metrics_started' not in g:
+        return False
+    g._metrics_statements += 1
+    g._metrics_sql_seconds += elapsed
+    if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+        registry.observe_slow_statement(_route(), request.method)
+        logger.warning("Slow query (%.1f ms) in %s %s: %s", elapsed * 1000, request.method, _route(),
+                       ' '.join(statement.split())[:500])
+    return True
+
+
+def start_request():
+    g._metrics_started = time.perf_counter()
+    g._metrics_statements = 0
+    g._metrics_sql_seconds = 0.0
+
+
+def finish_request(response):
+    if '_metrics_started' in g:
+        registry.observe_request(_route(), request.method, response.status_code,
+                                 time.perf_counter() - g._metrics_started,
+                                 g._metrics_statements, g._metrics_sql_seconds)
+    return response
+
+
+def metrics_response():
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+def init_metrics(blueprint):
+    blueprint.before_request(start_request)
+    blueprint.after_request(finish_request)
+    blueprint.add_url_rule('/metrics', 'metrics', metrics_response, methods=['GET'])
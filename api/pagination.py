@@ -0,0 +1,116 @@
+from flask import Response, jsonify, request, stream_with_context
+
+from api.serialization import dumps, json_response, requested_fields, rows_to_dicts
+from api.storage import get_storage
+
+# Page size used when the client asks for pagination without giving a limit
+DEFAULT_PAGE_SIZE = 100
+# Hard cap on a single page so a client cannot ask for the whole table at once
+MAX_PAGE_SIZE = 1000
+# Number of rows fetched per round-trip from the server-side cursor while streaming
+STREAM_CHUNK_SIZE = 1000
+
+STREAM_FORMATS = ('json', 'ndjson')
+# Ranked results are paged by offset; past this many rows the client should refine the query
+MAX_RANKED_OFFSET = 10000
+
+
+def _invalid(message):
+    return jsonify({'error': 'Invalid input', 'message': message}), 400
+
+
+def _parse_int_arg(name, minimum):
+    value = request.args.get(name)
+    if value is None or value == '':
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError(f'{name} must be an integer.')
+    if value < minimum:
+        raise ValueError(f'{name} must be greater than or equal to {minimum}.')
+    return value
+
+
+def _stream_rows(partitions, names, fmt):
+    if fmt == 'ndjson':
+        def generate():
+            for rows in partitions:
+                yield b''.join(dumps(row) + b'\n' for row in rows_to_dicts(names, rows))
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    def generate():
+        yield b'['
+        separator = b''
+        for rows in partitions:
+            yield separator + b','.join(dumps(row) for row in rows_to_dicts(names, rows))
+            separator = b','
+        yield b']'
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+# Serialize the rows of a list query according to the request's paging arguments:
+#   - no paging arguments: the full list, as before
+#   - after_id / limit: one keyset page wrapped as {'items': [...], 'next_cursor': id}
+#   - stream=json / stream=ndjson: the rows streamed from a server-side cursor
+# Only the columns named by ?fields=a,b are selected, as plain row tuples. filters are
+# column=value equalities, e.g. list_response(Campaign, status='Sent').
+# empty_error is returned as a 404 when the first page (or the full list) is empty.
+def list_response(model, empty_error=None, **filters):
+    try:
+        after_id = _parse_int_arg('after_id', 0)
+        limit = _parse_int_arg('limit', 1)
+        fields = requested_fields(model)
+    except ValueError as exc:
+        return _invalid(str(exc))
+
+    stream = request.args.get('stream')
+    if stream and stream not in STREAM_FORMATS:
+        return _invalid(f'stream must be one of: {", ".join(STREAM_FORMATS)}.')
+
+    names = list(fields)
+    # The keyset cursor needs the id even when the client did not ask for it; as the trailing
+    # column it is dropped by zip() when the rows become dicts
+    selected = names if 'id' in fields else names + ['id']
+    id_position = selected.index('id')
+
+    storage = get_storage()
+    if empty_error and after_id is None and not storage.has_rows(model, filters):
+        return jsonify({'error': empty_error}), 404
+
+    if stream:
+        return _stream_rows(storage.stream_rows(model, selected, filters, STREAM_CHUNK_SIZE), names, stream)
+
+    if after_id is None and limit is None:
+        return json_response(rows_to_dicts(names, storage.select_rows(model, selected, filters)))
+
+    limit = min(limit or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+    # Fetch one extra row to know whether another page exists
+    rows = storage.select_rows(model, selected, filters, after_id, limit + 1)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return json_response({
+        'items': rows_to_dicts(names, rows),
+        'next_cursor': rows[-1][id_position] if has_more else None
+    })
+
+
+# One page of a ranked query, which has no stable key to page on. fetch(names, offset, limit)
+# returns the rows in rank order; ?cursor is the offset of the page, returned as next_cursor.
+def ranked_response(model, fetch):
+    try:
+        offset = _parse_int_arg('cursor', 0) or 0
+        limit = min(_parse_int_arg('limit', 1) or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+        fields = requested_fields(model)
+    except ValueError as exc:
+        return _invalid(str(exc))
+    if offset > MAX_RANKED_OFFSET:
+        return _invalid(f'cursor cannot be greater than {MAX_RANKED_OFFSET}; narrow the query instead.')
+
+    names = list(fields)
+    rows = fetch(names, offset, limit + 1)
+    has_more = len(rows) > limit
+    return json_response({
+        'items': rows_to_dicts(names, rows[:limit]),
+        'next_cursor': offset + limit if has_more and offset + limit <= MAX_RANKED_OFFSET else None
+    })
@@ -0,0 +1,304 @@
+import asyncio
+import bisect
+import json
+import logging
+import math
+import os
+import random
+import time
+
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import RequestRedirect
+
+logger = logging.getLogger(__name__)
+
+# JSON file holding the named profiles and which one is active; see profiles.example.json
+PROFILES_PATH = os.environ.get('MOCK_PROFILES')
+# When set, the admin endpoint requires 'Authorization: Bearer <token>'
+ADMIN_TOKEN = os.environ.get('MOCK_ADMIN_TOKEN')
+# How often each worker checks the file for changes made by hand or by another worker
+RELOAD_INTERVAL_SECONDS = 1.0
+
+LATENCY_TYPES = ('fixed', 'normal', 'percentiles')
+
+
+# A callable returning one latency sample in seconds:
+#   {"type": "fixed", "ms": 50}
+#   {"type": "normal", "mean_ms": 80, "stddev_ms": 20}          (clipped at 0)
+#   {"type": "percentiles", "p50": 20, "p90": 60, "p99": 400, "p99.9": 2000}
+# Percentile specs are sampled by inverse transform, interpolating linearly between the given
+# points (p0 is 0 ms unless given), which reproduces a long tail without choosing a distribution.
+def latency_sampler(spec, rng):
+    kind = spec.get('type')
+    if kind == 'fixed':
+        value = float(spec['ms']) / 1000.0
+        return lambda: value
+    if kind == 'normal':
+        mean, stddev = float(spec['mean_ms']) / 1000.0, float(spec.get('stddev_ms', 0)) / 1000.0
+        return lambda: max(0.0, rng.gauss(mean, stddev))
+    if kind == 'percentiles':
+        points = {0.0: 0.0}
+        for key, value in spec.items():
+            if key == 'type':
+                continue
+            if not key.startswith('p'):
+                raise ValueError(f'Unknown percentile key {key!r}; expected e.g. p50, p99, p99.9')
+            points[float(key[1:]) / 100.0] = float(value) / 1000.0
+        fractions = sorted(points)
+        values = [points[fraction] for fraction in fractions]
+        if any(later < earlier for earlier, later in zip(values, values[1:])):
+            raise ValueError('Percentile latencies must not decrease')
+
+        def sample():
+            u = rng.random()
+            index = bisect.bisect_right(fractions, u)
+            if index >= len(fractions):
+                return values[-1]
+            low, high = fractions[index - 1], fractions[index]
+            return values[index - 1] + (values[index] - values[index - 1]) * (u - low) / (high - low)
+        return sample
+    raise ValueError(f'latency type must be one of: {", ".join(LATENCY_TYPES)}')
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    # Take a token; returns 0 when granted, else the seconds until one is available
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
+
+
+# What happens to requests matching one route key of the active profile. Buckets and counters
+# live here, per worker process: a limit of 100/s with 4 workers admits up to 400/s in total.
+class RouteProfile:
+    __slots__ = ('latency', 'bucket', 'error_rate', 'error_status', 'rng',
+                 'requests', 'delayed_seconds', 'rate_limited', 'injected_errors')
+
+    def __init__(self, spec, rng):
+        unknown = set(spec) - {'latency', 'rate_limit', 'error_rate', 'error_status'}
+        if unknown:
+            raise ValueError(f'Unknown route profile keys: {", ".join(sorted(unknown))}')
+        self.rng = rng
+        self.latency = latency_sampler(spec['latency'], rng) if spec.get('latency') else None
+        limit = spec.get('rate_limit')
+        self.bucket = None
+        if limit:
+            rate, burst = float(limit['rate']), float(limit.get('burst', limit['rate']))
+            if not rate > 0.0:
+                raise ValueError('rate_limit rate must be greater than 0')
+            if not burst >= 1.0:
+                raise ValueError('rate_limit burst must be at least 1')
+            self.bucket = TokenBucket(rate, burst)
+        self.error_rate = float(spec.get('error_rate', 0.0))
+        if not 0.0 <= self.error_rate <= 1.0:
+            raise ValueError('error_rate must be between 0 and 1')
+        self.error_status = int(spec.get('error_status', 500))
+        self.requests = 0
+        self.delayed_seconds = 0.0
+        self.rate_limited = 0
+        self.injected_errors = 0
+
+    def stats(self):
+        return {'requests': self.requests, 'delayed_seconds': round(self.delayed_seconds, 3),
+                'rate_limited': self.rate_limited, 'injected_errors': self.injected_errors}
+
+
+# The profile file, parsed and validated:
+#   {"active": "name or null", "seed": 1,
+#    "profiles": {"name": {"GET /api/recipients/<recipient_category>": {...}, "/api/campaigns": {...}, "*": {...}}}}
+# Route keys are a Flask rule, optionally prefixed with a method; "*" matches every request.
+# An invalid route rule fails the whole set, unless skip_invalid is set: then it is logged and left out.
+class ProfileSet:
+    def __init__(self, config, skip_invalid=False):
+        if not isinstance(config, dict) or not isinstance(config.get('profiles', {}), dict):
+            raise ValueError('Profile config must be an object with a "profiles" object')
+        self.config = {'active': config.get('active'), 'seed': config.get('seed'),
+                       'profiles': config.get('profiles', {})}
+        self.rng = random.Random(self.config['seed'])
+        self.profiles = {name: self._routes(name, routes, skip_invalid)
+                         for name, routes in self.config['profiles'].items()}
+        if self.config['active'] is not None and self.config['active'] not in self.profiles:
+            raise ValueError(f'Unknown active profile {self.config["active"]!r}')
+
+    def _routes(self, name, routes, skip_invalid):
+        parsed = {}
+        for key, spec in routes.items():
+            try:
+                parsed[key] = RouteProfile(spec, self.rng)
+            except (ValueError, KeyError, TypeError) as exc:
+                if not skip_invalid:
+                    raise ValueError(f'Invalid rule {key!r} in profile {name!r}: {exc}') from exc
+                logger.error("Skipping invalid mock profile rule %r in profile %r: %s", key, name, exc)
+        return parsed
+
+    @property
+    def routes(self):
+        return self.profiles.get(self.config['active']) or {}
+
+    # The most specific key for a request; wildcards only cover /api/ so /metrics keeps working
+    def match(self, method, rule, path):
+        routes = self.routes
+        if rule is not None:
+            for key in (f'{method} {rule}', rule):
+                if key in routes:
+                    return routes[key]
+        if not path.startswith('/api/'):
+            return None
+        return routes.get(f'{method} *') or routes.get('*')
+
+    def describe(self):
+        return dict(self.config, stats={key: profile.stats() for key, profile in self.routes.items()})
+
+
+# Rules in the file are checked again on every reload, and a bad one is skipped rather than
+# taking the rest of the file down with it (a hand edit may have broken a single rule)
+def load_profiles(path):
+    if not path or not os.path.exists(path):
+        return ProfileSet({})
+    with open(path, encoding='utf-8') as handle:
+        return ProfileSet(json.load(handle), skip_invalid=True)
+
+
+# Atomically replace the file so workers reloading it never read a partial write
+def save_profiles(path, config):
+    partial = path + '.partial'
+    with open(partial, 'w', encoding='utf-8') as handle:
+        json.dump(config, handle, indent=2)
+    os.replace(partial, path)
+
+
+ADMIN_PATH = '/admin/profiles'
+
+
+async def _send_json(send, status, body, headers=()):
+    payload = json.dumps(body).encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'),
+                            (b'content-length', str(len(payload)).encode('latin-1')), *headers]})
+    await send({'type': 'http.response.body', 'body': payload, 'more_body': False})
+
+
+# ASGI middleware in front of the WSGI adapter that applies the active profile: token-bucket
+# limits answered with 429, latency spent in asyncio.sleep on the event loop and injected
+# errors, all before a view thread is taken. Delayed or failed requests therefore cost no
+# worker thread, and thousands can be held at once.
+# GET /admin/profiles shows the config and per-route counters of the active profile;
+# PUT /admin/profiles with {"active": "name"} switches profile ({"active": null} turns them
+# off), and a body with "profiles" replaces the definitions. With MOCK_PROFILES set the change
+# is written to the file, which every worker reloads within RELOAD_INTERVAL_SECONDS.
+class ProfileMiddleware:
+    def __init__(self, app, url_map, path=PROFILES_PATH):
+        self.app = app
+        self.adapter = url_map.bind('localhost')
+        self.path = path
+        self._mtime = None
+        self._checked = 0.0
+        self.profiles = ProfileSet({})
+        self._reload(force=True)
+
+    def _reload(self, force=False):
+        now = time.monotonic()
+        if not self.path or (not force and now - self._checked < RELOAD_INTERVAL_SECONDS):
+            return
+        self._checked = now
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self._mtime and not force:
+            return
+        self._mtime = mtime
+        try:
+            self.profiles = load_profiles(self.path)
+            logger.info("Loaded mock profiles from %s (active: %s)", self.path, self.profiles.config['active'])
+        except (OSError, ValueError, KeyError, TypeError) as exc:
+            # Keep serving with the previous profiles rather than failing every request
+            logger.error("Ignoring invalid mock profiles in %s: %s", self.path, exc)
+
+    def _rule(self, path, method):
+        try:
+            rule, _ = self.adapter.match(path, method, return_rule=True)
+        except (HTTPException, RequestRedirect):
+            return None
+        return rule.rule
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        if scope['path'] == ADMIN_PATH:
+            return await self._admin(scope, receive, send)
+
+        self._reload()
+        if not self.profiles.routes:
+            return await self.app(scope, receive, send)
+        method, path = scope['method'], scope['path']
+        profile = self.profiles.match(method, self._rule(path, method), path)
+        if profile is None:
+            return await self.app(scope, receive, send)
+
+        profile.requests += 1
+        if profile.bucket is not None:
+            wait = profile.bucket.take()
+            if wait:
+                profile.rate_limited += 1
+                return await _send_json(send, 429, {
+                    'error': 'Too many requests',
+                    'message': f'Rate limited by mock profile {self.profiles.config["active"]!r}.'
+                }, [(b'retry-after', str(max(1, math.ceil(wait))).encode('latin-1'))])
+        if profile.latency is not None:
+            delay = profile.latency()
+            profile.delayed_seconds += delay
+            await asyncio.sleep(delay)
+        if profile.error_rate and profile.rng.random() < profile.error_rate:
+            profile.injected_errors += 1
+            return await _send_json(send, profile.error_status, {
+                'error': 'Injected fault',
+                'message': f'Failed on purpose by mock profile {self.profiles.config["active"]!r}.'
+            })
+        return await self.app(scope, receive, send)
+
+    async def _admin(self, scope, receive, send):
+        headers = dict(scope.get('headers', []))
+        if ADMIN_TOKEN and headers.get(b'authorization', b'').decode('latin-1') != f'Bearer {ADMIN_TOKEN}':
+            return await _send_json(send, 401, {'error': 'Unauthorized'})
+        if scope['method'] == 'GET':
+            self._reload()
+            return await _send_json(send, 200, self.profiles.describe())
+        if scope['method'] != 'PUT':
+            return await _send_json(send, 405, {'error': 'Method not allowed'}, [(b'allow', b'GET, PUT')])
+
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.extend(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+        try:
+            update = json.loads(body or b'{}')
+            if not isinstance(update, dict):
+                raise ValueError('Body must be a JSON object')
+            config = dict(self.profiles.config)
+            config.update(update)
+            profiles = ProfileSet(config)
+        except (ValueError, KeyError, TypeError) as exc:
+            return await _send_json(send, 400, {'error': 'Invalid input', 'message': str(exc)})
+        if self.path:
+            save_profiles(self.path, profiles.config)
+            self._mtime = os.stat(self.path).st_mtime_ns
+        self.profiles = profiles
+        logger.info("Mock profile switched to %s", profiles.config['active'])
+        return await _send_json(send, 200, profiles.describe())
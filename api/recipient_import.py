@@ -0,0 +1,199 @@
+import csv
+import io
+import json
+import re
+
+from sqlalchemy.exc import IntegrityError
+
+from api.group_commit import WriteConflict
+from api.storage import get_storage
+from db.models import normalize_email
+
+# Rows validated and written together; keeps every IN (...) list below SQLite's variable limit
+IMPORT_BATCH_SIZE = 5000
+# Number of batches written per transaction
+BATCHES_PER_COMMIT = 10
+# Upper bound on the number of row errors echoed back to the client
+MAX_REPORTED_ERRORS = 1000
+
+IMPORT_MODES = ('insert', 'upsert')
+
+CSV_CONTENT_TYPES = ('text/csv',)
+NDJSON_CONTENT_TYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+
+EMAIL_RE = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+
+
+class ImportReport:
+    def __init__(self):
+        self.processed = 0
+        self.inserted = 0
+        self.updated = 0
+        self.failed = 0
+        self.errors = []
+
+    def add_error(self, row_number, email, message):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'row': row_number, 'email': email, 'error': message})
+
+    def serialize(self):
+        return {
+            'processed': self.processed,
+            'inserted': self.inserted,
+            'updated': self.updated,
+            'failed': self.failed,
+            'errors': sorted(self.errors, key=lambda error: error['row']),
+            'errors_truncated': self.failed > len(self.errors)
+        }
+
+
+def _iter_csv(stream):
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8', newline=''))
+    for row_number, row in enumerate(reader, start=1):
+        yield row_number, row
+
+
+def _iter_ndjson(stream):
+    row_number = 0
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        row_number += 1
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield row_number, record if isinstance(record, dict) else None
+
+
+def iter_records(stream, content_type):
+    if content_type in CSV_CONTENT_TYPES:
+        return _iter_csv(stream)
+    if content_type in NDJSON_CONTENT_TYPES:
+        return _iter_ndjson(stream)
+    raise ValueError(f'Unsupported content type {content_type!r}; '
+                     f'expected one of: {", ".join(CSV_CONTENT_TYPES + NDJSON_CONTENT_TYPES)}.')
+
+
+def _row_email(record):
+    email = record.get('email') if record else None
+    return normalize_email(email) if isinstance(email, str) else None
+
+
+# Same rules as POST /api/recipients, applied to a single row. NDJSON values can be of any JSON
+# type, so every field is checked to be a string (or null where allowed) before it is used.
+def _validate_row(record):
+    if record is None:
+        return 'Malformed row.'
+    if record.get('email') is not None and not isinstance(record['email'], str):
+        return 'email must be a string.'
+    email = _row_email(record)
+    if not email:
+        return 'email is required and cannot be null.'
+    if not EMAIL_RE.match(email):
+        return 'email is not a valid email address.'
+    category = record.get('recipient_category')
+    if category is not None and not isinstance(category, str):
+        return 'recipient_category must be a string.'
+    if not category:
+        return 'recipient_category is required and cannot be null.'
+    name = record.get('name')
+    if name is not None and not isinstance(name, str):
+        return 'name must be a string.'
+    if name is not None and len(name) > 32:
+        return 'name cannot be more than 32 characters.'
+    return None
+
+
+class RecipientImporter:
+    def __init__(self, mode='insert'):
+        if mode not in IMPORT_MODES:
+            raise ValueError(f'mode must be one of: {", ".join(IMPORT_MODES)}.')
+        self.mode = mode
+        self.report = ImportReport()
+        self._known_categories = set()
+        self.storage = get_storage()
+
+    def _resolve_categories(self, categories):
+        missing = categories - self._known_categories
+        if missing:
+            self._known_categories.update(self.storage.existing_categories(missing))
+        return self._known_categories
+
+    def _write_batch(self, batch):
+        report = self.report
+        rows = []
+        seen = set()
+        for row_number, record in batch:
+            error = _validate_row(record)
+            email = _row_email(record)
+            if error:
+                report.add_error(row_number, email, error)
+            elif email in seen:
+                report.add_error(row_number, email, 'Duplicate email within the import.')
+            else:
+                seen.add(email)
+                rows.append((row_number, {
+                    'email': email,
+                    'name': record.get('name') or None,
+                    'recipient_category': record['recipient_category']
+                }))
+
+        # One IN (...) query per batch for categories and for already-stored emails
+        categories = self._resolve_categories({values['recipient_category'] for _, values in rows})
+        existing = self.storage.existing_emails(seen) if seen else set()
+
+        to_insert = []
+        to_update = []
+        for row_number, values in rows:
+            if values['recipient_category'] not in categories:
+                report.add_error(row_number, values['email'], 'Recipient category not found.')
+            elif values['email'] in existing:
+                if self.mode == 'upsert':
+                    to_update.append(values)
+                else:
+                    report.add_error(row_number, values['email'], 'A recipient with this email already exists.')
+            else:
+                to_insert.append(values)
+
+        if to_insert:
+            self.storage.insert_recipients(to_insert)
+            report.inserted += len(to_insert)
+        if to_update:
+            self.storage.update_recipients(to_update)
+            report.updated += len(to_update)
+
+    # A row that became a duplicate after the existing_emails() check (a concurrent writer took the email)
+    # fails the whole uncommitted part of the import with WriteConflict; the report then only counts the
+    # rows of batches that were committed before it.
+    def run(self, records):
+        report = self.report
+        batch = []
+        batches_since_commit = 0
+        committed = (0, 0)
+        try:
+            for row_number, record in records:
+                self.report.processed += 1
+                batch.append((row_number, record))
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    self._write_batch(batch)
+                    batch = []
+                    batches_since_commit += 1
+                    if batches_since_commit >= BATCHES_PER_COMMIT:
+                        self.storage.commit()
+                        committed = (report.inserted, report.updated)
+                        batches_since_commit = 0
+            if batch:
+                self._write_batch(batch)
+            self.storage.commit()
+        except IntegrityError as exc:
+            self.storage.rollback()
+            report.inserted, report.updated = committed
+            raise WriteConflict(str(exc.orig)) from exc
+        except Exception:
+            self.storage.rollback()
+            report.inserted, report.updated = committed
+            raise
+        return report
@@ -0,0 +1,200 @@
+import atexit
+import base64
+import io
+import logging
+import os
+import queue
+import threading
+import time
+
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import RequestRedirect
+
+from api.serialization import dumps
+
+logger = logging.getLogger(__name__)
+
+# Entries waiting for the writer; when it falls this far behind, new entries are dropped (and
+# counted) rather than slowing requests down
+MAX_PENDING = 100000
+# The writer appends whatever is queued at least this often
+FLUSH_INTERVAL_SECONDS = 1.0
+# Larger request bodies are recorded without their content and skipped on replay
+MAX_RECORDED_BODY = 1024 * 1024
+# Read size when the rest of a body the view left unread is drained for the recording
+DRAIN_CHUNK_BYTES = 64 * 1024
+# Request headers that change the response and are replayed as recorded
+RECORDED_HEADERS = ('CONTENT_TYPE', 'HTTP_ACCEPT', 'HTTP_IF_NONE_MATCH', 'HTTP_LAST_EVENT_ID')
+
+
+# Appends queued entries to a JSONL file from one background thread per process. Each batch
+# goes out in a single write() on an O_APPEND descriptor, so several workers can record to
+# the same file without interleaving lines.
+class RecordWriter:
+    def __init__(self, path):
+        self.path = path
+        self.written = 0
+        self.dropped = 0
+        self._queue = queue.Queue(MAX_PENDING)
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._thread = threading.Thread(target=self._run, name='traffic-recorder', daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def put(self, entry):
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        lines = []
+        while True:
+            try:
+                lines.append(dumps(self._queue.get_nowait()))
+            except queue.Empty:
+                break
+        if lines:
+            os.write(self._fd, b'\n'.join(lines) + b'\n')
+            self.written += len(lines)
+
+    def _run(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL_SECONDS)
+            try:
+                self.flush()
+            except OSError:
+                logger.exception("Writing recorded traffic to %s failed", self.path)
+
+
+# wsgi.input of a recorded request: reads go straight to the server's stream, chunked bodies
+# and large uploads included, and the first MAX_RECORDED_BODY bytes are copied on the way. Past
+# that the copy is dropped and the body marked truncated.
+class _TeeInput(io.RawIOBase):
+    def __init__(self, stream, length, terminated):
+        self._stream = stream
+        # Content-Length, or None for a chunked body, which only a terminated stream ends
+        self._length = length
+        self._terminated = terminated
+        self._read = 0
+        self.copied = bytearray()
+        self.truncated = False
+        self.finished = False
+
+    def readable(self):
+        return True
+
+    def _copy(self, data, size):
+        self._read += len(data)
+        if not data:
+            self.finished = self.finished or size != 0
+        elif not self.truncated:
+            if len(self.copied) + len(data) > MAX_RECORDED_BODY:
+                self.truncated = True
+                self.copied = bytearray()
+            else:
+                self.copied += data
+        return data
+
+    def read(self, size=-1):
+        return self._copy(self._stream.read() if size is None or size < 0 else self._stream.read(size), size)
+
+    def readline(self, size=-1):
+        return self._copy(self._stream.readline() if size is None or size < 0 else self._stream.readline(size), size)
+
+    def readinto(self, target):
+        data = self.read(len(target))
+        target[:len(data)] = data
+        return len(data)
+
+    # Reads whatever the view left unread, up to the recording limit, so the entry holds the
+    # whole body (e.g. of a request rejected before its body was parsed). Never reads past
+    # Content-Length, nor from a stream without one that the server does not terminate, since
+    # either would block on the connection.
+    def drain(self):
+        if self._length is None and not self._terminated:
+            return
+        while not self.finished and not self.truncated:
+            size = DRAIN_CHUNK_BYTES if self._length is None else min(DRAIN_CHUNK_BYTES, self._length - self._read)
+            if size <= 0:
+                return
+            self.read(size)
+
+    def body_fields(self):
+        if self.truncated:
+            return {'body': None, 'body_truncated': True}
+        body = bytes(self.copied)
+        try:
+            return {'body': body.decode('utf-8')}
+        except UnicodeDecodeError:
+            return {'body_b64': base64.b64encode(body).decode('ascii')}
+
+
+# WSGI middleware recording one line per /api/ request: wall-clock start, method, Flask rule,
+# path, query string, the headers that affect the response, the body, and the status and
+# duration the server produced. Duration runs until the response body has been sent, as a
+# client sees it. The request body is copied as the view reads it (see _TeeInput), so it
+# reaches the view unchanged; everything else happens on the background writer.
+class TrafficRecorder:
+    def __init__(self, wsgi_app, url_map, path):
+        self.wsgi_app = wsgi_app
+        self.adapter = url_map.bind('localhost')
+        self.writer = RecordWriter(path)
+
+    def _rule(self, path, method):
+        try:
+            rule, _ = self.adapter.match(path, method, return_rule=True)
+        except (HTTPException, RequestRedirect):
+            return None
+        return rule.rule
+
+    def __call__(self, environ, start_response):
+        if not environ.get('PATH_INFO', '').startswith('/api/'):
+            return self.wsgi_app(environ, start_response)
+        return self._record(environ, start_response)
+
+    def _record(self, environ, start_response):
+        started_at = time.time()
+        started = time.perf_counter()
+        try:
+            length = int(environ['CONTENT_LENGTH']) if environ.get('CONTENT_LENGTH') else None
+        except ValueError:
+            length = None
+        body = environ['wsgi.input'] = _TeeInput(environ['wsgi.input'], length,
+                                                 environ.get('wsgi.input_terminated', False))
+
+        method, path = environ['REQUEST_METHOD'], environ['PATH_INFO']
+        entry = {
+            'ts': round(started_at, 6),
+            'method': method,
+            'rule': self._rule(path, method),
+            'path': path,
+            'query': environ.get('QUERY_STRING', ''),
+            'headers': {name: environ[name] for name in RECORDED_HEADERS if environ.get(name)},
+        }
+        status = []
+
+        def recording_start_response(status_line, headers, exc_info=None):
+            status[:] = [int(status_line.split(' ', 1)[0])]
+            return start_response(status_line, headers, exc_info)
+
+        response = self.wsgi_app(environ, recording_start_response)
+        try:
+            yield from response
+        finally:
+            if hasattr(response, 'close'):
+                response.close()
+            body.drain()
+            entry.update(body.body_fields())
+            entry['status'] = status[0] if status else 500
+            entry['duration_ms'] = round((time.perf_counter() - started) * 1000, 3)
+            self.writer.put(entry)
+
+
+# RECORD_TRAFFIC=/path/to/traffic.jsonl records every /api/ request for replay with
+# python -m bench.replay. Off by default.
+def configure_recording(app):
+    app.config.setdefault('RECORD_TRAFFIC', os.environ.get('RECORD_TRAFFIC'))
+    if app.config['RECORD_TRAFFIC']:
+        app.wsgi_app = TrafficRecorder(app.wsgi_app, app.url_map, app.config['RECORD_TRAFFIC'])
+        logger.info("Recording /api/ traffic to %s", app.config['RECORD_TRAFFIC'])
@@ -1,33 +1,47 @@
 from flask import Blueprint, jsonify, request
-from db.models import RecipientList, Recipient, EmailTemplate, Campaign
-from db import db
-from datetime import datetime
+from db.models import RecipientList, Recipient, EmailTemplate, Campaign, normalize_email
+from api.campaign_changes import CampaignChangeError, parse_batch
+from api.cache import cached_response
+from api.change_feed import changes_response
+from api.group_commit import WriteConflict
+from api.metrics import init_metrics
+from api.pagination import list_response, ranked_response
+from api.recipient_import import RecipientImporter, iter_records
+from api.storage import get_storage
+from dispatch.templating import render_campaign_batch
+import csv
 
 api_bp = Blueprint('api', __name__)
 
+# Per-route latency and SQL statement metrics, served on /metrics
+init_metrics(api_bp)
+
+# Upper bound on the number of recipients rendered by one preview request
+PREVIEW_MAX_RECIPIENTS = 100
+
 
 @api_bp.route('/api/recipient_lists', methods=['GET'])
+# recipient_count changes with every recipient write
+@cached_response('recipient_lists', 'recipients')
 def get_recipient_lists():
-    recipient_lists = RecipientList.query.all()
-    return jsonify([resp_list.serialize() for resp_list in recipient_lists])
+    return list_response(RecipientList)
 
 
 @api_bp.route('/api/recipients', methods=['GET'])
 def get_recipients():
-    recipients = Recipient.query.all()
-    return jsonify([recipient.serialize() for recipient in recipients])
+    return list_response(Recipient)
 
 
 @api_bp.route('/api/email_templates', methods=['GET'])
+@cached_response('email_templates')
 def get_email_templates():
-    email_templates = EmailTemplate.query.all()
-    return jsonify([template.serialize() for template in email_templates])
+    return list_response(EmailTemplate)
 
 
 @api_bp.route('/api/campaigns', methods=['GET'])
+@cached_response('campaigns')
 def get_campaigns():
-    campaigns = Campaign.query.all()
-    return jsonify([campaign.serialize() for campaign in campaigns])
+    return list_response(Campaign)
 
 
 @api_bp.route('/api/recipients', methods=['POST'])
@@ -40,6 +54,12 @@ def create_recipient():
             'error': 'Invalid input',
             'message': 'email is required and cannot be null.'
         }), 400
+    if not isinstance(data['email'], str):
+        return jsonify({
+            'error': 'Invalid input',
+            'message': 'email must be a string.'
+        }), 400
+    email = normalize_email(data['email'])
 
     # Check if recipient_category is provided
     if 'recipient_category' not in data or not data['recipient_category']:
@@ -49,8 +69,7 @@ def create_recipient():
         }), 400
 
     # Check if email is unique
-    existing_recipient = Recipient.query.filter_by(email=data['email']).first()
-    if existing_recipient:
+    if get_storage().exists(Recipient, email=email):
         return jsonify({
             'error': 'Duplicate entry',
             'message': 'A recipient with this email already exists.'
@@ -64,11 +83,44 @@ def create_recipient():
         }), 400
 
     # If no issues, create the new recipient
-    new_recipient = Recipient(email=data['email'], name=data.get('name'),
-                              recipient_category=data.get('recipient_category'))
-    db.session.add(new_recipient)
-    db.session.commit()
-    return jsonify(new_recipient.serialize()), 201
+    try:
+        created = get_storage().insert(Recipient, {'email': email, 'name': data.get('name'),
+                                                   'recipient_category': data.get('recipient_category')})
+    except WriteConflict:
+        # Lost a race with a concurrent request for the same email
+        return jsonify({
+            'error': 'Duplicate entry',
+            'message': 'A recipient with this email already exists.'
+        }), 409
+    return jsonify(created), 201
+
+
+@api_bp.route('/api/recipients/bulk', methods=['POST'])
+def bulk_import_recipients():
+    # Body is streamed as CSV (with a header row) or NDJSON, one recipient per row
+    try:
+        importer = RecipientImporter(mode=request.args.get('mode', 'insert'))
+        records = iter_records(request.stream, request.mimetype)
+    except ValueError as exc:
+        return jsonify({'error': 'Invalid input', 'message': str(exc)}), 400
+
+    try:
+        report = importer.run(records)
+    except (UnicodeDecodeError, csv.Error) as exc:
+        # Batches committed before the parse error are kept
+        return jsonify({
+            'error': 'Invalid input',
+            'message': f'Could not parse the import body: {exc}',
+            'report': importer.report.serialize()
+        }), 400
+    except WriteConflict:
+        # Lost a race with a concurrent writer for one of the emails; batches committed before it are kept
+        return jsonify({
+            'error': 'Duplicate entry',
+            'message': 'A recipient in the import was created concurrently; the uncommitted rows were not imported.',
+            'report': importer.report.serialize()
+        }), 409
+    return jsonify(report.serialize()), 200
 
 
 @api_bp.route('/api/recipient_lists', methods=['POST'])
@@ -79,16 +131,18 @@ def create_recipient_list():
     recipient_category = data['recipient_category']
 
     # Check for duplicates
-    existing_list = RecipientList.query.filter_by(recipient_category=recipient_category).first()
-    if existing_list:
+    if get_storage().exists(RecipientList, recipient_category=recipient_category):
         return jsonify(
             {'error': 'Duplicate entry', 'message': 'A recipient list with this category already exists.'}), 409
 
     # If no duplicate is found, create the new recipient list
-    new_list = RecipientList(recipient_category=recipient_category, description=data.get('description'))
-    db.session.add(new_list)
-    db.session.commit()
-    return jsonify(new_list.serialize()), 201
+    try:
+        created = get_storage().insert(RecipientList, {'recipient_category': recipient_category,
+                                                       'description': data.get('description')})
+    except WriteConflict:
+        return jsonify(
+            {'error': 'Duplicate entry', 'message': 'A recipient list with this category already exists.'}), 409
+    return jsonify(created), 201
 
 
 @api_bp.route('/api/email_templates', methods=['POST'])
@@ -110,217 +164,167 @@ def create_email_template():
         }), 400
 
     # Check if template name is unique
-    existing_template = EmailTemplate.query.filter_by(name=data['name']).first()
-    if existing_template:
+    if get_storage().exists(EmailTemplate, name=data['name']):
         return jsonify({
             'error': 'Duplicate entry',
             'message': 'A template with this name already exists.'
         }), 409
 
     # If no issues, create the new email template
-    new_template = EmailTemplate(name=data['name'], content=data['content'])
-    db.session.add(new_template)
-    db.session.commit()
-    return jsonify(new_template.serialize()), 201
-
-
-@api_bp.route('/api/campaigns', methods=['POST'])
-def create_campaign():
-    data = request.json
-
-    # Check if campaign name is provided and not null
-    if 'name' not in data or not data['name']:
-        return jsonify({'error': 'Campaign name is required'}), 400
-
-    # Check if campaign name exceeds max length of 20 characters
-    if len(data['name']) > 60:
-        return jsonify({'error': 'Campaign name exceeds maximum length of 20 characters'}), 400
-
-    # Check if send_time is provided and not null
-    if 'send_time' not in data or not data['send_time']:
-        return jsonify({'error': 'Send time is required'}), 400
-
-    # Convert send_time to datetime object
     try:
-        send_time = datetime.fromisoformat(data['send_time'])
-    except ValueError:
-        return jsonify({'error': 'Invalid send time format. ISO 8601 format expected'}), 400
+        created = get_storage().insert(EmailTemplate, {'name': data['name'], 'content': data['content']})
+    except WriteConflict:
+        return jsonify({
+            'error': 'Duplicate entry',
+            'message': 'A template with this name already exists.'
+        }), 409
+    return jsonify(created), 201
 
-    # Check if send_time is in the past
-    if send_time < datetime.utcnow():
-        return jsonify({'error': 'Send time must be in the future'}), 400
 
-    # Check if campaign name is unique
-    existing_campaign = Campaign.query.filter_by(name=data['name']).first()
-    if existing_campaign:
+# Validate and apply a single campaign change through the same core the batch endpoint uses
+def _apply_campaign_change(op, name, data, status):
+    try:
+        (campaign, error), = get_storage().apply_campaign_changes([(op, name, data)])
+    except WriteConflict:
+        # Lost a race with a concurrent request for the same name
         return jsonify({'error': 'Campaign name already exists'}), 409
+    if error:
+        return jsonify({'error': error.message}), error.status
+    return jsonify(campaign), status
 
-    recipient_category = data.get('recipient_category')
-    if recipient_category:
-        recipient_list = RecipientList.query.filter_by(recipient_category=recipient_category).first()
-        if not recipient_list:
-            return jsonify({'error': 'Recipient category not found'}), 404
 
-    # Check if the template_name exists in email_templates
-    template_name = data.get('template_name')
-    if template_name:
-        email_template = EmailTemplate.query.filter_by(name=template_name).first()
-        if not email_template:
-            return jsonify({'error': 'Email template not found'}), 404
+@api_bp.route('/api/campaigns', methods=['POST'])
+def create_campaign():
+    return _apply_campaign_change('create', None, request.json, 201)
 
-    # Create the new campaign
-    new_campaign = Campaign(name=data['name'], send_time=send_time, recipient_category=recipient_category,
-                            campaign_template=data['campaign_template'], template_name=template_name)
-    db.session.add(new_campaign)
-    db.session.commit()
 
-    return jsonify(new_campaign.serialize()), 201
+# Creates and patches many campaigns at once. Every referenced name, category and template is
+# resolved with one IN (...) query each and all valid changes are committed in one transaction;
+# items that fail validation are reported in place and skipped.
+@api_bp.route('/api/campaigns/batch', methods=['POST'])
+def batch_campaign_changes():
+    try:
+        changes = parse_batch(request.get_json(silent=True))
+    except CampaignChangeError as exc:
+        return jsonify({'error': 'Invalid input', 'message': exc.message}), exc.status
+
+    try:
+        outcomes = get_storage().apply_campaign_changes(changes)
+    except WriteConflict:
+        # Only reachable when a concurrent writer took a name between the lookup and the commit
+        return jsonify({'error': 'Conflict', 'message': 'The batch conflicts with a concurrent change; retry it.'}), 409
+    applied = [campaign for campaign, error in outcomes if error is None]
+    results = [
+        {'index': index, 'status': 201 if op == 'create' else 200, 'campaign': campaign}
+        if error is None else {'index': index, 'status': error.status, 'error': error.message}
+        for index, ((op, _, _), (campaign, error)) in enumerate(zip(changes, outcomes))
+    ]
+    return jsonify({'applied': len(applied), 'failed': len(outcomes) - len(applied), 'results': results}), 200
+
+
+# Every campaign insert, update and delete since ?since=N, as a long-poll or (with
+# Accept: text/event-stream or ?stream=sse) as Server-Sent Events
+@api_bp.route('/api/campaigns/changes', methods=['GET'])
+def get_campaign_changes():
+    return changes_response()
 
 
 @api_bp.route('/api/campaigns/delete', methods=['DELETE'])
 def delete_campaign_by_name():
     name = request.args.get('name')
-    print(name)
     if not name:
         return jsonify({'error': 'Name parameter is required for deletion'}), 400
 
-    campaign = Campaign.query.filter_by(name=name).first()
-    print(campaign)
-    if not campaign:
+    # Campaigns are never deleted, only set to "Cancelled"
+    if not get_storage().cancel_campaign(name):
         return jsonify({'error': 'Campaign not found'}), 404
 
-    # Update the status to "Cancelled"
-    campaign.status = "Cancelled"
-    db.session.commit()
-
     return jsonify({'message': f'Campaign "{name}" has been cancelled'}), 200
 
 
+# Recipients whose email or name contains q, best matches first, served from the trigram index
+@api_bp.route('/api/recipients/search', methods=['GET'])
+@cached_response('recipients')
+def search_recipients():
+    q = (request.args.get('q') or '').strip()
+    if not q:
+        return jsonify({'error': 'Invalid input', 'message': 'q is required and cannot be null.'}), 400
+    if len(q) > 100:
+        return jsonify({'error': 'Invalid input', 'message': 'q cannot be more than 100 characters.'}), 400
+    return ranked_response(Recipient, lambda names, offset, limit: get_storage().search_rows(q, names, offset, limit))
+
+
 @api_bp.route('/api/recipients/<recipient_category>', methods=['GET'])
 def get_recipients_by_category(recipient_category):
-    recipients = Recipient.query.filter_by(recipient_category=recipient_category).all()
-    if not recipients:
-        return jsonify({'error': 'No recipients found for the given category'}), 404
-    return jsonify([recipient.serialize() for recipient in recipients])
+    return list_response(Recipient, empty_error='No recipients found for the given category',
+                         recipient_category=recipient_category)
 
 
+# PUT and PATCH both update only the fields present in the body
 @api_bp.route('/api/campaigns/<name>', methods=['PUT'])
 def update_campaign_by_name(name):
-    data = request.json
-
-    # Check if the campaign exists
-    campaign = Campaign.query.filter_by(name=name).first()
-    if not campaign:
-        return jsonify({'error': 'Campaign not found'}), 404
-
-    # Check if the campaign name is provided and not null
-    if 'name' in data:
-        if not data['name']:
-            return jsonify({'error': 'Campaign name is required'}), 400
-        # Check if campaign name exceeds max length of 60 characters
-        if len(data['name']) > 60:
-            return jsonify({'error': 'Campaign name exceeds maximum length of 60 characters'}), 400
-        # Check if campaign name is unique
-        existing_campaign = Campaign.query.filter_by(name=data['name']).first()
-        if existing_campaign and existing_campaign.id != campaign.id:
-            return jsonify({'error': 'Campaign name already exists'}), 409
-        campaign.name = data['name']
-
-    # Check if send_time is provided and not null
-    if 'send_time' in data:
-        if not data['send_time']:
-            return jsonify({'error': 'Send time is required'}), 400
-        # Convert send_time to datetime object
-        try:
-            send_time = datetime.fromisoformat(data['send_time'])
-        except ValueError:
-            return jsonify({'error': 'Invalid send time format. ISO 8601 format expected'}), 400
-        # Check if send_time is in the future
-        if send_time <= datetime.utcnow():
-            return jsonify({'error': 'Send time must be greater than the current time'}), 400
-        campaign.send_time = send_time
-
-    # Check if the recipient_category exists in recipient_lists
-    if 'recipient_category' in data:
-        recipient_category = data['recipient_category']
-        recipient_list = RecipientList.query.filter_by(recipient_category=recipient_category).first()
-        if not recipient_list:
-            return jsonify({'error': 'Recipient category not found'}), 404
-        campaign.recipient_category = recipient_category
-
-    # Check if the template_name exists in email_templates
-    if 'template_name' in data:
-        template_name = data['template_name']
-        email_template = EmailTemplate.query.filter_by(name=template_name).first()
-        if not email_template:
-            return jsonify({'error': 'Email template not found'}), 404
-        campaign.template_name = template_name
-
-    # Update other fields if provided
-    if 'campaign_template' in data:
-        if not data['campaign_template']:
-            return jsonify({'error': 'Campaign Template cannot be Null'}), 400
-        campaign.campaign_template = data['campaign_template']
-
-    db.session.commit()
-    return jsonify(campaign.serialize()), 200
+    return _apply_campaign_change('patch', name, request.json, 200)
 
 
 @api_bp.route('/api/campaigns/<name>', methods=['PATCH'])
 def partial_update_campaign_by_name(name):
-    data = request.json
-
-    # Check if the campaign exists
-    campaign = Campaign.query.filter_by(name=name).first()
-    if not campaign:
-        return jsonify({'error': 'Campaign not found'}), 404
-
-    # Update fields if provided
-    if 'name' in data:
-        campaign.name = data['name']
-
-    if 'send_time' in data:
-        try:
-            send_time = datetime.fromisoformat(data['send_time'])
-        except ValueError:
-            return jsonify({'error': 'Invalid send time format. ISO 8601 format expected'}), 400
-
-        if send_time <= datetime.utcnow():
-            return jsonify({'error': 'Send time must be greater than the current time'}), 400
-
-        campaign.send_time = send_time
-
-    if 'recipient_category' in data:
-        recipient_category = data['recipient_category']
-        recipient_list = RecipientList.query.filter_by(recipient_category=recipient_category).first()
-        if not recipient_list:
-            return jsonify({'error': 'Recipient category not found'}), 404
-        campaign.recipient_category = recipient_category
-
-    if 'template_name' in data:
-        template_name = data['template_name']
-        email_template = EmailTemplate.query.filter_by(name=template_name).first()
-        if not email_template:
-            return jsonify({'error': 'Email template not found'}), 404
-        campaign.template_name = template_name
-
-    if 'campaign_template' in data:
-        if data['campaign_template'] == "":
-            return jsonify({'error': 'Campaign Template cannot be Null'}), 404
-        campaign.campaign_template = data['campaign_template']
-
-    db.session.commit()
-    return jsonify(campaign.serialize()), 200
+    return _apply_campaign_change('patch', name, request.json, 200)
 
 
 @api_bp.route('/api/campaigns/<status>', methods=['GET'])
+@cached_response('campaigns')
 def get_campaigns_by_status(status):
     # Assuming Campaign model exists with a 'status' field
 
-    # Retrieve campaigns based on status
-    campaigns = Campaign.query.filter_by(status=status).all()
+    # Retrieve campaigns based on status, paginated or streamed on request
+    return list_response(Campaign, status=status)
+
 
-    # Serialize the campaigns
-    serialized_campaigns = [campaign.serialize() for campaign in campaigns]
+@api_bp.route('/api/campaigns/<name>/preview', methods=['GET'])
+def preview_campaign(name):
+    storage = get_storage()
+    campaign = storage.campaign(name)
+    if not campaign:
+        return jsonify({'error': 'Campaign not found'}), 404
+
+    try:
+        limit = int(request.args.get('limit', 10))
+    except ValueError:
+        return jsonify({'error': 'Invalid input', 'message': 'limit must be an integer.'}), 400
+    if limit < 1:
+        return jsonify({'error': 'Invalid input', 'message': 'limit must be greater than or equal to 1.'}), 400
+    limit = min(limit, PREVIEW_MAX_RECIPIENTS)
+
+    email_template = storage.email_template(campaign.template_name)
+    if not email_template:
+        return jsonify({'error': 'Email template not found'}), 404
+
+    # Render the first recipients of the campaign's audience exactly as the dispatcher would
+    rows = storage.recipient_rows(campaign.recipient_category, limit)
+    bodies = render_campaign_batch(campaign, email_template, rows)
+    return jsonify([
+        {'recipient_id': row[0], 'email': row[1], 'subject': campaign.name, 'body': body}
+        for row, body in zip(rows, bodies)
+    ]), 200
+
+
+# How many recipients a campaign reaches, read from the maintained per-category counter rather
+# than by counting the category's recipients, plus dispatch progress once sending has started
+@api_bp.route('/api/campaigns/<name>/audience', methods=['GET'])
+def campaign_audience(name):
+    row = get_storage().campaign_audience(name)
+    if row is None:
+        return jsonify({'error': 'Campaign not found'}), 404
 
-    return jsonify(serialized_campaigns), 200
+    recipient_count = row.recipient_count or 0
+    summary = {
+        'campaign': row.name,
+        'recipient_category': row.recipient_category,
+        'status': row.status,
+        'send_time': row.send_time.isoformat(),
+        'recipient_count': recipient_count,
+        'sent_count': row.sent_count or 0,
+        'failed_count': row.failed_count or 0,
+    }
+    summary['remaining_count'] = max(recipient_count - summary['sent_count'] - summary['failed_count'], 0)
+    return jsonify(summary), 200
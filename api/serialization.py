@@ -0,0 +1,54 @@
+import json
+from datetime import date, datetime
+
+from flask import Response, request
+from sqlalchemy import inspect
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is in requirements.txt; the stdlib encoder is the fallback
+    orjson = None
+
+
+def _default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+# orjson encodes naive datetimes natively in the same form as datetime.isoformat(), so bodies
+# match what Model.serialize() produced
+if orjson is not None:
+    def dumps(value):
+        return orjson.dumps(value)
+else:
+    def dumps(value):
+        return json.dumps(value, default=_default, separators=(',', ':')).encode('utf-8')
+
+
+def json_response(value, status=200):
+    return Response(dumps(value), status=status, mimetype='application/json')
+
+
+# The columns each model exposes, in the order Model.serialize() returns them; computed
+# column_property fields such as RecipientList.recipient_count follow the table columns
+def model_fields(model):
+    return {attr.key: getattr(model, attr.key) for attr in inspect(model).column_attrs}
+
+
+# The fields requested with ?fields=a,b (all of them by default). Raises ValueError on unknown names.
+def requested_fields(model):
+    fields = model_fields(model)
+    value = request.args.get('fields')
+    if not value:
+        return fields
+    names = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = [name for name in names if name not in fields]
+    if unknown:
+        raise ValueError(f'Unknown field(s): {", ".join(unknown)}. Available fields: {", ".join(fields)}.')
+    return {name: fields[name] for name in names}
+
+
+# Plain result rows (tuples) into the dicts that get encoded; no ORM object is ever hydrated
+def rows_to_dicts(names, rows):
+    return [dict(zip(names, row)) for row in rows]
@@ -0,0 +1,232 @@
+import heapq
+import logging
+from collections import defaultdict
+from contextlib import ExitStack
+from itertools import islice
+from operator import itemgetter
+
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError
+
+from api.group_commit import WriteConflict
+from api.serialization import model_fields
+from api.storage import (UPDATE_RECIPIENTS, AudienceRow, SqlStorage, audience_statement, recipient_updates,
+                         rows_statement)
+from db import db, search
+from db.models import Campaign, CampaignDispatch, Recipient, RecipientList
+from db.shards import RecipientShards
+from db.versions import read_versions
+
+logger = logging.getLogger(__name__)
+
+
+def _read(engine, statement):
+    with engine.connect() as conn:
+        return conn.execute(statement).all()
+
+
+# SqlStorage with recipients in RecipientShards (db/shards.py): one SQLite file per hash bucket
+# of recipient_category, each with its own writer lock, counters and search index. Every other
+# table stays in the main database. Reads filtered on a category go to its one shard; other
+# recipient reads query every shard and merge the results on id (or on the search ranking), so
+# paging works as on a single table.
+#
+# Differences from SqlStorage:
+#   - recipient writes commit per shard as they are made instead of on commit(), and skip the
+#     group-commit writer, since the shard's writer lock is what keeps them apart
+#   - email uniqueness across shards comes from the email registry (db/shards.py), itself
+#     split by hash of the email: an insert registers its emails first, committed, and then
+#     writes the rows, unregistering the emails again if that fails
+#   - search ranks each shard's matches by that shard's own bm25 statistics before merging
+class ShardedStorage(SqlStorage):
+    def __init__(self, engine, shards):
+        super().__init__(engine)
+        self.shards = shards
+
+    @classmethod
+    def open(cls, engine, directory, count):
+        shards = RecipientShards(directory, count)
+        moved = shards.absorb(engine)
+        if moved:
+            logger.info("Moved %d recipients from the main database into %d shards in %s", moved, count, directory)
+        return cls(engine, shards)
+
+    # A category filter names the one shard to read; anything else spans them all
+    def _engines(self, filters):
+        if 'recipient_category' in filters:
+            return [self.shards.engine_for(filters['recipient_category'])]
+        return self.shards.engines
+
+    # recipient_count is a subquery on the main database's (empty) counters; fill it in from the
+    # shards. fetch(selected) reads the lists with the category selected as well.
+    def _with_recipient_counts(self, names, fetch):
+        selected = names if 'recipient_category' in names else names + ['recipient_category']
+        category_position, count_position = selected.index('recipient_category'), names.index('recipient_count')
+        counts = self.shards.category_counts()
+        return [tuple(counts.get(row[category_position], 0) if position == count_position else value
+                      for position, value in enumerate(row[:len(names)])) for row in fetch(selected)]
+
+    def has_rows(self, model, filters):
+        if model is not Recipient:
+            return super().has_rows(model, filters)
+        statement = rows_statement(model, ['id'], filters).limit(1)
+        return any(_read(engine, statement) for engine in self._engines(filters))
+
+    def select_rows(self, model, names, filters, after_id=None, limit=None):
+        if model is RecipientList and 'recipient_count' in names:
+            return self._with_recipient_counts(
+                names, lambda selected: SqlStorage.select_rows(self, model, selected, filters, after_id, limit))
+        if model is not Recipient:
+            return super().select_rows(model, names, filters, after_id, limit)
+        statement = rows_statement(model, names, filters, after_id)
+        if limit is not None:
+            statement = statement.limit(limit)
+        engines = self._engines(filters)
+        if len(engines) == 1:
+            return _read(engines[0], statement)
+        # Each shard returns its first rows after the cursor; the page is the lowest ids among them
+        merged = heapq.merge(*(_read(engine, statement) for engine in engines), key=itemgetter(names.index('id')))
+        return list(islice(merged, limit))
+
+    def stream_rows(self, model, names, filters, chunk_size):
+        if model is RecipientList and 'recipient_count' in names:
+            # One row per category: read at once, so the counts come from one pass over the shards
+            return iter([self.select_rows(model, names, filters)])
+        if model is not Recipient:
+            return super().stream_rows(model, names, filters, chunk_size)
+        statement = rows_statement(model, names, filters).execution_options(yield_per=chunk_size)
+        return self._merged_partitions(self._engines(filters), statement, names.index('id'), chunk_size)
+
+    # One server-side cursor per shard, merged on id and cut into lists of chunk_size rows. The
+    # connections are opened on the first chunk and closed when the stream ends or is abandoned.
+    @staticmethod
+    def _merged_partitions(engines, statement, id_position, chunk_size):
+        with ExitStack() as stack:
+            results = [stack.enter_context(engine.connect()).execute(statement) for engine in engines]
+            merged = heapq.merge(*results, key=itemgetter(id_position))
+            while True:
+                rows = list(islice(merged, chunk_size))
+                if not rows:
+                    return
+                yield rows
+
+    # Every shard's best offset + limit matches, merged on the ORDER BY terms of search_statement
+    def search_rows(self, q, names, offset, limit):
+        fields = model_fields(Recipient)
+        engines = self.shards.engines
+        statement = search.search_statement(engines[0].dialect, q, [fields[name] for name in names], sort_key=True) \
+            .limit(offset + limit)
+        width = len(names)
+        ranked = heapq.merge(*(_read(engine, statement) for engine in engines), key=lambda row: tuple(row[width:]))
+        return [tuple(row[:width]) for row in islice(ranked, offset, offset + limit)]
+
+    def exists(self, model, **key):
+        if model is not Recipient:
+            return super().exists(model, **key)
+        if set(key) == {'email'}:
+            return key['email'] in self.shards.registered([key['email']])
+        statement = select(Recipient.id).filter_by(**key).limit(1)
+        return any(_read(engine, statement) for engine in self._engines(key))
+
+    def insert(self, model, values):
+        if model is RecipientList:
+            created = super().insert(model, values)
+            created['recipient_count'] = self.shards.recipient_count(created['recipient_category'])
+            return created
+        if model is not Recipient:
+            return super().insert(model, values)
+        index = self.shards.index_for(values['recipient_category'])
+        engine = self.shards.engines[index]
+        with engine.begin() as conn:
+            recipient = Recipient(id=self.shards.allocate_ids(conn, index, 1), **values)
+        row = recipient.serialize()
+        try:
+            self.shards.register([row])
+        except IntegrityError as exc:
+            raise WriteConflict(str(exc.orig))
+        try:
+            with engine.begin() as conn:
+                conn.execute(insert(Recipient), [row])
+        except IntegrityError as exc:
+            self.shards.unregister([row['email']])
+            raise WriteConflict(str(exc.orig))
+        except Exception:
+            self.shards.unregister([row['email']])
+            raise
+        return row
+
+    # The recipients counter is kept per shard; their sum grows with every write to any of them
+    def data_versions(self, resources):
+        versions = read_versions(db.session, resources)
+        if 'recipients' in versions:
+            for engine in self.shards.engines:
+                with engine.connect() as conn:
+                    versions['recipients'] += read_versions(conn, ['recipients'])['recipients']
+        return tuple(versions[resource] for resource in resources)
+
+    def recipient_rows(self, recipient_category, limit, after_id=0):
+        return _read(self.shards.engine_for(recipient_category),
+                     audience_statement(recipient_category, limit, after_id))
+
+    def campaign_audience(self, name):
+        row = db.session.execute(
+            select(Campaign.name, Campaign.recipient_category, Campaign.status, Campaign.send_time,
+                   CampaignDispatch.sent_count, CampaignDispatch.failed_count)
+            .outerjoin(CampaignDispatch, CampaignDispatch.campaign_id == Campaign.id)
+            .where(Campaign.name == name)
+        ).first()
+        if row is None:
+            return None
+        return AudienceRow(row.name, row.recipient_category, row.status, row.send_time,
+                           self.shards.recipient_count(row.recipient_category), row.sent_count, row.failed_count)
+
+    def existing_emails(self, emails):
+        return set(self.shards.registered(emails))
+
+    # Ids reserved per shard in one step and every email registered before any row is written,
+    # so a duplicate email writes nothing; the emails of a shard whose write fails are unregistered
+    def insert_recipients(self, rows):
+        by_shard = defaultdict(list)
+        for row in rows:
+            by_shard[self.shards.index_for(row['recipient_category'])].append(row)
+        values = {}
+        for index, shard_rows in by_shard.items():
+            with self.shards.engines[index].begin() as conn:
+                first = self.shards.allocate_ids(conn, index, len(shard_rows))
+            values[index] = [{**row, 'id': first + position * self.shards.count}
+                             for position, row in enumerate(shard_rows)]
+        self.shards.register([row for shard_values in values.values() for row in shard_values])
+        pending = dict(values)
+        try:
+            for index, shard_values in values.items():
+                with self.shards.engines[index].begin() as conn:
+                    conn.execute(insert(Recipient), shard_values)
+                del pending[index]
+        finally:
+            if pending:
+                self.shards.unregister([row['email'] for shard_values in pending.values() for row in shard_values])
+
+    # A recipient whose category moves to another shard is written there, with its id, before it
+    # is deleted from the old one, so a failure in between leaves a duplicate rather than a loss
+    def update_recipients(self, rows):
+        by_email = {row['email']: row for row in rows}
+        statement = select(Recipient.id, Recipient.email).where(Recipient.email.in_(by_email))
+        updates, moves_in, moves_out = defaultdict(list), defaultdict(list), defaultdict(list)
+        for index, engine in enumerate(self.shards.engines):
+            for recipient_id, email in _read(engine, statement):
+                row = by_email[email]
+                target = self.shards.index_for(row['recipient_category'])
+                if target == index:
+                    updates[index].append(row)
+                else:
+                    moves_in[target].append({**row, 'id': recipient_id})
+                    moves_out[index].append(email)
+        for index in updates.keys() | moves_in.keys():
+            with self.shards.engines[index].begin() as conn:
+                if updates[index]:
+                    conn.execute(UPDATE_RECIPIENTS, recipient_updates(updates[index]))
+                if moves_in[index]:
+                    conn.execute(insert(Recipient), moves_in[index])
+        for index, emails in moves_out.items():
+            with self.shards.engines[index].begin() as conn:
+                conn.execute(Recipient.__table__.delete().where(Recipient.email.in_(emails)))
@@ -0,0 +1,252 @@
+import logging
+import os
+import threading
+from collections import namedtuple
+
+from flask import current_app
+from sqlalchemy import bindparam, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+from api.campaign_changes import CampaignLookup, apply_changes, serialize_result
+from api.group_commit import WriteConflict, insert_row
+from api.serialization import model_fields, rows_to_dicts
+from db import db, search
+from db.versions import read_versions
+from db.shards import DEFAULT_SHARD_COUNT, default_shard_dir
+from db.models import (Campaign, CampaignChange, CampaignDispatch, EmailTemplate, Recipient, RecipientCategoryCount,
+                       RecipientList)
+from dispatch.templating import RECIPIENT_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+STORAGE_BACKENDS = ('sql', 'memory', 'sharded')
+
+CHANGE_FIELDS = model_fields(CampaignChange)
+
+AudienceRow = namedtuple('AudienceRow', ['name', 'recipient_category', 'status', 'send_time',
+                                         'recipient_count', 'sent_count', 'failed_count'])
+
+# Bulk upsert: the name and category of the stored recipient with each email
+UPDATE_RECIPIENTS = update(Recipient.__table__).where(Recipient.__table__.c.email == bindparam('b_email'))
+
+
+def recipient_updates(rows):
+    return [{'b_email': row['email'], 'name': row['name'], 'recipient_category': row['recipient_category']}
+            for row in rows]
+
+
+# The statements SqlStorage runs are built by the functions below, which db/query_plan_check.py
+# explains to make sure none of them falls back to a table scan.
+
+# A category's recipients laid out as RECIPIENT_COLUMNS, in id order after after_id
+def audience_statement(recipient_category, limit, after_id=0):
+    return select(*RECIPIENT_COLUMNS) \
+        .where(Recipient.recipient_category == recipient_category, Recipient.id > after_id) \
+        .order_by(Recipient.id) \
+        .limit(limit)
+
+
+# Rows laid out as the given field names, in id order after after_id; filters are column=value equalities
+def rows_statement(model, names, filters, after_id=None):
+    fields = model_fields(model)
+    criteria = [getattr(model, name) == value for name, value in filters.items()]
+    if after_id is not None:
+        criteria.append(model.id > after_id)
+    return select(*(fields[name] for name in names)).where(*criteria).order_by(model.id)
+
+
+def exists_statement(model, key):
+    return select(model.id).filter_by(**key).limit(1)
+
+
+def named_statement(model, name):
+    return select(model).filter_by(name=name).limit(1)
+
+
+def search_rows_statement(dialect, q, names, offset, limit):
+    fields = model_fields(Recipient)
+    return search.search_statement(dialect, q, [fields[name] for name in names]).offset(offset).limit(limit)
+
+
+def campaign_audience_statement(name):
+    return select(Campaign.name, Campaign.recipient_category, Campaign.status, Campaign.send_time,
+                  RecipientCategoryCount.recipient_count, CampaignDispatch.sent_count, CampaignDispatch.failed_count) \
+        .outerjoin(RecipientCategoryCount, RecipientCategoryCount.recipient_category == Campaign.recipient_category) \
+        .outerjoin(CampaignDispatch, CampaignDispatch.campaign_id == Campaign.id) \
+        .where(Campaign.name == name)
+
+
+def existing_categories_statement(categories):
+    return select(RecipientList.recipient_category).where(RecipientList.recipient_category.in_(categories))
+
+
+def existing_emails_statement(emails):
+    return select(Recipient.email).where(Recipient.email.in_(emails))
+
+
+def changes_statement(since, limit):
+    return select(*CHANGE_FIELDS.values()).where(CampaignChange.seq > since).order_by(CampaignChange.seq).limit(limit)
+
+
+# Everything the routes read and write goes through one backend with these methods and the same
+# semantics (409 on duplicates, 404 on missing references, cancel instead of delete): SqlStorage,
+# the database through SQLAlchemy; MemoryStorage (api/memory_storage.py), plain Python records
+# and indexes for load tests that need no durability; and ShardedStorage
+# (api/sharded_storage.py), SqlStorage with recipients split over per-category SQLite files.
+# Rows are tuples laid out as the requested field names; filters are column=value equalities.
+class SqlStorage:
+    def __init__(self, engine):
+        self.engine = engine
+
+    def has_rows(self, model, filters):
+        return db.session.execute(exists_statement(model, filters)).first() is not None
+
+    # Rows in id order after after_id; every row when limit is None
+    def select_rows(self, model, names, filters, after_id=None, limit=None):
+        statement = rows_statement(model, names, filters, after_id)
+        if limit is not None:
+            statement = statement.limit(limit)
+        return db.session.execute(statement).all()
+
+    # Lists of rows read from a server-side cursor, chunk_size at a time
+    def stream_rows(self, model, names, filters, chunk_size):
+        statement = rows_statement(model, names, filters).execution_options(yield_per=chunk_size)
+        return db.session.execute(statement).partitions()
+
+    def search_rows(self, q, names, offset, limit):
+        return db.session.execute(search_rows_statement(self.engine.dialect, q, names, offset, limit)).all()
+
+    def exists(self, model, **key):
+        return db.session.execute(exists_statement(model, key)).first() is not None
+
+    # Insert one row and return its serialize() dict; a unique-constraint violation raises WriteConflict
+    def insert(self, model, values):
+        return insert_row(model(**values))
+
+    # Validate and apply (op, name, data) campaign changes in one transaction; returns one
+    # (serialized campaign, error) pair per change. Raises WriteConflict when a concurrent
+    # writer took a name between the lookup and the commit.
+    def apply_campaign_changes(self, changes):
+        outcomes = apply_changes(changes, CampaignLookup(changes))
+        if len(changes) == 1 and changes[0][0] == 'create' and outcomes[0][2] is None:
+            # A single new campaign is inserted like the other POSTs, through the group-commit writer if enabled
+            campaign = outcomes[0][0]
+            db.session.expunge(campaign)
+            return [(insert_row(campaign), None)]
+        try:
+            # Flush before serializing so ids and timestamps are populated without a reload per row
+            db.session.flush()
+            results = [(serialize_result(campaign, snapshot) if error is None else None, error)
+                       for campaign, snapshot, error in outcomes]
+            db.session.commit()
+        except IntegrityError as exc:
+            db.session.rollback()
+            raise WriteConflict(str(exc.orig))
+        return results
+
+    def cancel_campaign(self, name):
+        campaign = self.campaign(name)
+        if not campaign:
+            return False
+        campaign.status = "Cancelled"
+        db.session.commit()
+        return True
+
+    def campaign(self, name):
+        return db.session.execute(named_statement(Campaign, name)).scalar()
+
+    def email_template(self, name):
+        return db.session.execute(named_statement(EmailTemplate, name)).scalar()
+
+    # Recipients of a category laid out as RECIPIENT_COLUMNS, for previews and the dispatcher
+    def recipient_rows(self, recipient_category, limit, after_id=0):
+        return db.session.execute(audience_statement(recipient_category, limit, after_id)).all()
+
+    def campaign_audience(self, name):
+        return db.session.execute(campaign_audience_statement(name)).first()
+
+    # Bulk import: which of the given categories and emails exist, then batched writes
+    def existing_categories(self, categories):
+        return set(db.session.execute(existing_categories_statement(categories)).scalars())
+
+    def existing_emails(self, emails):
+        return set(db.session.execute(existing_emails_statement(emails)).scalars())
+
+    def insert_recipients(self, rows):
+        db.session.execute(insert(Recipient), rows)
+
+    def update_recipients(self, rows):
+        db.session.execute(UPDATE_RECIPIENTS, recipient_updates(rows))
+
+    def commit(self):
+        db.session.commit()
+
+    def rollback(self):
+        db.session.rollback()
+
+    # Ends the request's read transaction, so a request about to wait holds no connection
+    def release(self):
+        db.session.rollback()
+
+    # The write counters of the given tables, in order, for cache keys and ETags
+    def data_versions(self, resources):
+        versions = read_versions(db.session, resources)
+        return tuple(versions[resource] for resource in resources)
+
+    # Campaign change log: (oldest seq, newest seq), and the entries after since
+    def change_bounds(self):
+        return db.session.execute(select(func.min(CampaignChange.seq), func.max(CampaignChange.seq))).one()
+
+    def read_changes(self, since, limit):
+        rows = db.session.execute(changes_statement(since, limit)).all()
+        return rows_to_dicts(list(CHANGE_FIELDS), rows)
+
+    # The newest seq, read on a connection of its own; called from the change watcher's thread
+    def change_head(self):
+        with self.engine.connect() as conn:
+            return conn.execute(select(func.max(CampaignChange.seq))).scalar()
+
+
+def configure_storage(app):
+    app.config.setdefault('STORAGE', os.environ.get('STORAGE', 'sql'))
+    app.config.setdefault('MEMORY_SNAPSHOT', os.environ.get('MEMORY_SNAPSHOT'))
+    app.config.setdefault('RECIPIENT_SHARDS', int(os.environ.get('RECIPIENT_SHARDS', DEFAULT_SHARD_COUNT)))
+    app.config.setdefault('SHARD_DIR', os.environ.get('SHARD_DIR') or
+                          default_shard_dir(app.config['SQLALCHEMY_DATABASE_URI']))
+    if app.config['STORAGE'] not in STORAGE_BACKENDS:
+        raise ValueError(f'STORAGE must be one of: {", ".join(STORAGE_BACKENDS)}')
+    if app.config['STORAGE'] == 'sharded' and not app.config['SHARD_DIR']:
+        raise ValueError('SHARD_DIR is required with STORAGE=sharded when the database is not a SQLite file')
+
+
+_storage_lock = threading.Lock()
+
+
+def _create_storage(app):
+    if app.config['STORAGE'] == 'memory':
+        from api.memory_storage import MemoryStorage
+        return MemoryStorage.load(db.engine, app.config['MEMORY_SNAPSHOT'])
+    if app.config['STORAGE'] == 'sharded':
+        from api.sharded_storage import ShardedStorage
+        return ShardedStorage.open(db.engine, app.config['SHARD_DIR'], app.config['RECIPIENT_SHARDS'])
+    return SqlStorage(db.engine)
+
+
+# The app's storage backend, created on first use: the in-memory backend loads every table then
+def get_storage():
+    app = current_app._get_current_object()
+    storage = app.extensions.get('storage')
+    if storage is None:
+        with _storage_lock:
+            storage = app.extensions.get('storage')
+            if storage is None:
+                storage = app.extensions['storage'] = _create_storage(app)
+    return storage
+
+
+# Where the dispatcher reads audiences: the app's storage, except that the in-memory backend
+# only exists inside the API process, so the dispatcher reads the database instead
+def audience_storage():
+    if current_app.config['STORAGE'] == 'memory':
+        return SqlStorage(db.engine)
+    return get_storage()
@@ -0,0 +1,379 @@
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlparse
+
+import psutil
+
+from db.generator import FIRST_NAMES, LAST_NAMES, Scale, campaign_name, category_name, template_name
+
+# Relative weight of every route exercised by default; override with --mix name=weight,...
+DEFAULT_MIX = {
+    'list_recipients': 10,
+    'list_recipient_lists': 5,
+    'list_email_templates': 5,
+    'list_campaigns': 10,
+    'recipients_by_category': 15,
+    'campaigns_by_status': 15,
+    'create_recipient': 10,
+    'create_campaign': 10,
+    'put_campaign': 8,
+    'patch_campaign': 8,
+    'cancel_campaign': 4,
+    'search_recipients': 8,
+    'batch_campaigns': 3,
+    'campaign_changes': 4,
+    'bulk_import_recipients': 2,
+    'preview_campaign': 5,
+    'campaign_audience': 5,
+}
+
+PAGE_SIZE = 100
+# Changes per POST /api/campaigns/batch and rows per POST /api/recipients/bulk
+BATCH_SIZE = 10
+BULK_IMPORT_ROWS = 50
+STATUSES = ['Scheduled', 'Cancelled', 'Sending', 'Sent']
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+
+
+# Builds the (method, path, body) of one request for each route in the mix; the body is sent
+# as JSON, except bytes, which are sent as NDJSON
+class Workload:
+    def __init__(self, scale, worker_id, seed):
+        self.scale = scale
+        self.worker_id = worker_id
+        self.rng = random.Random(seed * 1000 + worker_id)
+        self.sequence = 0
+
+    def _category(self):
+        return category_name(self.rng.randrange(self.scale.categories))
+
+    def _template(self):
+        return template_name(self.rng.randrange(self.scale.templates))
+
+    def _campaign(self):
+        return campaign_name(self.rng.randrange(self.scale.campaigns))
+
+    def _future_time(self):
+        return (datetime.utcnow() + timedelta(days=self.rng.randint(1, 30))).isoformat()
+
+    def _unique(self, prefix):
+        self.sequence += 1
+        return f'{prefix}_{self.worker_id}_{self.sequence}_{os.getpid()}'
+
+    def _search_term(self):
+        if self.rng.random() < 0.5:
+            return self.rng.choice(LAST_NAMES).lower()
+        # Short prefixes take the email-prefix path instead of the trigram index
+        return self.rng.choice(FIRST_NAMES).lower()[:2]
+
+    def _new_campaign(self):
+        return {'name': self._unique('bench'), 'send_time': self._future_time(),
+                'recipient_category': self._category(), 'template_name': self._template(),
+                'campaign_template': 'Hello {{name}}'}
+
+    def _batch(self):
+        changes = [{'op': 'patch', 'name': self._campaign(), 'data': {'campaign_template': 'Batched {{name}}'}}
+                   for _ in range(BATCH_SIZE - 1)]
+        changes.append({'op': 'create', 'data': self._new_campaign()})
+        return changes
+
+    def _bulk_rows(self):
+        return b''.join(json.dumps({'email': self._unique('bulk') + '@example.com', 'name': 'Bench',
+                                    'recipient_category': self._category()}).encode('utf-8') + b'\n'
+                        for _ in range(BULK_IMPORT_ROWS))
+
+    def build(self, route):
+        if route == 'list_recipients':
+            return 'GET', f'/api/recipients?limit={PAGE_SIZE}&after_id={self.rng.randrange(self.scale.recipients)}', None
+        if route == 'list_recipient_lists':
+            return 'GET', '/api/recipient_lists', None
+        if route == 'list_email_templates':
+            return 'GET', '/api/email_templates', None
+        if route == 'list_campaigns':
+            return 'GET', f'/api/campaigns?limit={PAGE_SIZE}&after_id={self.rng.randrange(self.scale.campaigns)}', None
+        if route == 'recipients_by_category':
+            return 'GET', f'/api/recipients/{self._category()}?limit={PAGE_SIZE}', None
+        if route == 'campaigns_by_status':
+            return 'GET', f'/api/campaigns/{self.rng.choice(STATUSES)}?limit={PAGE_SIZE}', None
+        if route == 'create_recipient':
+            return 'POST', '/api/recipients', {'email': self._unique('bench') + '@example.com', 'name': 'Bench',
+                                               'recipient_category': self._category()}
+        if route == 'create_campaign':
+            return 'POST', '/api/campaigns', self._new_campaign()
+        if route == 'put_campaign':
+            return 'PUT', f'/api/campaigns/{self._campaign()}', {'send_time': self._future_time(),
+                                                                 'campaign_template': 'Updated {{name}}',
+                                                                 'recipient_category': self._category(),
+                                                                 'template_name': self._template()}
+        if route == 'patch_campaign':
+            return 'PATCH', f'/api/campaigns/{self._campaign()}', {'campaign_template': 'Patched {{email}}'}
+        if route == 'cancel_campaign':
+            return 'DELETE', f'/api/campaigns/delete?name={self._campaign()}', None
+        if route == 'search_recipients':
+            return 'GET', f'/api/recipients/search?q={self._search_term()}&limit={PAGE_SIZE}', None
+        if route == 'batch_campaigns':
+            return 'POST', '/api/campaigns/batch', self._batch()
+        if route == 'campaign_changes':
+            # wait=0 answers at once instead of long-polling for the next change
+            return 'GET', f'/api/campaigns/changes?since=0&wait=0&limit={PAGE_SIZE}', None
+        if route == 'bulk_import_recipients':
+            return 'POST', '/api/recipients/bulk', self._bulk_rows()
+        if route == 'preview_campaign':
+            return 'GET', f'/api/campaigns/{self._campaign()}/preview?limit=10', None
+        if route == 'campaign_audience':
+            return 'GET', f'/api/campaigns/{self._campaign()}/audience', None
+        raise ValueError(f'Unknown route {route!r}')
+
+
+class InProcessClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body):
+        if isinstance(body, bytes):
+            response = self.client.open(path, method=method, data=body, content_type=NDJSON_CONTENT_TYPE)
+        else:
+            response = self.client.open(path, method=method, json=body)
+        response.close()
+        return response.status_code
+
+
+class HttpClient:
+    def __init__(self, base_url):
+        parsed = urlparse(base_url)
+        self.connection = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=60)
+
+    def request(self, method, path, body):
+        headers = {}
+        payload = None
+        if isinstance(body, bytes):
+            payload = body
+            headers['Content-Type'] = NDJSON_CONTENT_TYPE
+        elif body is not None:
+            payload = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        self.connection.request(method, path, body=payload, headers=headers)
+        response = self.connection.getresponse()
+        response.read()
+        return response.status
+
+
+class RouteStats:
+    def __init__(self):
+        self.latencies = []
+        self.status_codes = {}
+        self.errors = 0
+
+    def record(self, latency, status):
+        self.latencies.append(latency)
+        self.status_codes[status] = self.status_codes.get(status, 0) + 1
+        if status >= 500:
+            self.errors += 1
+
+    def merge(self, other):
+        self.latencies.extend(other.latencies)
+        self.errors += other.errors
+        for status, count in other.status_codes.items():
+            self.status_codes[status] = self.status_codes.get(status, 0) + count
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(stats, elapsed):
+    latencies = sorted(stats.latencies)
+    to_ms = lambda value: round(value * 1000, 3) if value is not None else None
+    return {
+        'requests': len(latencies),
+        'errors': stats.errors,
+        'status_codes': {str(status): count for status, count in sorted(stats.status_codes.items())},
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'mean_ms': to_ms(sum(latencies) / len(latencies)) if latencies else None,
+        'p50_ms': to_ms(percentile(latencies, 0.50)),
+        'p95_ms': to_ms(percentile(latencies, 0.95)),
+        'p99_ms': to_ms(percentile(latencies, 0.99)),
+        'max_ms': to_ms(latencies[-1]) if latencies else None,
+    }
+
+
+class RssSampler(threading.Thread):
+    def __init__(self, pid, interval=0.05):
+        super().__init__(daemon=True)
+        self.process = psutil.Process(pid)
+        self.interval = interval
+        self.peak = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.peak = max(self.peak, self.process.memory_info().rss)
+            except psutil.Error:
+                return
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def parse_mix(value):
+    if not value:
+        return dict(DEFAULT_MIX)
+    mix = {}
+    for item in value.split(','):
+        name, _, weight = item.partition('=')
+        if name not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f'unknown route {name!r}; choose from {", ".join(DEFAULT_MIX)}')
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def run_workers(make_client, scale, mix, concurrency, duration, warmup, seed):
+    routes = list(mix)
+    weights = [mix[route] for route in routes]
+    per_worker = [dict() for _ in range(concurrency)]
+    start_barrier = threading.Barrier(concurrency + 1)
+    timing = {}
+
+    def worker(worker_id):
+        client = make_client()
+        workload = Workload(scale, worker_id, seed)
+        results = per_worker[worker_id]
+        start_barrier.wait()
+        warmup_end = timing['start'] + warmup
+        deadline = warmup_end + duration
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                return
+            route = workload.rng.choices(routes, weights)[0]
+            method, path, body = workload.build(route)
+            started = time.perf_counter()
+            try:
+                status = client.request(method, path, body)
+            except Exception:
+                status = 599
+            finished = time.perf_counter()
+            if started >= warmup_end:
+                results.setdefault(route, RouteStats()).record(finished - started, status)
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    timing['start'] = time.perf_counter()
+    start_barrier.wait()
+    for thread in threads:
+        thread.join()
+
+    merged = {}
+    for results in per_worker:
+        for route, stats in results.items():
+            merged.setdefault(route, RouteStats()).merge(stats)
+    return merged
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def seed_database(database_url, scale):
+    from sqlalchemy import create_engine
+    from db import db
+    from db.config import install_sqlite_pragmas
+    from db.generator import generate
+
+    engine = create_engine(database_url)
+    install_sqlite_pragmas(engine)
+    db.metadata.create_all(engine)
+    generate(engine, scale)
+    engine.dispose()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench',
+                                     description='Drive every API route and report latency, throughput and RSS.')
+    parser.add_argument('--recipients', type=int, default=10000)
+    parser.add_argument('--campaigns', type=int, default=1000)
+    parser.add_argument('--categories', type=int, default=20)
+    parser.add_argument('--templates', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10.0, help='Measured seconds, after the warm-up')
+    parser.add_argument('--warmup', type=float, default=1.0)
+    parser.add_argument('--mix', type=parse_mix, default=None,
+                        help='Comma-separated route=weight pairs, e.g. list_campaigns=5,create_campaign=1')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--url', help='Benchmark a running server (seeded with the same --scale arguments) '
+                                      'instead of an in-process app on a fresh temporary database')
+    parser.add_argument('--server-pid', type=int, help='Process to sample for peak RSS when using --url')
+    parser.add_argument('--output', help='Write the JSON report to this file as well as stdout')
+    args = parser.parse_args(argv)
+
+    scale = Scale(args.recipients, args.categories, args.templates, args.campaigns, args.seed)
+    mix = args.mix or dict(DEFAULT_MIX)
+    tmp = None
+
+    if args.url:
+        make_client = lambda: HttpClient(args.url)
+        sampled_pid = args.server_pid or os.getpid()
+    else:
+        tmp = tempfile.TemporaryDirectory()
+        database_url = 'sqlite:///' + os.path.join(tmp.name, 'bench.db')
+        seed_started = time.perf_counter()
+        seed_database(database_url, scale)
+        print(f'Seeded in {time.perf_counter() - seed_started:.1f}s', file=sys.stderr)
+        # The app reads DATABASE_URL when it is first imported
+        os.environ['DATABASE_URL'] = database_url
+        from api.app import app
+        make_client = lambda: InProcessClient(app)
+        sampled_pid = os.getpid()
+
+    sampler = RssSampler(sampled_pid)
+    sampler.start()
+    try:
+        merged = run_workers(make_client, scale, mix, args.concurrency, args.duration, args.warmup, args.seed)
+    finally:
+        sampler.stop()
+        if tmp is not None:
+            tmp.cleanup()
+
+    total = RouteStats()
+    for stats in merged.values():
+        total.merge(stats)
+    report = {
+        'commit': git_commit(),
+        'target': args.url or 'in-process',
+        'scale': scale._asdict(),
+        'concurrency': args.concurrency,
+        'duration_seconds': args.duration,
+        'mix': mix,
+        'total': summarize(total, args.duration),
+        'routes': {route: summarize(merged[route], args.duration) for route in sorted(merged)},
+        'peak_rss_bytes': sampler.peak,
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as handle:
+            handle.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+import threading
+import time
+
+from bench.__main__ import InProcessClient, RouteStats, seed_database, summarize
+from db.generator import Scale, category_name
+
+SCALE = Scale(recipients=10000, categories=20, templates=5, campaigns=10)
+
+
+# One configuration in a fresh process and database: the app reads its settings from the
+# environment at import, as it does under gunicorn or uvicorn
+def _run(settings, concurrency, duration, duplicate_ratio, results):
+    with tempfile.TemporaryDirectory() as tmp:
+        database_url = 'sqlite:///' + os.path.join(tmp, 'group_commit.db')
+        os.environ.update(DATABASE_URL=database_url, SQLITE_SYNCHRONOUS=settings['synchronous'],
+                          GROUP_COMMIT='1' if settings['group_commit'] else '0')
+        seed_database(database_url, SCALE)
+        from api.app import app
+
+        per_worker = [RouteStats() for _ in range(concurrency)]
+        deadline = time.perf_counter() + duration
+
+        def worker(worker_id):
+            client = InProcessClient(app)
+            rng = random.Random(worker_id)
+            sent = []
+            stats = per_worker[worker_id]
+            while time.perf_counter() < deadline:
+                # Some signups repeat an email already taken, to exercise per-request 409s in a batch
+                if sent and rng.random() < duplicate_ratio:
+                    email = rng.choice(sent)
+                else:
+                    email = f'signup_{worker_id}_{len(sent)}@example.com'
+                    sent.append(email)
+                body = {'email': email, 'name': 'Signup', 'recipient_category': category_name(rng.randrange(20))}
+                started = time.perf_counter()
+                status = client.request('POST', '/api/recipients', body)
+                stats.record(time.perf_counter() - started, status)
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        merged = RouteStats()
+        for stats in per_worker:
+            merged.merge(stats)
+        report = summarize(merged, elapsed)
+        report['writes_per_second'] = round(merged.status_codes.get(201, 0) / elapsed, 1)
+        writer = app.extensions.get('group_commit')
+        if writer is not None and writer.batches:
+            report['mean_batch_size'] = round(writer.writes / writer.batches, 1)
+        results.put(report)
+
+
+def run(settings, concurrency, duration, duplicate_ratio):
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=_run, args=(settings, concurrency, duration, duplicate_ratio, results))
+    process.start()
+    report = results.get()
+    process.join()
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='POST /api/recipients writes/sec per concurrency level, per-request commits vs group commit.')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 32])
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--duplicate-ratio', type=float, default=0.05)
+    parser.add_argument('--synchronous', nargs='+', default=['NORMAL', 'FULL'],
+                        help='SQLITE_SYNCHRONOUS values to compare; FULL fsyncs on every commit')
+    args = parser.parse_args(argv)
+
+    report = {'duration_seconds': args.duration, 'duplicate_ratio': args.duplicate_ratio, 'runs': []}
+    for synchronous in args.synchronous:
+        for concurrency in args.concurrency:
+            row = {'synchronous': synchronous, 'concurrency': concurrency}
+            for group_commit in (False, True):
+                result = run({'synchronous': synchronous, 'group_commit': group_commit},
+                             concurrency, args.duration, args.duplicate_ratio)
+                row['group_commit' if group_commit else 'per_request_commit'] = result
+            row['speedup'] = round(row['group_commit']['writes_per_second'] /
+                                   max(row['per_request_commit']['writes_per_second'], 0.1), 2)
+            report['runs'].append(row)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
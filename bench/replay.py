@@ -0,0 +1,209 @@
+import argparse
+import base64
+import http.client
+import json
+import sys
+import threading
+import time
+from urllib.parse import urlparse
+
+from bench.__main__ import RouteStats, git_commit, summarize
+
+# Statistics compared between the recording and the replay
+COMPARED = ('mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms')
+
+
+def load_recording(path):
+    entries = []
+    skipped = 0
+    with open(path, encoding='utf-8') as handle:
+        for line in handle:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if entry.get('body_truncated'):
+                skipped += 1
+                continue
+            entries.append(entry)
+    # Several workers append to the same file, each in its own flush order
+    entries.sort(key=lambda entry: entry['ts'])
+    return entries, skipped
+
+
+def route_key(entry):
+    return f"{entry['method']} {entry.get('rule') or entry['path']}"
+
+
+class ReplayClient:
+    def __init__(self, base_url):
+        parsed = urlparse(base_url)
+        self.host, self.port = parsed.hostname, parsed.port or 80
+        self.connection = None
+
+    def send(self, entry):
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(self.host, self.port, timeout=120)
+        path = entry['path'] + ('?' + entry['query'] if entry.get('query') else '')
+        if 'body_b64' in entry:
+            body = base64.b64decode(entry['body_b64'])
+        else:
+            body = entry.get('body', '').encode('utf-8') or None
+        headers = {name[5:].replace('_', '-') if name.startswith('HTTP_') else name.replace('_', '-'): value
+                   for name, value in entry.get('headers', {}).items()}
+        try:
+            self.connection.request(entry['method'], path, body=body, headers=headers)
+            response = self.connection.getresponse()
+            response.read()
+            return response.status
+        except (OSError, http.client.HTTPException):
+            # Start a fresh connection for the next request, as a client would after a reset
+            self.connection.close()
+            self.connection = None
+            return 599
+
+
+# Sends the recorded requests in order from a pool of client threads. At a finite speed each
+# request goes out at its recorded offset divided by speed; when every thread is busy the
+# request leaves late, and the lag is reported so an undersized pool is not mistaken for a
+# slow server. With speed=None requests go out back to back.
+def replay(entries, base_url, speed, concurrency):
+    results = [None] * len(entries)
+    lags = [0.0] * len(entries)
+    next_index = [0]
+    lock = threading.Lock()
+    origin = entries[0]['ts'] if entries else 0.0
+    timing = {}
+    start_barrier = threading.Barrier(concurrency + 1)
+
+    def worker():
+        client = ReplayClient(base_url)
+        start_barrier.wait()
+        while True:
+            with lock:
+                index = next_index[0]
+                if index >= len(entries):
+                    return
+                next_index[0] += 1
+            entry = entries[index]
+            if speed is not None:
+                scheduled = timing['start'] + (entry['ts'] - origin) / speed
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                lags[index] = max(0.0, time.perf_counter() - scheduled)
+            started = time.perf_counter()
+            status = client.send(entry)
+            results[index] = (time.perf_counter() - started, status)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    timing['start'] = time.perf_counter()
+    start_barrier.wait()
+    for thread in threads:
+        thread.join()
+    return results, lags, time.perf_counter() - timing['start']
+
+
+def _delta(recorded, replayed):
+    delta = {}
+    for name in COMPARED:
+        if recorded.get(name) is None or replayed.get(name) is None:
+            continue
+        delta[name] = round(replayed[name] - recorded[name], 3)
+        if recorded[name]:
+            delta[name.replace('_ms', '_ratio')] = round(replayed[name] / recorded[name], 3)
+    delta['errors'] = replayed['errors'] - recorded['errors']
+    return delta
+
+
+def compare(entries, results, recorded_elapsed, replayed_elapsed):
+    recorded, replayed, mismatches = {}, {}, {}
+    for entry, (latency, status) in zip(entries, results):
+        key = route_key(entry)
+        recorded.setdefault(key, RouteStats()).record(entry['duration_ms'] / 1000.0, entry['status'])
+        replayed.setdefault(key, RouteStats()).record(latency, status)
+        if status != entry['status']:
+            mismatches[key] = mismatches.get(key, 0) + 1
+
+    routes = {}
+    total_recorded, total_replayed = RouteStats(), RouteStats()
+    for key in sorted(recorded):
+        total_recorded.merge(recorded[key])
+        total_replayed.merge(replayed[key])
+        before = summarize(recorded[key], recorded_elapsed)
+        after = summarize(replayed[key], replayed_elapsed)
+        routes[key] = {'recorded': before, 'replayed': after, 'delta': _delta(before, after),
+                       'status_mismatches': mismatches.get(key, 0)}
+    before = summarize(total_recorded, recorded_elapsed)
+    after = summarize(total_replayed, replayed_elapsed)
+    total = {'recorded': before, 'replayed': after, 'delta': _delta(before, after),
+             'status_mismatches': sum(mismatches.values())}
+    return total, routes
+
+
+def parse_speed(value):
+    if value == 'max':
+        return None
+    speed = float(value.rstrip('x'))
+    if speed <= 0:
+        raise argparse.ArgumentTypeError('speed must be positive, e.g. 1, 10x or max')
+    return speed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m bench.replay',
+        description='Replay traffic recorded with RECORD_TRAFFIC=path against a running server and '
+                    'report latency and error deltas per route against the recording. For matching '
+                    'statuses, start the server from the database the recording started from '
+                    '(e.g. the seed snapshot); otherwise repeated creates come back as 409.')
+    parser.add_argument('recording', help='JSONL file written by the recording middleware')
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--speed', type=parse_speed, default=1.0,
+                        help='1 replays at the recorded pace, 10x ten times faster, max back to back')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--limit', type=int, help='Replay only the first N requests')
+    parser.add_argument('--output', help='Write the JSON report to this file as well as stdout')
+    args = parser.parse_args(argv)
+
+    entries, skipped = load_recording(args.recording)
+    if args.limit is not None:
+        entries = entries[:args.limit]
+    if not entries:
+        parser.error(f'{args.recording} holds no replayable requests')
+    print(f'Replaying {len(entries)} requests at '
+          f'{"max speed" if args.speed is None else f"{args.speed:g}x"}', file=sys.stderr)
+
+    results, lags, replayed_elapsed = replay(entries, args.url, args.speed, args.concurrency)
+    last = entries[-1]
+    recorded_elapsed = last['ts'] + last['duration_ms'] / 1000.0 - entries[0]['ts']
+    total, routes = compare(entries, results, recorded_elapsed, replayed_elapsed)
+    sorted_lags = sorted(lags)
+    report = {
+        'commit': git_commit(),
+        'target': args.url,
+        'recording': args.recording,
+        'speed': 'max' if args.speed is None else args.speed,
+        'concurrency': args.concurrency,
+        'requests': len(entries),
+        'skipped_truncated_bodies': skipped,
+        'recorded_seconds': round(recorded_elapsed, 3),
+        'replayed_seconds': round(replayed_elapsed, 3),
+        # How far behind schedule requests left; large values mean --concurrency is too low
+        'schedule_lag_ms': None if args.speed is None else {
+            'p99': round(sorted_lags[min(len(sorted_lags) - 1, int(len(sorted_lags) * 0.99))] * 1000, 3),
+            'max': round(sorted_lags[-1] * 1000, 3),
+        },
+        'total': total,
+        'routes': routes,
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as handle:
+            handle.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+
+
+# Best of --repeat runs of fn(), in seconds
+def _best(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Compare Model.serialize() + jsonify against projected rows + the fast encoder.')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tmp, 'serialization.db')
+        from flask import jsonify
+        from sqlalchemy import select
+        from api.app import app
+        from api.serialization import dumps, model_fields, orjson, rows_to_dicts
+        from db import db
+        from db.generator import Scale, generate
+        from db.models import Campaign, Recipient
+
+        with app.app_context():
+            db.create_all()
+            generate(db.engine, Scale(recipients=args.rows, campaigns=args.rows))
+
+            report = {'rows': args.rows, 'encoder': 'orjson' if orjson is not None else 'json', 'models': {}}
+            for model, sparse in ((Recipient, ('id', 'email')), (Campaign, ('id', 'name', 'status'))):
+                fields = model_fields(model)
+                sparse_fields = {name: fields[name] for name in sparse}
+
+                def orm_serialize():
+                    with app.test_request_context():
+                        jsonify([row.serialize() for row in db.session.execute(select(model)).scalars()]).get_data()
+                    db.session.expunge_all()
+
+                def projected():
+                    dumps(rows_to_dicts(list(fields), db.session.execute(select(*fields.values()))))
+
+                def projected_sparse():
+                    dumps(rows_to_dicts(list(sparse_fields), db.session.execute(select(*sparse_fields.values()))))
+
+                baseline = _best(orm_serialize, args.repeat)
+                results = {'orm_serialize_jsonify': baseline,
+                           'projected_rows': _best(projected, args.repeat),
+                           f'projected_rows_fields={",".join(sparse)}': _best(projected_sparse, args.repeat)}
+                report['models'][model.__tablename__] = {
+                    name: {'seconds': round(seconds, 4), 'rows_per_second': round(args.rows / seconds),
+                           'speedup': round(baseline / seconds, 2)}
+                    for name, seconds in results.items()
+                }
+            db.engine.dispose()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import create_engine, insert, select
+from sqlalchemy.exc import OperationalError
+
+from db import db
+from db.config import engine_options, install_sqlite_pragmas
+from db.models import Recipient, RecipientList
+from db.schema import ensure_indexes
+
+CATEGORIES = ['admin', 'vendors', 'customer']
+
+
+def _prepare(path, tuned, rows):
+    engine = create_engine('sqlite:///' + path)
+    if tuned:
+        install_sqlite_pragmas(engine)
+    db.metadata.create_all(engine)
+    ensure_indexes(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(RecipientList), [{'recipient_category': name} for name in CATEGORIES])
+        conn.execute(insert(Recipient), [
+            {'email': f'seed_{i}@example.com', 'name': f'Seed {i}', 'recipient_category': CATEGORIES[i % 3]}
+            for i in range(rows)
+        ])
+    engine.dispose()
+
+
+# One worker process: a gunicorn worker's mix of category reads and single-row committed inserts
+def _worker(path, tuned, worker_id, duration, write_ratio, results):
+    url = 'sqlite:///' + path
+    engine = create_engine(url, **engine_options(url))
+    if tuned:
+        install_sqlite_pragmas(engine)
+    rng = random.Random(worker_id)
+    reads = writes = locked = 0
+    deadline = time.monotonic() + duration
+    sequence = 0
+    while time.monotonic() < deadline:
+        try:
+            if rng.random() < write_ratio:
+                sequence += 1
+                with engine.begin() as conn:
+                    conn.execute(insert(Recipient).values(
+                        email=f'w{worker_id}_{sequence}@example.com', name='Writer',
+                        recipient_category=rng.choice(CATEGORIES)))
+                writes += 1
+            else:
+                with engine.connect() as conn:
+                    conn.execute(select(Recipient).where(Recipient.recipient_category == rng.choice(CATEGORIES))
+                                 .order_by(Recipient.id.desc()).limit(50)).all()
+                reads += 1
+        except OperationalError:
+            # "database is locked"
+            locked += 1
+    engine.dispose()
+    results.put({'reads': reads, 'writes': writes, 'locked_errors': locked})
+
+
+def run(tuned, workers, duration, write_ratio, rows):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        _prepare(path, tuned, rows)
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=_worker, args=(path, tuned, i, duration, write_ratio, results))
+                     for i in range(workers)]
+        for process in processes:
+            process.start()
+        totals = {'reads': 0, 'writes': 0, 'locked_errors': 0}
+        for _ in processes:
+            for key, value in results.get().items():
+                totals[key] += value
+        for process in processes:
+            process.join()
+    totals['ops_per_second'] = round((totals['reads'] + totals['writes']) / duration, 1)
+    totals['writes_per_second'] = round(totals['writes'] / duration, 1)
+    return totals
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Mixed read/write throughput across worker processes, default vs tuned SQLite settings.')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--write-ratio', type=float, default=0.2)
+    parser.add_argument('--rows', type=int, default=50000)
+    args = parser.parse_args(argv)
+
+    report = {
+        'workers': args.workers,
+        'duration_seconds': args.duration,
+        'write_ratio': args.write_ratio,
+        'default': run(False, args.workers, args.duration, args.write_ratio, args.rows),
+        'tuned': run(True, args.workers, args.duration, args.write_ratio, args.rows),
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import logging
+
+from db.models import CampaignChange
+
+BASE_TABLE = 'campaigns'
+CHANGES_TABLE = CampaignChange.__tablename__
+# Entries kept in the log; older ones are pruned every PRUNE_EVERY appends. A client further
+# behind than this is told to reload instead of replaying.
+CHANGE_LOG_RETENTION = 100000
+PRUNE_EVERY = 1000
+
+_COLUMNS = 'campaign_id, op, name, status, send_time, changed_at'
+
+# Every insert, update and delete on campaigns appends one entry in the same transaction, so
+# route handlers, the batch endpoint and the dispatcher's status updates are all captured
+SQLITE_TRIGGERS = {
+    'trg_campaigns_log_insert': f"""
+        CREATE TRIGGER IF NOT EXISTS trg_campaigns_log_insert AFTER INSERT ON campaigns
+        BEGIN
+            INSERT INTO {CHANGES_TABLE} ({_COLUMNS}) VALUES
+            (NEW.id, 'insert', NEW.name, NEW.status, NEW.send_time, strftime('%Y-%m-%d %H:%M:%f', 'now'));
+        END""",
+    'trg_campaigns_log_update': f"""
+        CREATE TRIGGER IF NOT EXISTS trg_campaigns_log_update AFTER UPDATE ON campaigns
+        BEGIN
+            INSERT INTO {CHANGES_TABLE} ({_COLUMNS}) VALUES
+            (NEW.id, 'update', NEW.name, NEW.status, NEW.send_time, strftime('%Y-%m-%d %H:%M:%f', 'now'));
+        END""",
+    'trg_campaigns_log_delete': f"""
+        CREATE TRIGGER IF NOT EXISTS trg_campaigns_log_delete AFTER DELETE ON campaigns
+        BEGIN
+            INSERT INTO {CHANGES_TABLE} ({_COLUMNS}) VALUES
+            (OLD.id, 'delete', OLD.name, OLD.status, OLD.send_time, strftime('%Y-%m-%d %H:%M:%f', 'now'));
+        END""",
+    'trg_campaign_changes_prune': f"""
+        CREATE TRIGGER IF NOT EXISTS trg_campaign_changes_prune AFTER INSERT ON {CHANGES_TABLE}
+        WHEN NEW.seq % {PRUNE_EVERY} = 0
+        BEGIN
+            DELETE FROM {CHANGES_TABLE} WHERE seq <= NEW.seq - {CHANGE_LOG_RETENTION};
+        END""",
+}
+
+# On Postgres, sequence values are handed out before commit, so concurrent writers can commit
+# seq N+1 before seq N; readers should treat the feed as at-least-once there.
+POSTGRES_TRIGGERS = {
+    'trg_campaigns_log': f"""
+        CREATE OR REPLACE FUNCTION campaigns_log_trigger() RETURNS trigger AS $$
+        DECLARE
+            entry campaigns%ROWTYPE;
+        BEGIN
+            IF TG_OP = 'DELETE' THEN entry := OLD; ELSE entry := NEW; END IF;
+            INSERT INTO {CHANGES_TABLE} ({_COLUMNS}) VALUES
+            (entry.id, lower(TG_OP), entry.name, entry.status, entry.send_time, now() AT TIME ZONE 'utc');
+            IF currval(pg_get_serial_sequence('{CHANGES_TABLE}', 'seq')) % {PRUNE_EVERY} = 0 THEN
+                DELETE FROM {CHANGES_TABLE}
+                WHERE seq <= currval(pg_get_serial_sequence('{CHANGES_TABLE}', 'seq')) - {CHANGE_LOG_RETENTION};
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql;
+        DROP TRIGGER IF EXISTS trg_campaigns_log ON campaigns;
+        CREATE TRIGGER trg_campaigns_log AFTER INSERT OR UPDATE OR DELETE ON campaigns
+        FOR EACH ROW EXECUTE FUNCTION campaigns_log_trigger();""",
+}
+
+
+def triggers(dialect):
+    return {'sqlite': SQLITE_TRIGGERS, 'postgresql': POSTGRES_TRIGGERS}.get(dialect.name, {})
+
+
+def install_triggers(conn):
+    for name, ddl in triggers(conn.dialect).items():
+        logging.debug("Ensuring trigger %s", name)
+        conn.exec_driver_sql(ddl)
+
+
+def drop_triggers(conn):
+    for name in triggers(conn.dialect):
+        on = f' ON {BASE_TABLE}' if conn.dialect.name == 'postgresql' else ''
+        conn.exec_driver_sql(f'DROP TRIGGER IF EXISTS {name}{on}')
+
+
+# A bulk load is not a stream of changes: the log restarts empty, and seq keeps counting up
+# from where it was so clients holding an old cursor are told to reload
+def rebuild(conn):
+    conn.execute(CampaignChange.__table__.delete())
+    return {}
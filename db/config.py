@@ -0,0 +1,128 @@
+import os
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import StaticPool
+
+from db import db
+
+DEFAULT_DATABASE_URL = 'sqlite:///mydatabase.db'
+
+# Relative SQLite paths resolve against the api app's instance folder, so the seeder, the
+# server and the dispatcher all open the same file whichever of them is started first
+INSTANCE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'api', 'instance')
+
+
+def _env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+# Threads the ASGI adapter (api/asgi.py) runs views on; each may hold a pooled connection
+def asgi_threads():
+    return _env_int('ASGI_THREADS', 32)
+
+
+# Connections held outside the view threads: the change-feed watcher and the group-commit writer
+BACKGROUND_CONNECTIONS = 2
+
+
+# Unless DB_MAX_OVERFLOW is set, the pool grows to a connection per ASGI thread plus the
+# background threads, so a view never waits pool_timeout for a connection and fails
+def _pool_options():
+    pool_size = _env_int('DB_POOL_SIZE', 5)
+    return {
+        'pool_size': pool_size,
+        'max_overflow': _env_int('DB_MAX_OVERFLOW', max(10, asgi_threads() + BACKGROUND_CONNECTIONS - pool_size)),
+        'pool_timeout': _env_int('DB_POOL_TIMEOUT', 30),
+    }
+
+
+# Applied to every new SQLite connection. WAL lets readers proceed while one writer commits,
+# synchronous=NORMAL is durable across application crashes in WAL mode, and busy_timeout makes
+# a writer wait for the lock instead of failing with "database is locked".
+def sqlite_pragmas():
+    return {
+        'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+        'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+        'busy_timeout': _env_int('SQLITE_BUSY_TIMEOUT_MS', 5000),
+        'mmap_size': _env_int('SQLITE_MMAP_SIZE', 256 * 1024 * 1024),
+        # Negative values are KiB: 64 MiB of page cache per connection
+        'cache_size': _env_int('SQLITE_CACHE_SIZE', -64 * 1024),
+        'temp_store': 'MEMORY',
+    }
+
+
+def database_url():
+    url = os.environ.get('DATABASE_URL', DEFAULT_DATABASE_URL)
+    # Heroku-style URLs; SQLAlchemy only accepts the postgresql:// scheme
+    if url.startswith('postgres://'):
+        url = 'postgresql+psycopg2://' + url[len('postgres://'):]
+    parsed = make_url(url)
+    if parsed.get_backend_name() == 'sqlite' and parsed.database and parsed.database != ':memory:' \
+            and not os.path.isabs(parsed.database):
+        url = parsed.set(database=os.path.join(INSTANCE_DIR, parsed.database)).render_as_string(hide_password=False)
+    return url
+
+
+def engine_options(url):
+    parsed = make_url(url)
+    if parsed.get_backend_name() == 'sqlite':
+        if not parsed.database or parsed.database == ':memory:':
+            # One shared connection, otherwise every pooled connection sees its own empty database
+            return {'poolclass': StaticPool, 'connect_args': {'check_same_thread': False}}
+        return {
+            **_pool_options(),
+            'connect_args': {'check_same_thread': False},
+        }
+    return {
+        **_pool_options(),
+        'pool_recycle': _env_int('DB_POOL_RECYCLE', 1800),
+        'pool_pre_ping': True,
+    }
+
+
+def apply_sqlite_pragmas(dbapi_connection, pragmas=None):
+    cursor = dbapi_connection.cursor()
+    for name, value in (pragmas or sqlite_pragmas()).items():
+        cursor.execute(f'PRAGMA {name}={value}')
+    cursor.close()
+
+
+def install_sqlite_pragmas(engine, pragmas=None):
+    if engine.dialect.name != 'sqlite':
+        return
+    pragmas = pragmas or sqlite_pragmas()
+    if engine.url.database in (None, '', ':memory:'):
+        # WAL and mmap do not apply to in-memory databases
+        pragmas = {name: value for name, value in pragmas.items() if name not in ('journal_mode', 'mmap_size')}
+    event.listen(engine, 'connect', lambda dbapi_connection, _: apply_sqlite_pragmas(dbapi_connection, pragmas))
+
+
+# pysqlite only opens a transaction implicitly before an INSERT/UPDATE/DELETE, never for a
+# SAVEPOINT, and RELEASE of an outermost savepoint commits. An engine that needs savepoints inside
+# one transaction (the group-commit writer) takes over transaction control with SQLAlchemy's
+# pysqlite recipe: no implicit transactions, and an explicit BEGIN whenever one starts. IMMEDIATE
+# takes the write lock up front, so the transaction never has to upgrade a read lock.
+def install_sqlite_transactions(engine, begin='BEGIN IMMEDIATE'):
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def _disable_implicit_transactions(dbapi_connection, _):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def _begin(conn):
+        conn.exec_driver_sql(begin)
+
+
+# The single place the Flask apps get their database settings from
+def configure_database(app):
+    url = database_url()
+    if url.startswith('sqlite:///'):
+        os.makedirs(INSTANCE_DIR, exist_ok=True)
+    app.config['SQLALCHEMY_DATABASE_URI'] = url
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(url)
+    db.init_app(app)
+    with app.app_context():
+        install_sqlite_pragmas(db.engine)
@@ -0,0 +1,125 @@
+import argparse
+import logging
+import sys
+
+from sqlalchemy import func, select
+
+from db.models import Recipient, RecipientCategoryCount
+
+BASE_TABLE = 'recipients'
+COUNTS_TABLE = RecipientCategoryCount.__tablename__
+
+# Row-level triggers keep recipient_category_counts in step with recipients, whether the write
+# comes from the ORM, a core executemany (bulk import) or the driver (generator)
+SQLITE_TRIGGERS = {
+    'trg_recipients_count_insert': f"""
+        CREATE TRIGGER IF NOT EXISTS trg_recipients_count_insert AFTER INSERT ON recipients
+        BEGIN
+            INSERT INTO {COUNTS_TABLE} (recipient_category, recipient_count) VALUES (NEW.recipient_category, 1)
+            ON CONFLICT (recipient_category) DO UPDATE SET recipient_count = recipient_count + 1;
+        END""",
+    'trg_recipients_count_delete': f"""
+        CREATE TRIGGER IF NOT EXISTS trg_recipients_count_delete AFTER DELETE ON recipients
+        BEGIN
+            UPDATE {COUNTS_TABLE} SET recipient_count = recipient_count - 1
+            WHERE recipient_category = OLD.recipient_category;
+        END""",
+    'trg_recipients_count_update': f"""
+        CREATE TRIGGER IF NOT EXISTS trg_recipients_count_update AFTER UPDATE OF recipient_category ON recipients
+        WHEN OLD.recipient_category IS NOT NEW.recipient_category
+        BEGIN
+            UPDATE {COUNTS_TABLE} SET recipient_count = recipient_count - 1
+            WHERE recipient_category = OLD.recipient_category;
+            INSERT INTO {COUNTS_TABLE} (recipient_category, recipient_count) VALUES (NEW.recipient_category, 1)
+            ON CONFLICT (recipient_category) DO UPDATE SET recipient_count = recipient_count + 1;
+        END""",
+}
+
+POSTGRES_TRIGGERS = {
+    'trg_recipients_count': f"""
+        CREATE OR REPLACE FUNCTION recipients_count_trigger() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('DELETE', 'UPDATE') THEN
+                UPDATE {COUNTS_TABLE} SET recipient_count = recipient_count - 1
+                WHERE recipient_category = OLD.recipient_category;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO {COUNTS_TABLE} (recipient_category, recipient_count) VALUES (NEW.recipient_category, 1)
+                ON CONFLICT (recipient_category)
+                DO UPDATE SET recipient_count = {COUNTS_TABLE}.recipient_count + 1;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql;
+        DROP TRIGGER IF EXISTS trg_recipients_count ON recipients;
+        CREATE TRIGGER trg_recipients_count AFTER INSERT OR DELETE OR UPDATE OF recipient_category ON recipients
+        FOR EACH ROW EXECUTE FUNCTION recipients_count_trigger();""",
+}
+
+
+def triggers(dialect):
+    return {'sqlite': SQLITE_TRIGGERS, 'postgresql': POSTGRES_TRIGGERS}.get(dialect.name, {})
+
+
+def install_triggers(conn):
+    for name, ddl in triggers(conn.dialect).items():
+        logging.debug("Ensuring trigger %s", name)
+        conn.exec_driver_sql(ddl)
+
+
+def drop_triggers(conn):
+    for name in triggers(conn.dialect):
+        suffix = ' ON recipients' if conn.dialect.name == 'postgresql' else ''
+        conn.exec_driver_sql(f'DROP TRIGGER IF EXISTS {name}{suffix}')
+
+
+def actual_counts(conn):
+    return dict(conn.execute(
+        select(Recipient.recipient_category, func.count()).group_by(Recipient.recipient_category)).all())
+
+
+def stored_counts(conn):
+    return dict(conn.execute(
+        select(RecipientCategoryCount.recipient_category, RecipientCategoryCount.recipient_count)).all())
+
+
+# {category: (stored, actual)} for every counter that disagrees with the recipients table
+def find_drift(conn, actual=None):
+    actual = actual if actual is not None else actual_counts(conn)
+    stored = stored_counts(conn)
+    return {category: (stored.get(category, 0), actual.get(category, 0))
+            for category in set(actual) | set(stored) if stored.get(category, 0) != actual.get(category, 0)}
+
+
+# Rebuild every counter from one GROUP BY over recipients and return the drift that was corrected
+def rebuild(conn):
+    actual = actual_counts(conn)
+    drift = find_drift(conn, actual)
+    conn.execute(RecipientCategoryCount.__table__.delete())
+    if actual:
+        conn.execute(RecipientCategoryCount.__table__.insert(),
+                     [{'recipient_category': category, 'recipient_count': count} for category, count in actual.items()])
+    return drift
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Rebuild the per-category recipient counts from the recipients table.')
+    parser.add_argument('--check', action='store_true', help='Only report drift; exit 1 if any counter is off')
+    args = parser.parse_args(argv)
+
+    from api.app import app
+    from db import db
+    logging.basicConfig(level=logging.INFO)
+    with app.app_context():
+        db.create_all()
+        with db.engine.begin() as conn:
+            install_triggers(conn)
+            drift = find_drift(conn) if args.check else rebuild(conn)
+    for category, (stored, actual) in sorted(drift.items()):
+        logging.info("%s: stored %d, actual %d", category, stored, actual)
+    logging.info("%d counters %s", len(drift), 'off' if args.check else 'corrected')
+    return 1 if args.check and drift else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,42 +1,115 @@
-from flask import Flask
+from api.app import app
 from db import db
-from db.models import RecipientList, Recipient, EmailTemplate, Campaign
+from db.models import RecipientList, Recipient, EmailTemplate, Campaign, CampaignDispatch
 from db.dummy_data_initinilazier import create_dummy_data
+from db.generator import generate, parse_scale
+from db.schema import ensure_indexes, ensure_triggers, triggers_suspended
+from db.shards import remove_shards
+from db import snapshot
+import argparse
 import logging
+import os
+import time
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Configure logging; LOG_LEVEL=DEBUG brings back the step-by-step seeding messages
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper())
 
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///mydatabase.db'  # Change to SQLite database URI
 
-# Initialize SQLAlchemy
-db.init_app(app)
-
-
-def seed_data():
+# Without a scale the small hand-written dataset is loaded; with one (see db.generator.Scale)
+# a generated dataset of that size is bulk-inserted instead
+def seed_data(scale=None):
     with app.app_context():
         # Create tables
         logging.debug("Creating database tables...")
         db.create_all()
+        ensure_indexes()
+        ensure_triggers()
 
         # Seed data
         logging.debug("Seeding data...")
         wipe_db()
-        if not any(table.query.first() for table in [RecipientList, Recipient, EmailTemplate, Campaign]):
+        remove_stale_shards()
+        if scale is not None:
+            generate(db.engine, scale)
+        elif not any(table.query.first() for table in [RecipientList, Recipient, EmailTemplate, Campaign]):
             create_dummy_data()
+        snapshot.store_fingerprint(db.session, snapshot.fingerprint(db.engine, scale))
 
 
 def wipe_db():
     # Wipe the data from all tables
     logging.debug("Wiping database tables...")
-    db.session.query(RecipientList).delete()
-    db.session.query(Recipient).delete()
-    db.session.query(EmailTemplate).delete()
-    db.session.query(Campaign).delete()
+    with triggers_suspended(db.session.connection()):
+        db.session.query(CampaignDispatch).delete()
+        db.session.query(RecipientList).delete()
+        db.session.query(Recipient).delete()
+        db.session.query(EmailTemplate).delete()
+        db.session.query(Campaign).delete()
     db.session.commit()
 
 
+# Recipients moved into shard files by STORAGE=sharded belong to the data being replaced; the
+# next sharded start absorbs the new recipients into fresh shards and registry
+def remove_stale_shards():
+    removed = remove_shards(app.config['SHARD_DIR'])
+    if removed:
+        logging.info("Removed %d recipient shard and registry files from %s", removed, app.config['SHARD_DIR'])
+
+
+# Startup entry point. A database already seeded with the same schema and data is reused as is;
+# otherwise a snapshot matching the fingerprint is restored, and only when there is none is
+# the database seeded (and a snapshot written for the next cold start).
+def prepare_database(scale=None, force_reseed=False):
+    with app.app_context():
+        engine = db.engine
+        expected = snapshot.fingerprint(engine, scale)
+        path = snapshot.sqlite_path(engine)
+
+        if force_reseed:
+            logging.info("Reseeding the database (forced)")
+        elif snapshot.stored_fingerprint(engine) == expected:
+            logging.info("Reusing the existing database; schema and seed fingerprint match")
+            return 'reused'
+        elif path and os.path.exists(snapshot.snapshot_path(expected)):
+            snapshot.restore_snapshot(engine, snapshot.snapshot_path(expected))
+            remove_stale_shards()
+            return 'restored'
+
+    seed_data(scale)
+    if path:
+        with app.app_context():
+            snapshot.create_snapshot(db.engine, snapshot.snapshot_path(expected))
+    return 'seeded'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Create the tables and seed the database.')
+    parser.add_argument('--scale', nargs='+', metavar='KEY=N', default=os.environ.get('SEED_SCALE', '').split() or None,
+                        help='Generate data instead of the built-in sample, e.g. '
+                             '--scale recipients=1000000 campaigns=100000 categories=50 templates=20 '
+                             '(default: $SEED_SCALE)')
+    parser.add_argument('--seed', type=int, default=int(os.environ.get('SEED_RANDOM_SEED', 0)),
+                        help='Random seed for generated data')
+    parser.add_argument('--force-reseed', action='store_true', default=os.environ.get('SEED_FORCE') == '1',
+                        help='Wipe and reseed even if the database or a snapshot matches (default: $SEED_FORCE=1)')
+    parser.add_argument('--always-reseed', action='store_true',
+                        help='Wipe and reseed without fingerprints or snapshots, as every boot used to')
+    args = parser.parse_args(argv)
+    if args.scale is not None:
+        try:
+            args.scale = parse_scale(args.scale, seed=args.seed)
+        except ValueError as exc:
+            parser.error(str(exc))
+    return args
+
+
 if __name__ == "__main__":
-    seed_data()
+    args = parse_args()
+    started = time.perf_counter()
+    if args.always_reseed:
+        seed_data(args.scale)
+        outcome = 'seeded'
+    else:
+        outcome = prepare_database(args.scale, force_reseed=args.force_reseed)
+    logging.info("Database %s in %.2fs", outcome, time.perf_counter() - started)
     logging.debug("Data seeding completed.")
@@ -1,4 +1,5 @@
 from datetime import datetime, timedelta
+from sqlalchemy import select
 from db import db
 from .models import RecipientList, Recipient, EmailTemplate, Campaign
 
@@ -65,9 +66,13 @@ def create_email_templates():
 
 # Function to create dummy data for Campaign
 def create_campaigns():
-    # Retrieve the IDs of the previously inserted recipient lists and email templates
-    recipient_list_ids = [rl.recipient_category for rl in RecipientList.query.all()]
-    template_ids = [et.name for et in EmailTemplate.query.all()]
+    # Only the first three recipient lists and templates are referenced below
+    recipient_list_ids = db.session.execute(
+        select(RecipientList.recipient_category).order_by(RecipientList.id).limit(3)
+    ).scalars().all()
+    template_ids = db.session.execute(
+        select(EmailTemplate.name).order_by(EmailTemplate.id).limit(3)
+    ).scalars().all()
     campaigns = [
         Campaign(name='Admin_camp', send_time=datetime.utcnow() + timedelta(hours=5), recipient_category=recipient_list_ids[0],
                  template_name=template_ids[0], campaign_template="Hello Admins How are You", status='Scheduled'),
@@ -85,7 +90,6 @@ def create_campaigns():
 def create_dummy_data():
     # Create dummy data for each table
     create_recipient_lists()
-    print("#"*30)
     create_recipients()
     create_email_templates()
     create_campaigns()
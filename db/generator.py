@@ -0,0 +1,162 @@
+import logging
+import random
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from db.models import RecipientList, Recipient, EmailTemplate, Campaign
+from db.schema import triggers_suspended
+
+# Bump whenever the generated data changes for the same scale and seed
+GENERATOR_VERSION = 1
+
+# Rows per executemany call; every table is written in a single transaction
+INSERT_CHUNK_SIZE = 50000
+
+Scale = namedtuple('Scale', ['recipients', 'categories', 'templates', 'campaigns', 'seed'])
+Scale.__new__.__defaults__ = (10000, 20, 20, 1000, 0)
+
+FIRST_NAMES = ['James', 'Mary', 'Robert', 'Patricia', 'John', 'Jennifer', 'Michael', 'Linda', 'David',
+               'Elizabeth', 'William', 'Barbara', 'Richard', 'Susan', 'Joseph', 'Jessica', 'Thomas', 'Sarah',
+               'Charles', 'Karen', 'Aarav', 'Priya', 'Wei', 'Mei', 'Carlos', 'Sofia', 'Ahmed', 'Fatima',
+               'Yuki', 'Hiroshi', 'Olga', 'Ivan', 'Chloe', 'Lucas', 'Amara', 'Kwame']
+LAST_NAMES = ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Rodriguez',
+              'Martinez', 'Hernandez', 'Lopez', 'Wilson', 'Anderson', 'Taylor', 'Thomas', 'Moore', 'Jackson',
+              'Sharma', 'Patel', 'Wang', 'Li', 'Kim', 'Nguyen', 'Silva', 'Khan', 'Tanaka', 'Ivanov', 'Okafor']
+DOMAINS = ['gmail.com', 'yahoo.com', 'outlook.com', 'hotmail.com', 'icloud.com', 'example.com',
+           'company.org', 'mail.net']
+# Most mail goes to a handful of providers
+DOMAIN_WEIGHTS = [30, 12, 12, 8, 8, 15, 10, 5]
+
+TEMPLATE_BODIES = [
+    'Hi {{name}}, here is what is new for {{recipient_category}} this week.',
+    'Dear {{name}}, your account {{email}} has an update waiting.',
+    'Hello {{name}}! Exclusive offers for {{recipient_category}} members inside.',
+    'Reminder for {{email}}: your subscription renews soon.',
+]
+
+
+def category_name(index):
+    return f'category_{index}'
+
+
+def template_name(index):
+    return f'template_{index}'
+
+
+def campaign_name(index):
+    return f'campaign_{index}'
+
+
+# Category sizes follow a Zipf-like curve: a few large audiences and a long tail of small ones
+def category_weights(count):
+    return [1.0 / (rank + 1) ** 1.1 for rank in range(count)]
+
+
+def _write(conn, table, columns, rows):
+    # Driver-level executemany over plain tuples: no per-row dict or SQLAlchemy parameter processing
+    marker = '?' if conn.dialect.paramstyle == 'qmark' else '%s'
+    statement = f'INSERT INTO {table.name} ({", ".join(columns)}) VALUES ({", ".join([marker] * len(columns))})'
+    written = 0
+    for chunk in rows:
+        conn.exec_driver_sql(statement, chunk)
+        written += len(chunk)
+    return written
+
+
+def _chunks(total, chunk_size):
+    for start in range(0, total, chunk_size):
+        yield start, min(chunk_size, total - start)
+
+
+RECIPIENT_LIST_COLUMNS = ('recipient_category', 'description', 'created_at', 'updated_at')
+EMAIL_TEMPLATE_COLUMNS = ('name', 'content', 'created_at', 'updated_at')
+RECIPIENT_COLUMNS = ('email', 'name', 'recipient_category')
+CAMPAIGN_COLUMNS = ('name', 'send_time', 'campaign_template', 'recipient_category', 'template_name', 'status',
+                    'created_at', 'updated_at')
+
+
+def _recipient_lists(scale, now, chunk_size):
+    for start, size in _chunks(scale.categories, chunk_size):
+        yield [(category_name(i), f'Send Email Campaign to {category_name(i)} users', now, now)
+               for i in range(start, start + size)]
+
+
+def _email_templates(scale, rng, now, chunk_size):
+    for start, size in _chunks(scale.templates, chunk_size):
+        yield [(template_name(i), rng.choice(TEMPLATE_BODIES), now, now) for i in range(start, start + size)]
+
+
+def _recipients(scale, rng, chunk_size):
+    categories = [category_name(i) for i in range(scale.categories)]
+    weights = category_weights(scale.categories)
+    width = len(str(scale.recipients))
+    # Every column of a chunk is drawn with one random.choices call instead of one call per row
+    for start, size in _chunks(scale.recipients, chunk_size):
+        firsts = rng.choices(FIRST_NAMES, k=size)
+        lasts = rng.choices(LAST_NAMES, k=size)
+        domains = rng.choices(DOMAINS, DOMAIN_WEIGHTS, k=size)
+        chunk_categories = rng.choices(categories, weights, k=size)
+        # The zero-padded index keeps emails unique and makes each name prefix grow append-only
+        # in the unique email index
+        yield [(f'{first.lower()}.{last.lower()}.{start + offset:0{width}d}@{domain}', f'{first} {last}', category)
+               for offset, (first, last, domain, category)
+               in enumerate(zip(firsts, lasts, domains, chunk_categories))]
+
+
+def _campaigns(scale, rng, now, chunk_size):
+    categories = [category_name(i) for i in range(scale.categories)]
+    weights = category_weights(scale.categories)
+    for start, size in _chunks(scale.campaigns, chunk_size):
+        chunk = []
+        for i in range(start, start + size):
+            # A third of the campaigns are in the past, the rest spread over the next two months
+            send_time = now + timedelta(minutes=rng.randint(-30 * 24 * 60, 60 * 24 * 60))
+            if send_time <= now:
+                status = 'Sent' if rng.random() < 0.9 else 'Cancelled'
+            else:
+                status = 'Scheduled' if rng.random() < 0.85 else 'Cancelled'
+            created_at = min(send_time, now) - timedelta(days=rng.randint(1, 30))
+            chunk.append((campaign_name(i), send_time, rng.choice(TEMPLATE_BODIES),
+                          rng.choices(categories, weights)[0], template_name(rng.randrange(scale.templates)),
+                          status, created_at, created_at))
+        yield chunk
+
+
+# Write a deterministic dataset of the given scale into empty tables, one transaction per
+# table. Secondary indexes and triggers are dropped for the load and rebuilt
+# afterwards, which is much cheaper than maintaining them row by row. The same scale and seed always produce the same
+# rows, timestamps aside.
+def generate(engine, scale, chunk_size=INSERT_CHUNK_SIZE):
+    rng = random.Random(scale.seed)
+    now = datetime.utcnow()
+    counts = {}
+    for model, columns, rows in (
+            (RecipientList, RECIPIENT_LIST_COLUMNS, _recipient_lists(scale, now, chunk_size)),
+            (EmailTemplate, EMAIL_TEMPLATE_COLUMNS, _email_templates(scale, rng, now, chunk_size)),
+            (Recipient, RECIPIENT_COLUMNS, _recipients(scale, rng, chunk_size)),
+            (Campaign, CAMPAIGN_COLUMNS, _campaigns(scale, rng, now, chunk_size))):
+        table = model.__table__
+        started = time.perf_counter()
+        with engine.begin() as conn:
+            for index in table.indexes:
+                index.drop(conn, checkfirst=True)
+            with triggers_suspended(conn, table.name):
+                counts[table.name] = _write(conn, table, columns, rows)
+            for index in table.indexes:
+                index.create(conn)
+        logging.info("Generated %d %s in %.2fs", counts[table.name], table.name, time.perf_counter() - started)
+    return counts
+
+
+def parse_scale(items, seed=0):
+    values = Scale()._asdict()
+    values['seed'] = seed
+    for item in items:
+        key, _, value = item.partition('=')
+        if key not in values or key == 'seed':
+            raise ValueError(f'Unknown scale key {key!r}; expected one of: recipients, categories, templates, campaigns')
+        values[key] = int(float(value))
+    if values['categories'] < 1 or values['templates'] < 1:
+        raise ValueError('categories and templates must be at least 1')
+    return Scale(**values)
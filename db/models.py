@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Index, func, select
+from sqlalchemy.orm import column_property, validates
 from datetime import datetime
 from . import db
 
@@ -17,15 +18,27 @@ class RecipientList(db.Model):
             'recipient_category': self.recipient_category,
             'description': self.description,
             'created_at': self.created_at.isoformat(),
-            'updated_at': self.updated_at.isoformat()
+            'updated_at': self.updated_at.isoformat(),
+            'recipient_count': self.recipient_count
         }
 
+# Emails are stored lowercase, so they are unique regardless of case and an email prefix search
+# is a range on the unique index (db/search.py). The API normalizes every email it writes or
+# looks up with this; the validator below covers rows built as models.
+def normalize_email(email):
+    return email.strip().lower()
+
+
 class Recipient(db.Model):
     __tablename__ = 'recipients'
     id = Column(Integer, primary_key=True, autoincrement=True)
     email = Column(String, unique=True, nullable=False)
     name = Column(String)
-    recipient_category = Column(String, nullable=False)
+    recipient_category = Column(String, nullable=False, index=True)
+
+    @validates('email')
+    def _normalize_email(self, key, email):
+        return normalize_email(email) if isinstance(email, str) else email
 
     def serialize(self):
         return {
@@ -35,6 +48,24 @@ class Recipient(db.Model):
             'recipient_category': self.recipient_category
         }
 
+# Number of recipients per category. Maintained by triggers on recipients (see db/counters.py),
+# so every write path keeps it current; rebuild it with `python -m db.counters`.
+class RecipientCategoryCount(db.Model):
+    __tablename__ = 'recipient_category_counts'
+    recipient_category = Column(String, primary_key=True)
+    recipient_count = Column(Integer, nullable=False, default=0)
+
+
+# A primary-key lookup per list instead of counting its recipients
+RecipientList.recipient_count = column_property(
+    func.coalesce(
+        select(RecipientCategoryCount.recipient_count)
+        .where(RecipientCategoryCount.recipient_category == RecipientList.recipient_category)
+        .scalar_subquery(),
+        0
+    )
+)
+
 class EmailTemplate(db.Model):
     __tablename__ = 'email_templates'
     id = Column(Integer, primary_key=True, autoincrement=True)
@@ -54,12 +85,16 @@ class EmailTemplate(db.Model):
 
 class Campaign(db.Model):
     __tablename__ = 'campaigns'
+    __table_args__ = (
+        # Due-campaign lookups filter on status and range/order on send_time
+        Index('ix_campaigns_status_send_time', 'status', 'send_time'),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String, nullable=False, unique=True)
-    send_time = Column(DateTime, nullable=False)
+    send_time = Column(DateTime, nullable=False, index=True)
     campaign_template = Column(String, nullable=False)
-    recipient_category = Column(String, ForeignKey('recipient_lists.recipient_category'), nullable=False)
-    template_name = Column(String, ForeignKey('email_templates.name'), nullable=False)
+    recipient_category = Column(String, ForeignKey('recipient_lists.recipient_category'), nullable=False, index=True)
+    template_name = Column(String, ForeignKey('email_templates.name'), nullable=False, index=True)
     status = Column(String, default='Scheduled')
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -76,3 +111,65 @@ class Campaign(db.Model):
             'created_at': self.created_at.isoformat(),
             'updated_at': self.updated_at.isoformat()
         }
+
+
+# Progress of a campaign that left 'Scheduled'. last_recipient_id is the keyset checkpoint
+# a restarted dispatcher resumes from, so recipients already handed to the transport are not resent.
+class CampaignDispatch(db.Model):
+    __tablename__ = 'campaign_dispatches'
+    campaign_id = Column(Integer, ForeignKey('campaigns.id'), primary_key=True)
+    last_recipient_id = Column(Integer, nullable=False, default=0)
+    sent_count = Column(Integer, nullable=False, default=0)
+    failed_count = Column(Integer, nullable=False, default=0)
+    started_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime)
+
+    def serialize(self):
+        return {
+            'campaign_id': self.campaign_id,
+            'last_recipient_id': self.last_recipient_id,
+            'sent_count': self.sent_count,
+            'failed_count': self.failed_count,
+            'started_at': self.started_at.isoformat(),
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+
+
+# Append-only log of campaign mutations, written by triggers on campaigns (see db/change_log.py).
+# seq is AUTOINCREMENT, so it only ever grows, even after old entries are pruned.
+class CampaignChange(db.Model):
+    __tablename__ = 'campaign_changes'
+    __table_args__ = {'sqlite_autoincrement': True}
+    seq = Column(Integer, primary_key=True, autoincrement=True)
+    campaign_id = Column(Integer, nullable=False)
+    op = Column(String, nullable=False)
+    name = Column(String, nullable=False)
+    status = Column(String)
+    send_time = Column(DateTime)
+    changed_at = Column(DateTime, nullable=False)
+
+    def serialize(self):
+        return {
+            'seq': self.seq,
+            'campaign_id': self.campaign_id,
+            'op': self.op,
+            'name': self.name,
+            'status': self.status,
+            'send_time': self.send_time.isoformat() if self.send_time else None,
+            'changed_at': self.changed_at.isoformat()
+        }
+
+
+# Key/value facts about how the database was built, e.g. the seed fingerprint checked at startup
+class SeedMetadata(db.Model):
+    __tablename__ = 'seed_metadata'
+    key = Column(String, primary_key=True)
+    value = Column(Text)
+
+
+# A counter per table, bumped by triggers on every write to it (see db/versions.py) whichever
+# process or connection made the write; cached responses are keyed on it
+class DataVersion(db.Model):
+    __tablename__ = 'data_versions'
+    resource = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
@@ -0,0 +1,132 @@
+import argparse
+import os
+import sys
+import tempfile
+from datetime import datetime
+
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import sqlite
+
+from api.campaign_changes import lookup_statements
+from api.pagination import DEFAULT_PAGE_SIZE
+from api.serialization import model_fields
+from api.storage import (UPDATE_RECIPIENTS, audience_statement, campaign_audience_statement, changes_statement,
+                         exists_statement, existing_categories_statement, existing_emails_statement,
+                         named_statement, recipient_updates, rows_statement, search_rows_statement)
+from db import db
+from db.generator import Scale, generate
+from db.models import RecipientList, Recipient, EmailTemplate, Campaign
+from db.schema import ensure_indexes
+from dispatch.dispatcher import due_statement, interrupted_statement
+
+
+# Pages whose filter column has a handful of values, where the planner walks the table in id order
+# and stops once the page is full instead of going through an index on the column. Campaign status
+# is only indexed as the prefix of ix_campaigns_status_send_time, which cannot return rows in id order.
+ORDERED_WALKS = {'get_campaigns_by_status': 'campaigns'}
+
+
+def _page(model, filters, after_id=None):
+    return rows_statement(model, list(model_fields(model)), filters, after_id).limit(DEFAULT_PAGE_SIZE + 1)
+
+
+# The lookups issued by the routes and the dispatcher, built by the same functions SqlStorage and
+# the dispatcher use, keyed by a description of where they come from
+def route_queries():
+    dialect = sqlite.dialect()
+    email = 'mary.smith.000001@gmail.com'
+    batch = [('create', None, {'name': 'campaign_1', 'recipient_category': 'category_1',
+                               'template_name': 'template_1'})]
+    queries = {
+        'get_recipients_by_category': _page(Recipient, {'recipient_category': 'category_1'}),
+        'get_recipients_by_category (after_id)': _page(Recipient, {'recipient_category': 'category_1'}, 1000),
+        'get_recipients_by_category (empty check)': exists_statement(Recipient, {'recipient_category': 'category_1'}),
+        'get_campaigns_by_status': _page(Campaign, {'status': 'Scheduled'}),
+        'get_campaigns_by_status (after_id)': _page(Campaign, {'status': 'Scheduled'}, 1000),
+        'keyset page': _page(Recipient, {}, 1000),
+        'get_recipient_lists (after_id)': _page(RecipientList, {}, 10),
+        'create_recipient email uniqueness': exists_statement(Recipient, {'email': email}),
+        'create_recipient_list uniqueness': exists_statement(RecipientList, {'recipient_category': 'category_1'}),
+        'create_email_template uniqueness': exists_statement(EmailTemplate, {'name': 'template_1'}),
+        'search_recipients (trigram)': search_rows_statement(dialect, 'smith', ['id', 'email'], 0, 101),
+        'search_recipients (short email prefix)': search_rows_statement(dialect, 'ma', ['id', 'email'], 0, 101),
+        'campaign changes since': changes_statement(10, 500),
+        'preview_campaign campaign': named_statement(Campaign, 'campaign_1'),
+        'preview_campaign template': named_statement(EmailTemplate, 'template_1'),
+        'preview_campaign / dispatch audience': audience_statement('category_1', 100, 1000),
+        'campaign audience': campaign_audience_statement('campaign_1'),
+        'bulk import categories': existing_categories_statement(['category_1', 'category_2']),
+        'bulk import emails': existing_emails_statement([email]),
+        # An executemany statement, explained with the parameters of one row
+        'bulk import upsert': (UPDATE_RECIPIENTS, recipient_updates([
+            {'email': email, 'name': 'Mary', 'recipient_category': 'category_1'}])[0]),
+        'dispatcher due campaigns': due_statement(datetime.utcnow()),
+        'dispatcher interrupted campaigns': interrupted_statement(),
+    }
+    for kind, statement in lookup_statements(batch).items():
+        queries[f'campaign changes lookup ({kind})'] = statement
+    return queries
+
+
+def explain(conn, statement, params=None):
+    if params is None:
+        sql = str(statement.compile(dialect=conn.dialect, compile_kwargs={'literal_binds': True}))
+        return [row[-1] for row in conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + sql)]
+    compiled = statement.compile(dialect=conn.dialect, column_keys=list(params))
+    values = compiled.construct_params(params)
+    return [row[-1] for row in conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + str(compiled),
+                                                     tuple(values[name] for name in compiled.positiontup))]
+
+
+# A plan step that reads a whole table (or a whole index) means the query degrades with table size.
+# FTS5 reports its index lookups as 'SCAN ... VIRTUAL TABLE INDEX', and a subquery the plan
+# materialized (bounded by its own LIMIT) is read back with 'SCAN <name>'; neither is a table scan.
+def is_scan(detail, materialized=()):
+    return detail.startswith('SCAN ') and 'VIRTUAL TABLE INDEX' not in detail \
+        and detail.split()[1] not in materialized
+
+
+def check(engine):
+    failures = []
+    with engine.connect() as conn:
+        for label, query in route_queries().items():
+            plan = explain(conn, *query) if isinstance(query, tuple) else explain(conn, query)
+            materialized = {detail.split()[1] for detail in plan if detail.startswith('MATERIALIZE ')}
+            scans = [detail for detail in plan if is_scan(detail, materialized)]
+            if label in ORDERED_WALKS and scans == [f'SCAN {ORDERED_WALKS[label]}'] \
+                    and not any(detail.startswith('USE TEMP B-TREE') for detail in plan):
+                scans = []
+            print(f"{'FAIL' if scans else 'ok  '}  {label}: {' | '.join(plan)}")
+            if scans:
+                failures.append(label)
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fail if any route query falls back to a table scan.')
+    parser.add_argument('--recipients', type=int, default=200000)
+    parser.add_argument('--campaigns', type=int, default=20000)
+    parser.add_argument('--categories', type=int, default=50)
+    parser.add_argument('--templates', type=int, default=50)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine('sqlite:///' + os.path.join(tmp, 'plan_check.db'))
+        db.metadata.create_all(engine)
+        ensure_indexes(engine)
+        generate(engine, Scale(args.recipients, args.categories, args.templates, args.campaigns))
+        with engine.begin() as conn:
+            # Give the planner real statistics, as a long-running database would have
+            conn.exec_driver_sql('ANALYZE')
+        failures = check(engine)
+        engine.dispose()
+
+    if failures:
+        print(f'{len(failures)} route queries fall back to a scan: {", ".join(failures)}')
+        return 1
+    print('All route queries use an index.')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,60 @@
+import logging
+from contextlib import contextmanager
+
+from db import change_log, counters, db, search, versions
+# Imported for its side effect of registering every table on db.metadata
+from db import models  # noqa: F401
+
+# Modules that keep a derived table in step with a base table through triggers. Each provides
+# BASE_TABLE, triggers(dialect), install_triggers(conn), drop_triggers(conn) and rebuild(conn).
+# The write counters of db/versions.py are one such object per versioned table.
+DERIVED_TABLES = (counters, search, change_log, *versions.VERSIONS)
+
+
+# Indexes a model no longer declares, dropped from databases created while it did.
+# ix_campaigns_status is a prefix of ix_campaigns_status_send_time.
+OBSOLETE_INDEXES = ('ix_campaigns_status',)
+
+
+# db.create_all() only creates indexes together with their table, so databases created before
+# an index was declared on a model never get it. Create any missing index in place.
+def ensure_indexes(bind=None):
+    bind = bind if bind is not None else db.engine
+    with bind.begin() as conn:
+        for name in OBSOLETE_INDEXES:
+            conn.exec_driver_sql(f'DROP INDEX IF EXISTS {name}')
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            logging.debug("Ensuring index %s on %s", index.name, table.name)
+            index.create(bind, checkfirst=True)
+
+
+# With base_table, only the triggers on that table are installed (e.g. in a recipient shard)
+def ensure_triggers(bind=None, base_table=None):
+    bind = bind if bind is not None else db.engine
+    with bind.begin() as conn:
+        for derived in DERIVED_TABLES:
+            if base_table in (None, derived.BASE_TABLE):
+                derived.install_triggers(conn)
+
+
+# Row-by-row trigger work is wasted on a bulk load or wipe: drop the triggers for the duration
+# and rebuild the derived tables once at the end, the way secondary indexes are handled.
+# With base_table, only the tables derived from it are suspended. The triggers are put back
+# even when the body fails, so a connection that commits anyway never keeps a schema without them.
+@contextmanager
+def triggers_suspended(conn, base_table=None):
+    suspended = [derived for derived in DERIVED_TABLES if base_table in (None, derived.BASE_TABLE)]
+    for derived in suspended:
+        derived.drop_triggers(conn)
+    try:
+        yield
+    finally:
+        for derived in suspended:
+            derived.install_triggers(conn)
+            derived.rebuild(conn)
+
+
+# The trigger DDL is part of the schema a seeded database was built with
+def trigger_ddl(dialect):
+    return [ddl for derived in DERIVED_TABLES for _, ddl in sorted(derived.triggers(dialect).items())]
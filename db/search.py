@@ -0,0 +1,104 @@
+import logging
+
+from sqlalchemy import column, literal_column, select, table
+
+from db.models import Recipient
+
+BASE_TABLE = 'recipients'
+FTS_TABLE = 'recipients_fts'
+# The trigram tokenizer only indexes substrings of three characters or more
+MIN_TRIGRAM_LENGTH = 3
+# Matches considered for ranking. Broad terms ('gmail') match a large share of the table and
+# ranking all of them costs a pass over every match; beyond this many, the earliest matches
+# are ranked. Covers every page up to api.pagination.MAX_RANKED_OFFSET.
+MAX_RANKED_CANDIDATES = 11000
+
+# External-content FTS5 index over recipients.email and recipients.name: the text lives in
+# recipients only, the index stores trigrams keyed by recipients.id
+SQLITE_TABLE = f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        email, name, content='recipients', content_rowid='id', tokenize='trigram'
+    )"""
+
+SQLITE_TRIGGERS = {
+    'trg_recipients_fts_insert': f"""
+        CREATE TRIGGER IF NOT EXISTS trg_recipients_fts_insert AFTER INSERT ON recipients
+        BEGIN
+            INSERT INTO {FTS_TABLE} (rowid, email, name) VALUES (NEW.id, NEW.email, NEW.name);
+        END""",
+    'trg_recipients_fts_delete': f"""
+        CREATE TRIGGER IF NOT EXISTS trg_recipients_fts_delete AFTER DELETE ON recipients
+        BEGIN
+            INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, email, name) VALUES ('delete', OLD.id, OLD.email, OLD.name);
+        END""",
+    'trg_recipients_fts_update': f"""
+        CREATE TRIGGER IF NOT EXISTS trg_recipients_fts_update AFTER UPDATE OF email, name ON recipients
+        BEGIN
+            INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, email, name) VALUES ('delete', OLD.id, OLD.email, OLD.name);
+            INSERT INTO {FTS_TABLE} (rowid, email, name) VALUES (NEW.id, NEW.email, NEW.name);
+        END""",
+}
+
+fts = table(FTS_TABLE, column('rowid'), column('rank'))
+
+
+# Only SQLite has the index; elsewhere search falls back to LIKE over recipients
+def triggers(dialect):
+    return SQLITE_TRIGGERS if dialect.name == 'sqlite' else {}
+
+
+def install_triggers(conn):
+    if conn.dialect.name != 'sqlite':
+        return
+    conn.exec_driver_sql(SQLITE_TABLE)
+    for name, ddl in SQLITE_TRIGGERS.items():
+        logging.debug("Ensuring trigger %s", name)
+        conn.exec_driver_sql(ddl)
+
+
+def drop_triggers(conn):
+    for name in triggers(conn.dialect):
+        conn.exec_driver_sql(f'DROP TRIGGER IF EXISTS {name}')
+
+
+# Re-read every recipient into the index
+def rebuild(conn):
+    if conn.dialect.name == 'sqlite':
+        conn.exec_driver_sql(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('rebuild')")
+    return {}
+
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+# Recipients matching q, best first: emails starting with q, then by FTS5 rank (bm25) over
+# substring matches in email or name, among the first MAX_RANKED_CANDIDATES matches. Queries
+# shorter than a trigram can only use the email index, so they match email prefixes alone.
+# With sort_key, the ascending ORDER BY terms follow the columns, so results searched in
+# several databases (see db/shards.py) can be merged into one ranking.
+def search_statement(dialect, q, columns, sort_key=False):
+    prefix = _escape_like(q) + '%'
+    if len(q) < MIN_TRIGRAM_LENGTH:
+        # Emails are stored lowercase (models.normalize_email), so the prefix becomes a range on
+        # the unique email index
+        q = q.lower()
+        order = (Recipient.email,)
+        statement = select(*columns).where(Recipient.email >= q, Recipient.email < q + '\U0010ffff')
+    elif dialect.name != 'sqlite':
+        pattern = '%' + _escape_like(q) + '%'
+        order = (Recipient.email.not_ilike(prefix, escape='\\'), Recipient.id)
+        statement = select(*columns).where(Recipient.email.ilike(pattern, escape='\\') |
+                                           Recipient.name.ilike(pattern, escape='\\'))
+    else:
+        # A quoted FTS5 string is matched as a literal substring, whatever punctuation q contains
+        phrase = '"' + q.replace('"', '""') + '"'
+        matches = select(fts.c.rowid, fts.c.rank).where(literal_column(FTS_TABLE).op('MATCH')(phrase)) \
+            .limit(MAX_RANKED_CANDIDATES).subquery('matches')
+        # NOT LIKE is 0 for an email starting with q, so those sort first
+        order = (Recipient.email.not_like(prefix, escape='\\'), matches.c.rank, Recipient.id)
+        statement = select(*columns) \
+            .select_from(matches.join(Recipient.__table__, Recipient.id == matches.c.rowid))
+    if sort_key:
+        statement = statement.add_columns(*order)
+    return statement.order_by(*order)
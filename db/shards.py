@@ -0,0 +1,384 @@
+import argparse
+import fcntl
+import logging
+import os
+import re
+import sys
+import zlib
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
+
+from sqlalchemy import Column, Integer, MetaData, String, Table, bindparam, create_engine, func, insert, select, update
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+
+from db.config import engine_options, install_sqlite_pragmas
+from db.counters import find_drift
+from db.models import DataVersion, Recipient, RecipientCategoryCount
+from db.schema import ensure_triggers, triggers_suspended
+
+logger = logging.getLogger(__name__)
+
+BASE_TABLE = 'recipients'
+DEFAULT_SHARD_COUNT = 8
+# Rows per executemany when recipients move between the main database and the shards
+MOVE_CHUNK_SIZE = 50000
+
+SHARD_FILE_RE = re.compile(r'^(?:recipients|emails)-(\d+)-of-(\d+)\.db$')
+# Emails per IN (...) lookup in a registry file, well under SQLite's bound-parameter limit
+REGISTRY_LOOKUP_CHUNK = 5000
+
+# The next id a shard hands out. Shard i of N only allocates ids congruent to i modulo N, so
+# shards never collide without coordinating, and the counter only grows, so an id stays unique
+# after its row moves to another shard.
+id_sequence = Table('recipient_id_sequence', MetaData(), Column('next_id', Integer, nullable=False))
+
+# Every sharded recipient's email and id, split by hash of the email over registry files
+# (emails-{i}-of-{N}.db) next to the shards. Its primary key is what makes emails unique across
+# shards, and only writes of emails hashed to the same file share its writer lock. A write
+# registers its emails and commits them first, then writes the rows, and unregisters the emails
+# of rows that failed; a duplicate therefore fails before any recipient row is written.
+email_registry = Table('recipient_email_registry', MetaData(),
+                       Column('email', String, primary_key=True),
+                       Column('recipient_id', Integer, nullable=False))
+
+_COLUMNS = ('id', 'email', 'name', 'recipient_category')
+
+
+def shard_index(recipient_category, count):
+    return zlib.crc32(recipient_category.encode('utf-8')) % count
+
+
+# The smallest id above value that shard allocates
+def first_id_after(value, shard, count):
+    return value + 1 + (shard - value - 1) % count
+
+
+# Shards sit next to a SQLite main database: mydatabase.db -> mydatabase-shards/
+def default_shard_dir(database_url):
+    parsed = make_url(database_url)
+    if parsed.get_backend_name() != 'sqlite' or parsed.database in (None, '', ':memory:'):
+        return None
+    return os.path.splitext(parsed.database)[0] + '-shards'
+
+
+def _remove_database_file(path):
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+# Serializes schema changes and moves between the processes (e.g. web workers) opening the shards
+@contextmanager
+def layout_lock(directory):
+    with open(os.path.join(directory, '.lock'), 'a') as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        yield
+
+
+# Removes every shard and registry file in directory, for when the main database is reseeded
+# and they no longer hold its recipients. Returns the number of files removed.
+def remove_shards(directory):
+    if not directory or not os.path.isdir(directory):
+        return 0
+    with layout_lock(directory):
+        names = [name for name in os.listdir(directory) if SHARD_FILE_RE.match(name)]
+        for name in names:
+            _remove_database_file(os.path.join(directory, name))
+    return len(names)
+
+
+# Recipients split by hash of recipient_category over count SQLite files in directory. Each file
+# holds the recipients table with its indexes, the per-category counters, the trigram search
+# index and the recipients write counter, all kept current by the same triggers as in the main
+# database, so writes to different shards take different writer locks and a category is read
+# from a single file. Another count files hold the email registry.
+class RecipientShards:
+    def __init__(self, directory, count):
+        if count < 1:
+            raise ValueError('RECIPIENT_SHARDS must be at least 1')
+        self.directory = directory
+        self.count = count
+        os.makedirs(directory, exist_ok=True)
+        self.engines = [self._open(self.path(index)) for index in range(count)]
+        self.registry_engines = [self._open(self.registry_path(index)) for index in range(count)]
+        with self.layout_lock():
+            self._check_layout()
+            for index in range(count):
+                self._ensure_schema(index)
+
+    @staticmethod
+    def _open(path):
+        url = f'sqlite:///{path}'
+        engine = create_engine(url, **engine_options(url))
+        install_sqlite_pragmas(engine)
+        return engine
+
+    def path(self, index):
+        return os.path.join(self.directory, f'recipients-{index}-of-{self.count}.db')
+
+    def registry_path(self, index):
+        return os.path.join(self.directory, f'emails-{index}-of-{self.count}.db')
+
+    def index_for(self, recipient_category):
+        return shard_index(recipient_category, self.count)
+
+    def engine_for(self, recipient_category):
+        return self.engines[self.index_for(recipient_category)]
+
+    def registry_index(self, email):
+        return zlib.crc32(email.encode('utf-8')) % self.count
+
+    def layout_lock(self):
+        return layout_lock(self.directory)
+
+    def _check_layout(self):
+        for name in os.listdir(self.directory):
+            match = SHARD_FILE_RE.match(name)
+            if match and int(match.group(2)) != self.count:
+                raise ValueError(f'{self.directory} holds shards for RECIPIENT_SHARDS={match.group(2)}; move them '
+                                 f'back with python -m db.shards merge --shards {match.group(2)} first')
+
+    def _ensure_schema(self, index):
+        engine = self.engines[index]
+        for table in (Recipient.__table__, RecipientCategoryCount.__table__, DataVersion.__table__, id_sequence):
+            table.create(engine, checkfirst=True)
+        ensure_triggers(engine, BASE_TABLE)
+        email_registry.create(self.registry_engines[index], checkfirst=True)
+        with engine.begin() as conn:
+            if conn.execute(select(id_sequence.c.next_id)).first() is None:
+                highest = conn.execute(select(func.max(Recipient.id))).scalar() or 0
+                conn.execute(insert(id_sequence).values(next_id=first_id_after(highest, index, self.count)))
+
+    # Reserve count ids in shard index and return the first; the others follow every self.count.
+    # The UPDATE takes the shard's writer lock, so call it first in a write transaction.
+    def allocate_ids(self, conn, index, count):
+        step = count * self.count
+        return conn.execute(
+            update(id_sequence).values(next_id=id_sequence.c.next_id + step).returning(id_sequence.c.next_id)
+        ).scalar() - step
+
+    # {registry index: registry rows} for rows with email and id
+    def _by_registry(self, rows):
+        by_registry = defaultdict(list)
+        for row in rows:
+            by_registry[self.registry_index(row['email'])].append({'email': row['email'], 'recipient_id': row['id']})
+        return by_registry
+
+    # {email: recipient id} for the given emails that are registered, read through conns (one
+    # per registry file) or fresh connections
+    def _registered(self, conns, emails):
+        by_registry = defaultdict(list)
+        for email in emails:
+            by_registry[self.registry_index(email)].append(email)
+        registered = {}
+        for index, found in by_registry.items():
+            with ExitStack() as stack:
+                conn = conns[index] if conns else stack.enter_context(self.registry_engines[index].connect())
+                for start in range(0, len(found), REGISTRY_LOOKUP_CHUNK):
+                    registered.update(conn.execute(
+                        select(email_registry.c.email, email_registry.c.recipient_id)
+                        .where(email_registry.c.email.in_(found[start:start + REGISTRY_LOOKUP_CHUNK]))).all())
+        return registered
+
+    def registered(self, emails):
+        return self._registered(None, emails)
+
+    # Registers rows (with email and id), one committed transaction per registry file. A duplicate
+    # email raises IntegrityError with none of the rows left registered.
+    def register(self, rows):
+        committed = []
+        try:
+            for index, entries in self._by_registry(rows).items():
+                with self.registry_engines[index].begin() as conn:
+                    conn.execute(insert(email_registry), entries)
+                committed.extend(entry['email'] for entry in entries)
+        except IntegrityError:
+            self.unregister(committed)
+            raise
+
+    def unregister(self, emails):
+        by_registry = defaultdict(list)
+        for email in emails:
+            by_registry[self.registry_index(email)].append({'b_email': email})
+        for index, params in by_registry.items():
+            with self.registry_engines[index].begin() as conn:
+                conn.execute(email_registry.delete().where(email_registry.c.email == bindparam('b_email')), params)
+
+    def recipient_count(self, recipient_category):
+        with self.engine_for(recipient_category).connect() as conn:
+            return conn.execute(select(RecipientCategoryCount.recipient_count).where(
+                RecipientCategoryCount.recipient_category == recipient_category)).scalar() or 0
+
+    # {category: count} over every shard; a category is counted in exactly one of them
+    def category_counts(self):
+        counts = {}
+        for engine in self.engines:
+            with engine.connect() as conn:
+                counts.update(conn.execute(
+                    select(RecipientCategoryCount.recipient_category, RecipientCategoryCount.recipient_count)).all())
+        return counts
+
+    # The registry lists exactly the sharded emails. It is rebuilt from the shards when its size
+    # says otherwise: the first start with a registry, or a write or move interrupted between
+    # registering its emails and committing the rows.
+    def _sync_registry(self):
+        registered = 0
+        for engine in self.registry_engines:
+            with engine.connect() as conn:
+                registered += conn.execute(select(func.count()).select_from(email_registry)).scalar()
+        if registered == sum(self.category_counts().values()):
+            return
+        logger.info("Rebuilding the recipient email registry from the shards in %s", self.directory)
+        try:
+            with ExitStack() as stack:
+                targets = [stack.enter_context(engine.begin()) for engine in self.registry_engines]
+                for target in targets:
+                    target.execute(email_registry.delete())
+                for engine in self.engines:
+                    with engine.connect() as source:
+                        rows = source.execute(select(Recipient.email, Recipient.id)
+                                              .execution_options(yield_per=MOVE_CHUNK_SIZE))
+                        for chunk in rows.partitions():
+                            for index, entries in self._by_registry(row._asdict() for row in chunk).items():
+                                targets[index].execute(insert(email_registry), entries)
+        except IntegrityError:
+            raise ValueError(f'Some emails are stored in more than one shard in {self.directory}; keep one '
+                             f'recipient per email before starting with STORAGE=sharded')
+
+    # Recipients in the main database (a fresh seed, a restored snapshot, rows written with
+    # STORAGE=sql) are moved into the shards and registered; rows already in the shards are never
+    # touched. Into empty shards the rows keep their ids, so cursors and dispatch checkpoints stay
+    # valid; otherwise each takes a new id from its shard's sequence. A row whose email is already
+    # sharded stays in the main database and is logged, unless it is that very row (same id) left
+    # behind by an interrupted move. Returns the number of rows moved.
+    def absorb(self, main_engine):
+        with self.layout_lock():
+            self._sync_registry()
+            with main_engine.connect() as conn:
+                highest = conn.execute(select(func.max(Recipient.id))).scalar()
+            if highest is None:
+                return 0
+            keep_ids = sum(self.category_counts().values()) == 0
+            moved, done_ids, conflicts = 0, [], 0
+            # Commit order: the registry, the shards, then the main database, so a crash in between
+            # leaves rows in the main database that the next start finds registered under their
+            # own ids (or, without their shard rows, a registry that gets rebuilt)
+            with main_engine.begin() as main:
+                with ExitStack() as stack:
+                    conns = [stack.enter_context(engine.begin()) for engine in self.engines]
+                    for conn in conns:
+                        stack.enter_context(triggers_suspended(conn, BASE_TABLE))
+                    registry_conns = [stack.enter_context(engine.begin()) for engine in self.registry_engines]
+                    rows = main.execute(select(*(getattr(Recipient, name) for name in _COLUMNS))
+                                        .execution_options(yield_per=MOVE_CHUNK_SIZE))
+                    for chunk in rows.partitions():
+                        registered = self._registered(registry_conns, [row.email for row in chunk])
+                        by_shard = defaultdict(list)
+                        for row in chunk:
+                            if row.email not in registered:
+                                by_shard[self.index_for(row.recipient_category)].append(row)
+                            elif registered[row.email] == row.id:
+                                done_ids.append(row.id)
+                            else:
+                                conflicts += 1
+                        for index, shard_rows in by_shard.items():
+                            first = None if keep_ids else self.allocate_ids(conns[index], index, len(shard_rows))
+                            values = [{name: getattr(row, name) for name in _COLUMNS} for row in shard_rows]
+                            if first is not None:
+                                for position, value in enumerate(values):
+                                    value['id'] = first + position * self.count
+                            conns[index].execute(insert(Recipient), values)
+                            for registry_index, entries in self._by_registry(values).items():
+                                registry_conns[registry_index].execute(insert(email_registry), entries)
+                            done_ids.extend(row.id for row in shard_rows)
+                            moved += len(shard_rows)
+                    if keep_ids:
+                        for index, conn in enumerate(conns):
+                            conn.execute(update(id_sequence).values(
+                                next_id=func.max(id_sequence.c.next_id, first_id_after(highest, index, self.count))))
+                with triggers_suspended(main, BASE_TABLE):
+                    if conflicts:
+                        main.execute(Recipient.__table__.delete().where(Recipient.id == bindparam('b_id')),
+                                     [{'b_id': recipient_id} for recipient_id in done_ids])
+                    else:
+                        main.execute(Recipient.__table__.delete())
+            if conflicts:
+                logger.warning("%d recipients in the main database have emails that are already in the shards in "
+                               "%s and were left there", conflicts, self.directory)
+            return moved
+
+    # The reverse of absorb: every recipient goes back to the main database and the shard and
+    # registry files are removed, e.g. before changing RECIPIENT_SHARDS or going back to STORAGE=sql
+    def merge(self, main_engine):
+        with self.layout_lock():
+            moved = 0
+            with main_engine.begin() as target, triggers_suspended(target, BASE_TABLE):
+                for engine in self.engines:
+                    with engine.connect() as source:
+                        rows = source.execute(select(*(getattr(Recipient, name) for name in _COLUMNS))
+                                              .execution_options(yield_per=MOVE_CHUNK_SIZE))
+                        for chunk in rows.partitions():
+                            target.execute(insert(Recipient), [row._asdict() for row in chunk])
+                            moved += len(chunk)
+            self._remove_files()
+            return moved
+
+    def _remove_files(self):
+        for index in range(self.count):
+            for engine, path in ((self.engines[index], self.path(index)),
+                                 (self.registry_engines[index], self.registry_path(index))):
+                engine.dispose()
+                _remove_database_file(path)
+
+    # {shard: problems} for counters that drifted and categories stored in the wrong shard
+    def check(self):
+        problems = {}
+        for index, engine in enumerate(self.engines):
+            with engine.connect() as conn:
+                found = [f'{category}: counter {stored}, actual {actual}'
+                         for category, (stored, actual) in sorted(find_drift(conn).items())]
+                categories = conn.execute(select(Recipient.recipient_category).distinct()).scalars()
+                found += [f'{category}: belongs in shard {self.index_for(category)}'
+                          for category in categories if self.index_for(category) != index]
+            if found:
+                problems[index] = found
+        return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m db.shards',
+        description='Move recipients between the main database and the per-category shard files used '
+                    'with STORAGE=sharded. A sharded server absorbs the main database\'s recipients on '
+                    'startup by itself; split does the same ahead of time.')
+    parser.add_argument('action', choices=('split', 'merge', 'check'))
+    parser.add_argument('--shards', type=int, help='Number of shards (default: $RECIPIENT_SHARDS)')
+    parser.add_argument('--dir', help='Shard directory (default: $SHARD_DIR, or next to the database file)')
+    args = parser.parse_args(argv)
+
+    from api.app import app
+    from db import db
+    logging.basicConfig(level=logging.INFO)
+    with app.app_context():
+        directory = args.dir or app.config['SHARD_DIR']
+        if not directory:
+            parser.error('--dir is required when the database is not a SQLite file')
+        shards = RecipientShards(directory, args.shards or app.config['RECIPIENT_SHARDS'])
+        if args.action == 'split':
+            logging.info("Moved %d recipients into %d shards in %s", shards.absorb(db.engine), shards.count,
+                         directory)
+        elif args.action == 'merge':
+            logging.info("Moved %d recipients back into the main database", shards.merge(db.engine))
+        else:
+            problems = shards.check()
+            for index, found in sorted(problems.items()):
+                for problem in found:
+                    logging.info("shard %d: %s", index, problem)
+            logging.info("%d shards with problems", len(problems))
+            return 1 if problems else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+import hashlib
+import inspect
+import logging
+import os
+
+from sqlalchemy import inspect as inspect_schema
+from sqlalchemy import select
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from db import db, dummy_data_initinilazier
+from db.config import INSTANCE_DIR
+from db.generator import GENERATOR_VERSION
+from db.models import SeedMetadata
+from db.schema import trigger_ddl
+
+FINGERPRINT_KEY = 'seed_fingerprint'
+
+SNAPSHOT_DIR = os.environ.get('SEED_SNAPSHOT_DIR', os.path.join(INSTANCE_DIR, 'snapshots'))
+
+
+# Identifies a seeded database: the DDL of every table, index and trigger plus what was seeded
+# into them. Any model change, generator change or different scale produces another fingerprint.
+def fingerprint(engine, scale):
+    digest = hashlib.sha256()
+    for table in db.metadata.sorted_tables:
+        digest.update(str(CreateTable(table).compile(dialect=engine.dialect)).encode('utf-8'))
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            digest.update(str(CreateIndex(index).compile(dialect=engine.dialect)).encode('utf-8'))
+    for ddl in trigger_ddl(engine.dialect):
+        digest.update(ddl.encode('utf-8'))
+    if scale is None:
+        digest.update(b'sample:' + inspect.getsource(dummy_data_initinilazier).encode('utf-8'))
+    else:
+        digest.update(f'generated:{GENERATOR_VERSION}:{tuple(scale)}'.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def stored_fingerprint(engine):
+    if not inspect_schema(engine).has_table(SeedMetadata.__tablename__):
+        return None
+    with engine.connect() as conn:
+        return conn.execute(select(SeedMetadata.value).where(SeedMetadata.key == FINGERPRINT_KEY)).scalar()
+
+
+def store_fingerprint(session, value):
+    session.merge(SeedMetadata(key=FINGERPRINT_KEY, value=value))
+    session.commit()
+
+
+def sqlite_path(engine):
+    if engine.dialect.name != 'sqlite' or engine.url.database in (None, '', ':memory:'):
+        return None
+    return engine.url.database
+
+
+def snapshot_path(value):
+    return os.path.join(SNAPSHOT_DIR, f'seed-{value[:16]}.db')
+
+
+def _remove_sidecars(path):
+    for suffix in ('-wal', '-shm', '-journal'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+# Replace the database file with the snapshot. The copy is written next to the target and
+# renamed over it, so a crash mid-restore never leaves a half-written database behind.
+def restore_snapshot(engine, snapshot):
+    path = sqlite_path(engine)
+    engine.dispose()
+    partial = path + '.restoring'
+    with open(snapshot, 'rb') as source, open(partial, 'wb') as target:
+        while True:
+            block = source.read(16 * 1024 * 1024)
+            if not block:
+                break
+            target.write(block)
+    _remove_sidecars(path)
+    os.replace(partial, path)
+    logging.info("Restored %s from snapshot %s", path, snapshot)
+
+
+# VACUUM INTO writes a compact, consistent copy of the live database in one statement
+def create_snapshot(engine, snapshot):
+    os.makedirs(os.path.dirname(snapshot), exist_ok=True)
+    partial = snapshot + '.partial'
+    if os.path.exists(partial):
+        os.remove(partial)
+    with engine.connect() as conn:
+        conn.exec_driver_sql('VACUUM INTO ?', (partial,))
+    os.replace(partial, snapshot)
+    logging.info("Wrote snapshot %s", snapshot)
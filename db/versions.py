@@ -0,0 +1,73 @@
+import logging
+
+from sqlalchemy import select
+
+from db.models import DataVersion
+
+VERSIONS_TABLE = DataVersion.__tablename__
+# Tables whose writes make cached responses stale (see api/cache.py)
+VERSIONED_TABLES = ('recipients', 'recipient_lists', 'email_templates', 'campaigns')
+
+POSTGRES_FUNCTION = f"""
+    CREATE OR REPLACE FUNCTION data_version_trigger() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO {VERSIONS_TABLE} (resource, version) VALUES (TG_TABLE_NAME, 1)
+        ON CONFLICT (resource) DO UPDATE SET version = {VERSIONS_TABLE}.version + 1;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;"""
+
+
+# Keeps the data_versions row of one table counting its writes. Routes, the group-commit writer,
+# the dispatcher, other workers and direct SQL all go through the triggers, so every process
+# sees every write. Same interface as the derived-table modules in db/schema.py.
+class VersionTriggers:
+    def __init__(self, base_table):
+        self.BASE_TABLE = base_table
+        bump = (f"INSERT INTO {VERSIONS_TABLE} (resource, version) VALUES ('{base_table}', 1) "
+                f"ON CONFLICT (resource) DO UPDATE SET version = version + 1")
+        self.sqlite_triggers = {
+            f'trg_{base_table}_version_{op.lower()}': f"""
+                CREATE TRIGGER IF NOT EXISTS trg_{base_table}_version_{op.lower()} AFTER {op} ON {base_table}
+                BEGIN
+                    {bump};
+                END"""
+            for op in ('INSERT', 'UPDATE', 'DELETE')
+        }
+        # Once per statement: a bulk insert is one change to the table
+        self.postgres_triggers = {
+            f'trg_{base_table}_version': f"""{POSTGRES_FUNCTION}
+                DROP TRIGGER IF EXISTS trg_{base_table}_version ON {base_table};
+                CREATE TRIGGER trg_{base_table}_version AFTER INSERT OR UPDATE OR DELETE ON {base_table}
+                FOR EACH STATEMENT EXECUTE FUNCTION data_version_trigger();""",
+        }
+
+    def triggers(self, dialect):
+        return {'sqlite': self.sqlite_triggers, 'postgresql': self.postgres_triggers}.get(dialect.name, {})
+
+    def install_triggers(self, conn):
+        for name, ddl in self.triggers(conn.dialect).items():
+            logging.debug("Ensuring trigger %s", name)
+            conn.exec_driver_sql(ddl)
+
+    def drop_triggers(self, conn):
+        for name in self.triggers(conn.dialect):
+            on = f' ON {self.BASE_TABLE}' if conn.dialect.name == 'postgresql' else ''
+            conn.exec_driver_sql(f'DROP TRIGGER IF EXISTS {name}{on}')
+
+    # A bulk load or wipe went past the triggers; count it as one more write
+    def rebuild(self, conn):
+        conn.exec_driver_sql(
+            f"INSERT INTO {VERSIONS_TABLE} (resource, version) VALUES ('{self.BASE_TABLE}', 1) "
+            f"ON CONFLICT (resource) DO UPDATE SET version = {VERSIONS_TABLE}.version + 1")
+        return {}
+
+
+VERSIONS = tuple(VersionTriggers(table) for table in VERSIONED_TABLES)
+
+
+# {resource: version} for the given tables; a table never written to is at 0
+def read_versions(conn, resources):
+    found = dict(conn.execute(select(DataVersion.resource, DataVersion.version)
+                              .where(DataVersion.resource.in_(resources))).all())
+    return {resource: found.get(resource, 0) for resource in resources}
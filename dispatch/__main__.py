@@ -0,0 +1,45 @@
+import argparse
+import logging
+import signal
+from datetime import timedelta
+
+from api.app import app
+from dispatch.dispatcher import Dispatcher
+from dispatch.transports import transport_from_url
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m dispatch', description='Send due campaigns.')
+    parser.add_argument('--transport', default='null://',
+                        help='file:///path/to/sink.ndjson, smtp://host:port or null:// (default)')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--chunk-size', type=int, default=5000)
+    parser.add_argument('--lookahead-seconds', type=float, default=300.0)
+    parser.add_argument('--poll-interval', type=float, default=5.0)
+    parser.add_argument('--once', action='store_true',
+                        help='Resume interrupted campaigns, send everything due now and exit')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s %(message)s')
+    dispatcher = Dispatcher(transport_from_url(args.transport), workers=args.workers,
+                            batch_size=args.batch_size, chunk_size=args.chunk_size,
+                            lookahead=timedelta(seconds=args.lookahead_seconds),
+                            poll_interval=args.poll_interval)
+    signal.signal(signal.SIGTERM, lambda *_: dispatcher.stop())
+    signal.signal(signal.SIGINT, lambda *_: dispatcher.stop())
+
+    with app.app_context():
+        try:
+            if args.once:
+                dispatcher.resume_interrupted()
+                dispatcher.run_once()
+            else:
+                dispatcher.run_forever()
+        finally:
+            dispatcher.close()
+    print(dispatcher.stats.snapshot())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+import heapq
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update
+
+from api.storage import audience_storage
+from db import db
+from db.models import Campaign, CampaignDispatch, EmailTemplate
+from dispatch.templating import render_campaign_batch
+from dispatch.transports import Message
+
+logger = logging.getLogger(__name__)
+
+
+class DispatchStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.campaigns_started = 0
+        self.campaigns_sent = 0
+        self.messages_sent = 0
+        self.messages_failed = 0
+
+    def add(self, **counters):
+        with self._lock:
+            for name, value in counters.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def snapshot(self):
+        with self._lock:
+            elapsed = time.monotonic() - self.started_at
+            return {
+                'campaigns_started': self.campaigns_started,
+                'campaigns_sent': self.campaigns_sent,
+                'messages_sent': self.messages_sent,
+                'messages_failed': self.messages_failed,
+                'elapsed_seconds': round(elapsed, 3),
+                'messages_per_second': round(self.messages_sent / elapsed, 1) if elapsed else 0.0
+            }
+
+
+# Scheduled campaigns due by until, served by ix_campaigns_status_send_time
+def due_statement(until):
+    return select(Campaign.id, Campaign.send_time) \
+        .where(Campaign.status == 'Scheduled', Campaign.send_time <= until) \
+        .order_by(Campaign.send_time)
+
+
+def interrupted_statement():
+    return select(Campaign.id).where(Campaign.status == 'Sending').order_by(Campaign.send_time)
+
+
+# Sends due campaigns. Campaigns due within the lookahead window are kept in a heap ordered by
+# send_time; each is claimed with a conditional Scheduled -> Sending update, its audience is read
+# in keyset chunks and handed to the transport in batches by a bounded worker pool, and a
+# conditional Sending -> Sent update finishes it. The recipient checkpoint is committed after
+# every batch, in order, so a restart resumes where the previous run stopped.
+class Dispatcher:
+    def __init__(self, transport, workers=8, batch_size=500, chunk_size=5000, max_attempts=3,
+                 lookahead=timedelta(minutes=5), poll_interval=5.0, stats_interval=10.0):
+        self.transport = transport
+        self.workers = workers
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.max_attempts = max_attempts
+        self.lookahead = lookahead
+        self.poll_interval = poll_interval
+        self.stats_interval = stats_interval
+        self.stats = DispatchStats()
+        self._queue = []
+        self._queued = set()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='dispatch')
+        self._stop = threading.Event()
+        self._last_stats_log = time.monotonic()
+
+    def stop(self):
+        self._stop.set()
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+        self.transport.close()
+
+    def _load_due(self, now):
+        due = db.session.execute(due_statement(now + self.lookahead)).all()
+        db.session.rollback()
+        for campaign_id, send_time in due:
+            if campaign_id not in self._queued:
+                self._queued.add(campaign_id)
+                heapq.heappush(self._queue, (send_time, campaign_id))
+
+    def _claim(self, campaign_id, now):
+        # The status and send_time are re-checked in the UPDATE itself: a campaign cancelled,
+        # rescheduled or claimed by another dispatcher since it was queued is skipped
+        claimed = db.session.execute(
+            update(Campaign)
+            .where(Campaign.id == campaign_id, Campaign.status == 'Scheduled', Campaign.send_time <= now)
+            .values(status='Sending', updated_at=now)
+        ).rowcount == 1
+        if claimed:
+            if db.session.get(CampaignDispatch, campaign_id) is None:
+                db.session.add(CampaignDispatch(campaign_id=campaign_id, started_at=now))
+        db.session.commit()
+        return claimed
+
+    def _send_with_retries(self, messages):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                return self.transport.send_batch(messages), 0
+            except Exception:
+                logger.warning("Transport failed on attempt %d/%d for a batch of %d messages",
+                               attempt, self.max_attempts, len(messages), exc_info=True)
+                if attempt < self.max_attempts:
+                    time.sleep(min(2 ** attempt * 0.1, 5.0))
+        return 0, len(messages)
+
+    def _build_messages(self, campaign, email_template, rows):
+        bodies = render_campaign_batch(campaign, email_template, rows)
+        return [Message(f'{campaign.id}:{row[0]}', row[1], campaign.name, body)
+                for row, body in zip(rows, bodies)]
+
+    # Read through the storage layer, so with STORAGE=sharded only the category's shard is scanned
+    def _iter_audience(self, recipient_category, after_id):
+        storage = audience_storage()
+        while True:
+            rows = storage.recipient_rows(recipient_category, self.chunk_size, after_id)
+            if not rows:
+                return
+            yield rows
+            after_id = rows[-1][0]
+
+    def _checkpoint(self, campaign_id, last_recipient_id, sent, failed):
+        db.session.execute(
+            update(CampaignDispatch)
+            .where(CampaignDispatch.campaign_id == campaign_id)
+            .values(last_recipient_id=last_recipient_id,
+                    sent_count=CampaignDispatch.sent_count + sent,
+                    failed_count=CampaignDispatch.failed_count + failed)
+        )
+        still_sending = db.session.execute(
+            select(Campaign.status).where(Campaign.id == campaign_id)
+        ).scalar() == 'Sending'
+        db.session.commit()
+        return still_sending
+
+    def send_campaign(self, campaign_id):
+        campaign = db.session.get(Campaign, campaign_id)
+        email_template = db.session.execute(
+            select(EmailTemplate).where(EmailTemplate.name == campaign.template_name)
+        ).scalar()
+        progress = db.session.get(CampaignDispatch, campaign_id)
+        last_recipient_id = progress.last_recipient_id if progress else 0
+        logger.info("Sending campaign %s (%s) from recipient %d", campaign.name, campaign.recipient_category,
+                    last_recipient_id)
+        self.stats.add(campaigns_started=1)
+
+        in_flight = deque()
+
+        # Batches complete out of order but are checkpointed in submission order
+        def drain(limit):
+            while len(in_flight) > limit:
+                batch_last_id, future = in_flight.popleft()
+                sent, failed = future.result()
+                self.stats.add(messages_sent=sent, messages_failed=failed)
+                if not self._checkpoint(campaign_id, batch_last_id, sent, failed):
+                    return False
+            self._maybe_log_stats()
+            return True
+
+        for rows in self._iter_audience(campaign.recipient_category, last_recipient_id):
+            messages = self._build_messages(campaign, email_template, rows)
+            for start in range(0, len(messages), self.batch_size):
+                batch = messages[start:start + self.batch_size]
+                batch_last_id = rows[min(start + self.batch_size, len(rows)) - 1][0]
+                in_flight.append((batch_last_id, self._pool.submit(self._send_with_retries, batch)))
+                # Bound the number of batches held in memory to twice the worker count
+                if not drain(self.workers * 2):
+                    return self._abandon(campaign, in_flight)
+            if self._stop.is_set():
+                drain(0)
+                logger.info("Stopping mid-campaign %s; it resumes from its checkpoint on restart", campaign.name)
+                return False
+        if not drain(0):
+            return self._abandon(campaign, in_flight)
+
+        now = datetime.utcnow()
+        db.session.execute(
+            update(Campaign).where(Campaign.id == campaign_id, Campaign.status == 'Sending')
+            .values(status='Sent', updated_at=now)
+        )
+        db.session.execute(
+            update(CampaignDispatch).where(CampaignDispatch.campaign_id == campaign_id).values(finished_at=now)
+        )
+        db.session.commit()
+        self.stats.add(campaigns_sent=1)
+        logger.info("Campaign %s sent", campaign.name)
+        return True
+
+    def _abandon(self, campaign, in_flight):
+        # The campaign left 'Sending' (e.g. it was cancelled); let queued batches finish, record nothing more
+        for _, future in in_flight:
+            future.result()
+        logger.info("Campaign %s is no longer Sending; stopped dispatching it", campaign.name)
+        return False
+
+    def _maybe_log_stats(self):
+        now = time.monotonic()
+        if now - self._last_stats_log >= self.stats_interval:
+            self._last_stats_log = now
+            logger.info("Dispatch progress: %s", self.stats.snapshot())
+
+    # Campaigns left in 'Sending' by a previous run are resumed from their checkpoint
+    def resume_interrupted(self):
+        interrupted = db.session.execute(interrupted_statement()).scalars().all()
+        for campaign_id in interrupted:
+            if self._stop.is_set():
+                return
+            if db.session.get(CampaignDispatch, campaign_id) is None:
+                db.session.add(CampaignDispatch(campaign_id=campaign_id))
+                db.session.commit()
+            self.send_campaign(campaign_id)
+
+    def run_once(self):
+        now = datetime.utcnow()
+        self._load_due(now)
+        while self._queue and self._queue[0][0] <= now and not self._stop.is_set():
+            _, campaign_id = heapq.heappop(self._queue)
+            self._queued.discard(campaign_id)
+            if self._claim(campaign_id, now):
+                self.send_campaign(campaign_id)
+            now = datetime.utcnow()
+
+    def run_forever(self):
+        self.resume_interrupted()
+        next_poll = 0.0
+        while not self._stop.is_set():
+            if time.monotonic() >= next_poll:
+                # Re-reading the due set picks up campaigns created or rescheduled since the last poll
+                self._queue = []
+                self._queued = set()
+                next_poll = time.monotonic() + self.poll_interval
+            self.run_once()
+            wait = next_poll - time.monotonic()
+            if self._queue:
+                until_due = (self._queue[0][0] - datetime.utcnow()).total_seconds()
+                wait = min(wait, until_due)
+            self._stop.wait(max(wait, 0.05))
+        logger.info("Dispatcher stopped: %s", self.stats.snapshot())
@@ -0,0 +1,86 @@
+import re
+import threading
+from collections import OrderedDict
+
+from db.models import Recipient
+
+# Column layout of the recipient rows the compiled templates render, as plain tuples
+RECIPIENT_COLUMNS = (Recipient.id, Recipient.email, Recipient.name, Recipient.recipient_category)
+_FIELD_POSITIONS = {'email': 1, 'name': 2, 'recipient_category': 3}
+
+PLACEHOLDER_RE = re.compile(r'\{\{\s*(\w+)\s*\}\}')
+
+# Number of compiled templates kept in memory
+TEMPLATE_CACHE_SIZE = 1024
+
+
+# A template parsed once into a str.format pattern whose fields index straight into a
+# recipient row tuple, so rendering a row is a single C-level format call and never builds a
+# dict per recipient. Unknown placeholders are left in the output untouched.
+class CompiledTemplate:
+    __slots__ = ('source', '_format')
+
+    def __init__(self, source):
+        self.source = source
+        parts = []
+        position = 0
+        for match in PLACEHOLDER_RE.finditer(source):
+            field = _FIELD_POSITIONS.get(match.group(1))
+            if field is None:
+                continue
+            parts.append(source[position:match.start()].replace('{', '{{').replace('}', '}}'))
+            parts.append('{%d}' % field)
+            position = match.end()
+        parts.append(source[position:].replace('{', '{{').replace('}', '}}'))
+        self._format = ''.join(parts).format
+
+    def render(self, row):
+        if None in row:
+            row = ['' if value is None else value for value in row]
+        return self._format(*row)
+
+    def render_batch(self, rows):
+        render = self._format
+        return [render(*row) if None not in row else render(*['' if value is None else value for value in row])
+                for row in rows]
+
+
+class TemplateCache:
+    def __init__(self, maxsize=TEMPLATE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    # key identifies the template (e.g. its name); updated_at makes an edited template recompile
+    def get(self, key, updated_at, source):
+        cache_key = (key, updated_at)
+        with self._lock:
+            compiled = self._entries.get(cache_key)
+            if compiled is not None:
+                self._entries.move_to_end(cache_key)
+                return compiled
+        compiled = CompiledTemplate(source)
+        with self._lock:
+            self._entries[cache_key] = compiled
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return compiled
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+template_cache = TemplateCache()
+
+
+# Render the bodies of a campaign for a chunk of recipient rows (laid out as RECIPIENT_COLUMNS):
+# the email template's content followed by the campaign's own text, both personalized.
+def render_campaign_batch(campaign, email_template, rows):
+    campaign_text = template_cache.get(('campaign', campaign.name), campaign.updated_at,
+                                       campaign.campaign_template).render_batch(rows)
+    if email_template is None:
+        return campaign_text
+    template_text = template_cache.get(('template', email_template.name), email_template.updated_at,
+                                       email_template.content).render_batch(rows)
+    return [f'{header}\n\n{body}' for header, body in zip(template_text, campaign_text)]
@@ -0,0 +1,95 @@
+import json
+import smtplib
+import threading
+from collections import namedtuple
+from email.message import EmailMessage
+from urllib.parse import urlparse
+
+# key is '<campaign_id>:<recipient_id>', stable across restarts so a sink can de-duplicate
+Message = namedtuple('Message', ['key', 'to', 'subject', 'body'])
+
+
+class NullTransport:
+    def send_batch(self, messages):
+        return len(messages)
+
+    def close(self):
+        pass
+
+
+# Appends every message as one JSON line; used as a local sink for testing and benchmarks
+class FileTransport:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def send_batch(self, messages):
+        lines = ''.join(json.dumps(message._asdict()) + '\n' for message in messages)
+        with self._lock:
+            self._file.write(lines)
+            self._file.flush()
+        return len(messages)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+# Keeps one SMTP connection per worker thread and reuses it across batches
+class SmtpTransport:
+    def __init__(self, host='localhost', port=25, sender='noreply@example.com', timeout=30):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def send_batch(self, messages):
+        try:
+            connection = self._connection()
+            for message in messages:
+                email = EmailMessage()
+                email['From'] = self.sender
+                email['To'] = message.to
+                email['Subject'] = message.subject
+                email['Message-ID'] = f'<{message.key}@{self.host}>'
+                email.set_content(message.body)
+                connection.send_message(email)
+        except OSError:
+            # Drop the connection so the retry starts from a fresh one
+            self._local.connection = None
+            raise
+        return len(messages)
+
+    def close(self):
+        with self._lock:
+            for connection in self._connections:
+                try:
+                    connection.quit()
+                except OSError:
+                    pass
+            self._connections = []
+
+
+# file:///path/to/sink.ndjson, smtp://host:port or null://
+def transport_from_url(url):
+    parsed = urlparse(url)
+    if parsed.scheme == 'file':
+        return FileTransport(parsed.path)
+    if parsed.scheme == 'smtp':
+        return SmtpTransport(parsed.hostname or 'localhost', parsed.port or 25)
+    if parsed.scheme == 'null':
+        return NullTransport()
+    raise ValueError(f'Unsupported transport URL {url!r}; expected file://, smtp:// or null://')
@@ -1,7 +1,16 @@
 #!/bin/bash
 
-# Run the data seeding script
+# Reuse the seeded database when its schema and seed fingerprint match, restore the matching
+# snapshot otherwise, and only seed from scratch when neither exists (SEED_FORCE=1 forces it)
 python data_seed.py
 
+# SERVER=uvicorn serves the same routes through the ASGI adapter (api/asgi.py), which keeps
+# slow clients and idle connections on the event loop instead of holding a sync worker. Latency,
+# rate-limit and fault-injection profiles (MOCK_PROFILES=profiles.json, see profiles.example.json)
+# are applied there too, so they only take effect with SERVER=uvicorn.
+if [ "$SERVER" = "uvicorn" ]; then
+    exec uvicorn api.asgi:app --host 0.0.0.0 --port 5000 --workers "${WEB_CONCURRENCY:-1}"
+fi
+
 # Start the Flask application with Gunicorn
 gunicorn --bind 0.0.0.0:5000 api.app:app